@@ -0,0 +1,127 @@
+# Testing aggregates (dur, onsetSpan, pitchRange), the memos that operations
+# keep of them, and the invalidation of those memos. Every check compares the
+# answer against one worked out from scratch.
+# Run from the repository root with: python -m MusECI.AggregateTests
+
+from MusECI.MusEciDataStructures import *
+import MusECI.BasicOperations as basic
+import MusECI.MusEciOperations as op
+import MusECI.MEvent as me
+
+
+def leaves(x):
+    return basic.mMapAllRet(lambda v: v, x)
+
+
+def freshDur(x):
+    kind = nodeKind(x)
+    if kind == NOTE or kind == REST:
+        return x.dur
+    elif kind == SEQ:
+        return sum([freshDur(t) for t in x.trees])
+    elif kind == PAR:
+        return max([freshDur(t) for t in x.trees] + [0])
+    else:
+        return freshDur(x.tree)
+
+
+def freshSpan(x):
+    vals = [(v.onset, v.onset + v.dur) for v in leaves(x) if v.onset is not None]
+    if len(vals) == 0:
+        return None
+    return (min([v[0] for v in vals]), max([v[1] for v in vals]))
+
+
+def freshRange(x):
+    ps = [v.pitch for v in leaves(x) if isinstance(v, Note)]
+    if len(ps) == 0:
+        return None
+    return (min(ps), max(ps))
+
+
+def check(x, label):
+    assert basic.dur(x) == freshDur(x), label + ": dur"
+    assert basic.onsetSpan(x) == freshSpan(x), label + ": onsetSpan"
+    assert basic.pitchRange(x) == freshRange(x), label + ": pitchRange"
+    print(label + ": ok")
+
+
+def makeMusic():
+    m1 = Seq([Note(60, QN), Note(62, EN), Rest(EN), Note(64, HN)], inPlace=True)
+    m2 = Par([Note(48, WN), Seq([Note(55, QN), Note(57, QN)], inPlace=True)], inPlace=True)
+    return Seq([Part(m1, Instrument(0)), m2, Seq([Note(72, 0), Rest(0)], inPlace=True)], inPlace=True)
+
+
+# Values are remembered in a memo and reused
+x = makeMusic()
+check(x, "initial")
+memo = dict()
+assert basic.pitchRange(x, memo) == (48, 72)
+assert memo[id(x)] == (x, (48, 72)) and memo[id(x.trees[1])][1] == (48, 57)
+memo[id(x.trees[1])] = (x.trees[1], (0, 127))
+assert basic.pitchRange(x, memo) == (48, 72) # x itself is known
+del memo[id(x)]
+assert basic.pitchRange(x, memo) == (0, 127)
+
+# Changing a subtree must be seen by its ancestors
+basic.transpose(x.trees[1], 12)
+check(x, "transpose subtree")
+basic.scaleDurations(x.trees[0].tree, 2)
+check(x, "scaleDurations subtree")
+
+# deriveOnsets works out each subtree's duration only once
+x = makeMusic()
+basic.deriveOnsets(x)
+check(x, "deriveOnsets")
+basic.shiftOnsets(x.trees[1], 0.5)
+check(x, "shiftOnsets")
+assert basic.minOnset(x) == 0
+assert basic.durOnset(x) == freshSpan(x)[1] - freshSpan(x)[0]
+
+# Structural changes
+for name, f in [("cut", lambda m: basic.cut(m, 0.6)), ("remove", lambda m: basic.remove(m, 0.3)),
+                ("removeZeros", basic.removeZeros), ("stripRests", basic.stripRests),
+                ("reverse in place", basic.reverseInPlace)]:
+    x = makeMusic()
+    if name == "reverse in place":
+        x = x.trees[0] # reverseInPlace can't handle Pars
+    check(x, name + " (before)")
+    f(x)
+    check(x, name)
+
+# Copies share subtrees with the original; altering one must not disturb the other
+x = makeMusic()
+check(x, "original")
+y = Seq([x, Note(90, QN)])
+check(y, "copy")
+basic.transpose(y, -24)
+basic.scaleDurations(y, 0.5)
+check(x, "original after changing the copy")
+check(y, "copy after changing it")
+
+# Higher-level operations
+x = makeMusic()
+basic.deriveOnsets(x)
+check(x, "before operations")
+y = op.Transpose(7).apply(x)
+check(x, "original after Transpose")
+check(y, "Transpose")
+y = op.Repeat(3).apply(x)
+check(y, "Repeat")
+op.ScaleDurs(2).apply(x)
+check(x, "ScaleDurs")
+z = me.applyTempo(Music([x]), 2.0)
+check(z, "applyTempo")
+
+# Changes made by hand are seen right away
+x = makeMusic()
+check(x, "before hand edit")
+x.trees[1].trees[0].pitch = 30
+x.trees[0].tree.trees[0].dur = WN
+assert basic.dur(x) == 2.75
+x.trees[2].trees.append(Note(100, QN))
+assert basic.dur(x) == 3.0
+check(x, "after hand edit")
+basic.deriveOnsets(x)
+x.trees[2].trees[0].onset = 10
+check(x, "after hand edit of an onset")
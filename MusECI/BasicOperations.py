@@ -1,4 +1,5 @@
 from copy import deepcopy
+import copy as _copy # private, so star imports still get the copy module
 from MusECI.MusEciDataStructures import *
 from random import *
 
@@ -17,42 +18,60 @@ def removeOnsets(musicVal):
     mMap(stripOnset, musicVal)
 
 def findBy(selectFun, x):
-    retVals = []
-    if selectFun(x):
-        retVals.append(x)
-    elif x.__class__.__name__ == "Seq" or isinstance(x, Par):
-        for t in x.trees:
-            newVals = findBy(selectFun, t)
-            retVals = retVals+newVals
-    elif x.__class__.__name__=="Note" or x.__class__.__name__=="Rest":
-        if selectFun(x):
-            retVals.append(x)
-    elif x.__class__.__name__=="Part": # formerly Modify
-        newVals = findBy(selectFun, x.tree)
-        retVals = retVals+newVals
-    return retVals
+    """
+    Find the subtrees of x for which selectFun is true (without looking inside
+    of ones that are found). Inside of a Shift, selectFun is given subtrees of
+    an expanded copy (see materialize), so it sees the right onsets. What is
+    found belongs to x, like the results of select (see resolvePath).
+    :param selectFun: a function from music values to booleans
+    :param x: the music value to search
+    :return: a list of the subtrees found
+    """
+    def unroll(link): # paths are kept as linked (rest of path, last step) pairs while searching
+        path = []
+        while link is not None:
+            link, step = link
+            path.append(step)
+        path.reverse()
+        return path
+    paths = []
+    stack = [(x, x, None)] # (subtree, what selectFun sees of it, path to it)
+    while stack:
+        t, view, link = stack.pop()
+        kind = nodeKind(t)
+        if kind == SHIFT:
+            if view is t: # not inside another Shift
+                if selectFun(t):
+                    paths.append(unroll(link))
+                    continue
+                view = materialize(t)
+            # expanded copies have no Shifts, so view is already what t.tree looks like
+            stack.append((t.tree, view, (link, (kind, 0))))
+        elif selectFun(view):
+            paths.append(unroll(link))
+        elif kind == SEQ or kind == PAR:
+            for i in reversed(range(len(t.trees))): # reversed so that results are in order
+                stack.append((t.trees[i], view.trees[i], (link, (kind, i))))
+        elif kind == PART: # formerly Modify
+            stack.append((t.tree, view.tree, (link, (kind, 0))))
+    return [resolvePath(x, path) for path in paths]
 
 def minOnset(x):
-    os = getOnsets(x)
-    retVal = 0
-    for o in os:
-        if o==None:
-            pass
-        else:
-            if o < retVal:
-                retVal = o
-    return retVal
+    span = onsetSpan(x)
+    if span is None or span[0] > 0:
+        return 0
+    return span[0]
 
 def setDefaultOffset(x, defO):
     def oFun(x):
-        if (x.__class__.__name__ == 'Note' or x.__class__.__name__ == 'Rest'):
+        if (isNote(x) or isRest(x)):
             if (x.onset == None):
                 x.onset = defO
     mMapAll(oFun, x)
 
 def shiftOnsets(x, shiftAmt):
     def oFun(x):
-        if (x.__class__.__name__ == 'Note' or x.__class__.__name__ == 'Rest'):
+        if (isNote(x) or isRest(x)):
             if (x.onset != None):
                 x.onset = x.onset + shiftAmt
     mMapAll(oFun, x)
@@ -64,14 +83,14 @@ def line(musicVals, correctOnsets=True):
     :param musicVals: a list of musical structures
     :return: the sequential composition of the input list
     """
-    ms = deepcopy(musicVals)
+    ms = [privateCopy(m) for m in musicVals]
     offset = 0
     if(correctOnsets):
         for m in ms:
             mdur = durOnset(m)
             shiftOnsets(m, offset)
         offset = offset + mdur
-    return Seq(ms)
+    return Seq(ms, inPlace=True) # ms is already a copy
 
 def par(musicVals): # Does NOT assign onsets by default
     """
@@ -80,43 +99,62 @@ def par(musicVals): # Does NOT assign onsets by default
     :param musicVals: a list of music structures
     :return: the parallel composition of the input
     """
-    ms = deepcopy(musicVals)
-    return Par(ms)
+    return Par(musicVals) # Par copies its input (sharing structure)
 
 def deriveOnsets(x, currentTime=0):
     #if (x.__class__.__name__ == 'Music'):
     #    deriveOnsets(x.tree, 0)
-    if (x.__class__.__name__ == 'Note' or x.__class__.__name__ == 'Rest'):
-        if x.onset == None:
-            x.onset = currentTime
-    elif (x.__class__.__name__ == 'Seq'):
-        ct = currentTime
-        for t in x.trees:
-            deriveOnsets(t, ct)
-            ct = ct + dur(t)
-    elif isinstance(x, Par):
-        for t in x.trees:
-            deriveOnsets(t, currentTime)
-    elif (x.__class__.__name__ == 'Part'): # formerly Modify
-        deriveOnsets(x.tree, currentTime)
-    else:
-        raise MusEciException("Unrecognized musical structure: " + str(x))
+    touch(node=x)
+    durs = dict() # durations are unchanged by this, so each subtree's is only worked out once
+    stack = [(x, currentTime)] # subtrees still to visit, with their start times
+    while stack:
+        x, currentTime = stack.pop()
+        kind = nodeKind(x)
+        if kind == NOTE or kind == REST:
+            if x.onset == None:
+                x.onset = currentTime
+        elif kind == SEQ:
+            unshare(x)
+            ct = currentTime
+            starts = []
+            last = len(x.trees) - 1
+            for i in range(len(x.trees)):
+                starts.append((x.trees[i], ct))
+                if i < last: # the last tree's duration isn't needed (avoids re-walking deep right spines)
+                    ct = ct + dur(x.trees[i], durs)
+            starts.reverse()
+            stack.extend(starts)
+        elif kind == PAR:
+            unshare(x)
+            for t in reversed(x.trees):
+                stack.append((t, currentTime))
+        elif kind == PART or kind == SHIFT: # formerly Modify
+            unshare(x)
+            stack.append((x.tree, currentTime))
+        else:
+            raise MusEciException("Unrecognized musical structure: " + str(x))
 
 def getOnset(x): # We assume onsets are defined
-    if x.__class__.__name__ == "Part": # formerly Modify
+    kind = nodeKind(x)
+    if kind == PART: # formerly Modify
         return getOnset(x.tree)
-    elif x.__class__.__name__=="Note" or x.__class__.__name__ == "Rest":
+    elif kind == SHIFT:
+        o = getOnset(x.tree)
+        return None if o is None else o + x.offset
+    elif kind == NOTE or kind == REST:
         return x.onset
-    elif x.__class__.__name__=="Seq":
+    elif kind == SEQ:
         return getOnset(x.trees[0]) # we assume structural correctness for Seq (first is earliest onset)
-    elif isinstance(x, Par):
+    elif kind == PAR:
         return min(list(map(getOnsets, x.trees))) # can't really make the same assumption for Par
     else:
         raise MusEciException("Unrecognized musical structure: " + str(x))
 
-def durOnset(x):  # WE ASSUME ALL ONSETS HAVE BEEN DERIVED (no mix of actual numbers and Nones allowed)
-    minO = min(getOnsets(x))
-    maxE = max(getEndTimes(x))
+def durOnset(x, memo=None):  # WE ASSUME ALL ONSETS HAVE BEEN DERIVED (no mix of actual numbers and Nones allowed)
+    span = onsetSpan(x, memo)
+    if span is None:
+        raise MusEciException("No onsets found in: " + str(x))
+    minO, maxE = span
     return maxE - minO
 
 def getOnsets(x): # UNTESTED
@@ -129,35 +167,135 @@ def getEndTimes(x):# UNTESTED
 
 def scaleOnsets(x, shiftAmt):
     def oFun(x):
-        if (x.__class__.__name__ == 'Note' or x.__class__.__name__ == 'Rest'):
+        if (isNote(x) or isRest(x)):
             if (x.onset != None):
                 x.onset = x.onset * shiftAmt
     mMapAll(oFun, x)
 
-def dur(x): # WILL NOT HANDLE ONSETS
+def dur(x, memo=None): # WILL NOT HANDLE ONSETS
     """
     Computes the duration of a music tree. Values are relative to the overall
     bpm for the entire tree, such that 0.25 is a quarter note.
     :param x: the music structure
+    :param memo: durations of subtrees already worked out (see aggregate)
     :return: the duration of x in whole notes (wn = 1.0)
     """
-    if (x.__class__.__name__ == 'Music'):
-        d = max(list(map(dur,x.trees)))
-        return d * (120/x.bpm)
-    elif (x.__class__.__name__ == 'Note' or x.__class__.__name__ == 'Rest'):
-        return x.dur
-    elif (x.__class__.__name__ == 'Seq'):
-        return sum(map(dur,x.trees)) # THIS IS NOT RIGHT FOR ONSETS
-    elif isinstance(x, Par):
-        return max(list(map(dur,x.trees)))
-    elif (x.__class__.__name__ == 'Part'): # formerly Modify
-        #if (x.mod.__class__.__name__ == 'Tempo'):
-        #    d = dur(x.tree)
-        #    return d / x.mod.value
-        #else:
-        return dur(x.tree)
-    else:
-        raise MusEciException("Unrecognized musical structure: " + str(x))
+    def leafDur(x): return x.dur
+    def seqDur(a, b): return a + b # THIS IS NOT RIGHT FOR ONSETS
+    return aggregate(x, leafDur, seqDur, max, 0, memo=memo)
+
+
+def onsetSpan(x, memo=None):
+    """
+    Finds the earliest onset and the latest end time (onset + duration) of
+    the Notes and Rests in a music tree. Leaves without onsets are ignored.
+    :param x: the music structure
+    :param memo: onset spans of subtrees already worked out (see aggregate)
+    :return: a pair (min onset, max end time), or None if there are no onsets
+    """
+    def leafSpan(x):
+        if x.onset is None:
+            return None
+        return (x.onset, x.onset + x.dur)
+    def combine(a, b):
+        if a is None:
+            return b
+        elif b is None:
+            return a
+        return (min(a[0], b[0]), max(a[1], b[1]))
+    def shift(a, offset):
+        if a is None:
+            return None
+        return (a[0] + offset, a[1] + offset)
+    return aggregate(x, leafSpan, combine, combine, None, shift, memo)
+
+
+def pitchRange(x, memo=None):
+    """
+    Finds the lowest and highest pitch in a music tree.
+    :param x: the music structure
+    :param memo: pitch ranges of subtrees already worked out (see aggregate)
+    :return: a pair (min pitch, max pitch), or None if there are no Notes
+    """
+    def leafRange(x):
+        if nodeKind(x) == NOTE:
+            return (x.pitch, x.pitch)
+        return None
+    def combine(a, b):
+        if a is None:
+            return b
+        elif b is None:
+            return a
+        return (min(a[0], b[0]), max(a[1], b[1]))
+    return aggregate(x, leafRange, combine, combine, None, memo=memo)
+
+
+def aggregate(x, leafOp, seqOp, parOp, emptyVal, shiftOp=None, memo=None):
+    """
+    Computes a value over a whole music tree, bottom-up. A Part has the value
+    of its tree. The walk uses an explicit stack, so very deep trees are fine.
+
+    Values aren't kept on the nodes, since nodes can be changed by hand at any
+    time. Instead, an operation that asks for the values of many overlapping
+    subtrees (like deriveOnsets, which needs the duration of every child of
+    every Seq) passes the same memo to each call, so that every subtree is
+    only walked once. While it holds a memo, the operation has to remove the
+    entry of every Seq, Par, Part or Shift that it alters (and so of every
+    node on the path down to a change) before asking for values again.
+    :param x: the music structure
+    :param leafOp: takes a Note or Rest and returns its value
+    :param seqOp: combines the values of two consecutive trees in a Seq
+    :param parOp: combines the values of two trees in a Par
+    :param emptyVal: the value of a Seq or Par with no trees
+    :param shiftOp: takes the value of a Shift's tree and the Shift's offset and
+                    returns the value of the Shift (if None, the tree's value is used)
+    :param memo: a dictionary from ids of nodes to (node, value) pairs, for one
+                 kind of value, which is used and filled in (or None)
+    :return: the value for x
+    """
+    # Each frame is [node, kind, index of the next tree to visit, running value];
+    # d holds the value of the last finished subtree.
+    d = None
+    stack = [[x, nodeKind(x), 0, None]]
+    while stack:
+        frame = stack[-1]
+        x, kind, i, total = frame
+        if kind == NOTE or kind == REST:
+            d = leafOp(x)
+            stack.pop()
+            continue
+        if kind != SEQ and kind != PAR and kind != PART and kind != SHIFT:
+            raise MusEciException("Unrecognized musical structure: " + str(x))
+        if i == 0 and memo is not None:
+            known = memo.get(id(x))
+            if known is not None and known[0] is x: # (ids of nodes that are gone can be reused)
+                d = known[1]
+                stack.pop()
+                continue
+        if kind == PART or kind == SHIFT: # formerly Modify
+            if i == 0:
+                frame[2] = 1
+                stack.append([x.tree, nodeKind(x.tree), 0, None])
+                continue
+            # d is already the value of x.tree
+            if kind == SHIFT and shiftOp is not None:
+                d = shiftOp(d, x.offset)
+        else:
+            if i == 1: # tree i-1 just finished
+                total = d
+            elif i > 1:
+                total = seqOp(total, d) if kind == SEQ else parOp(total, d)
+            frame[3] = total
+            if i < len(x.trees):
+                frame[2] = i + 1
+                t = x.trees[i]
+                stack.append([t, nodeKind(t), 0, None])
+                continue
+            d = emptyVal if i == 0 else total
+        if memo is not None:
+            memo[id(x)] = (x, d)
+        stack.pop()
+    return d
 
 
 def line(musicVals): # Does NOT assign onsets by default.
@@ -181,20 +319,23 @@ def mMap(f, x):
     :param x: the music structure to operate on
     :return: an in-place modification of the music structure
     """
-    if (x.__class__.__name__ == 'Music'):
-        for t in x.trees:
-            mMap(f, t)
-    elif (x.__class__.__name__ == 'Note'):
-        f(x)
-    elif (x.__class__.__name__ == 'Rest'):
-        pass # nothing to do to a Rest
-    elif (x.__class__.__name__ == 'Seq' or isinstance(x, Par)):
-        for t in x.trees:
-            mMap(f, t)
-    elif (x.__class__.__name__ == 'Part'): # formerly Modify
-        mMap(f, x.tree)
-    else:
-        raise MusEciException("Unrecognized musical structure: " + str(x))
+    touch(node=x) # f could change any field
+    stack = [x] # explicit stack so that very deep trees don't hit the recursion limit
+    while stack:
+        x = stack.pop()
+        kind = nodeKind(x)
+        if kind == NOTE:
+            f(x)
+        elif kind == REST:
+            pass # nothing to do to a Rest
+        elif kind == SEQ or kind == PAR:
+            unshare(x) # copy any borrowed children before altering them
+            stack.extend(reversed(x.trees)) # reversed so that trees are visited left to right
+        elif kind == PART or kind == SHIFT: # formerly Modify
+            unshare(x)
+            stack.append(x.tree)
+        else:
+            raise MusEciException("Unrecognized musical structure: " + str(x))
 
 
 
@@ -208,18 +349,21 @@ def mMapAll(f, x):
     :param x: the music structure to traverse
     :return: an in-place altered version of the music structure
     """
-    if (x.__class__.__name__ == 'Music'):
-        for t in x.trees:
-            mMapAll(f,t)
-    elif (x.__class__.__name__ == 'Note' or x.__class__.__name__ == 'Rest'):
-        f(x)
-    elif (x.__class__.__name__ == 'Seq' or isinstance(x, Par)):
-        for t in x.trees:
-            mMapAll(f,t)
-    elif (x.__class__.__name__ == 'Part'): # formerly Modify
-        mMapAll(f, x.tree)
-    else:
-        raise MusEciException("Unrecognized musical structure: " + str(x))
+    touch(node=x)
+    stack = [x]
+    while stack:
+        x = stack.pop()
+        kind = nodeKind(x)
+        if kind == NOTE or kind == REST:
+            f(x)
+        elif kind == SEQ or kind == PAR:
+            unshare(x)
+            stack.extend(reversed(x.trees))
+        elif kind == PART or kind == SHIFT: # formerly Modify
+            unshare(x)
+            stack.append(x.tree)
+        else:
+            raise MusEciException("Unrecognized musical structure: " + str(x))
 
 def mMapAllRet(f, x):
     """
@@ -231,24 +375,26 @@ def mMapAllRet(f, x):
     :param x: the music structure to traverse
     :return: an in-place altered version of the music structure
     """
-    if (x.__class__.__name__ == 'Music'):
-        v = list()
-        for t in x.trees:
-            v += mMapAllRet(f,t)
-            v += mMapAllRet(f,t)
-        return v
-    elif (x.__class__.__name__ == 'Note' or x.__class__.__name__ == 'Rest'):
-        return [f(x)]
-    elif (x.__class__.__name__ == 'Seq' or isinstance(x, Par)):
-        v = list()
-        for t in x.trees:
-            v += mMapAllRet(f,t)
-            v += mMapAllRet(f,t)
-        return v
-    elif (x.__class__.__name__ == 'Part'):
-        return mMapAllRet(f, x.tree)
-    else:
-        raise MusEciException("Unrecognized musical structure: " + str(x))
+    v = list()
+    stack = [(x, ())] # subtrees, with the offsets of the Shifts they are in (outermost first)
+    while stack:
+        x, offsets = stack.pop()
+        kind = nodeKind(x)
+        if kind == NOTE or kind == REST:
+            if len(offsets) > 0 and x.onset is not None: # f sees a copy with the shifted onset
+                x = _copy.copy(x)
+                x.onset = applyOffsets(x.onset, offsets)
+            v.append(f(x))
+        elif kind == SEQ or kind == PAR:
+            for t in reversed(x.trees):
+                stack.append((t, offsets))
+        elif kind == PART:
+            stack.append((x.tree, offsets))
+        elif kind == SHIFT:
+            stack.append((x.tree, offsets + (x.offset,)))
+        else:
+            raise MusEciException("Unrecognized musical structure: " + str(x))
+    return v
 
 
 def transpose(x, amount):
@@ -286,32 +432,39 @@ def adjustVolume(x, amount): # add a constant amount to all volumes
     def f(xNote): xNote.vol = xNote.vol + amount
     mMap (f,x)
 
-def reverseInPlace(x):
+def reverseInPlace(x, durs=None):
     """
     Reverse a musical structure in place (last note is first, etc.)
     :param x: the music structure to reverse.
+    :param durs: durations of subtrees already worked out (see aggregate)
     :return: the reversal of the input.
     """
     #if (x.__class__.__name__ == 'Music'):
     #    reverseInPlace(x.tree)
-    if (x.__class__.__name__ == 'Note' or x.__class__.__name__ == 'Rest'):
+    if durs is None:
+        durs = dict()
+    durs.pop(id(x), None) # x is about to change
+    unshare(x)
+    touch(node=x)
+    kind = nodeKind(x)
+    if kind == NOTE or kind == REST:
         pass # nothing to do
-    elif (x.__class__.__name__ == 'Seq'):
+    elif kind == SEQ:
         x.trees.reverse()
         for t in x.trees:
-            reverseInPlace(t)
-    elif (x.__class__.__name__ == 'Par' or x.__class__.__name__ == 'Music'):
-        dMax = dur(x)
+            reverseInPlace(t, durs)
+    elif kind == PAR:
+        dMax = dur(x, durs)
         newTrees = []
         for t in x.trees:
-            newTrees.append(Seq[Rest(dMax - dur(t)), reverseInPlace(t)])
+            newTrees.append(Seq[Rest(dMax - dur(t, durs)), reverseInPlace(t, durs)])
         x.trees = newTrees
-    elif (x.__class__.__name__ == 'Part'):
-        reverseInPlace(x.tree)
+    elif kind == PART or kind == SHIFT:
+        reverseInPlace(x.tree, durs)
     else: raise MusEciException("Unrecognized musical structure: " + str(x))
 
 def reverse(x): # DOES NOT HANDLE ONSETS
-    x2 = deepcopy(x)
+    x2 = shareCopy(x)
     reverseInPlace(x2)
     return x2
 
@@ -323,7 +476,7 @@ def reverseOnsetInPlace(x): # HANDLES ONSETS. Notes must store onsets. Rests may
     #deriveOnsets(x,0) # Might need to do this if rests are involved
 
 def reverseOnset(x):
-    x2 = deepcopy(x)
+    x2 = shareCopy(x)
     reverseOnsetInPlace(x2)
     return x2
 
@@ -341,7 +494,7 @@ def reverseOnsetInPlaceWithin(x, startTime, endTime): # To reverse within a larg
         raise MusEciException("Selection must be a subset of the time span to be reversed.")
 
 def reverseOnsetWithin(x, startTime, endTime):
-    x2 = deepcopy(x)
+    x2 = shareCopy(x)
     reverseOnsetInPlaceWithin(x2, startTime, endTime)
     return x2
 
@@ -349,8 +502,9 @@ def reverseOnsetWithin(x, startTime, endTime):
 def times(music, n): # TO-DO: ONSET HANDLING
     """
     Returns a new value that is n repetitions of the input musical structure.
-    Deep copy is used, so there will be no shared references between the input
-    and the output.
+    The repetitions share structure with the input (see shareCopy), so shared
+    parts are only copied once an in-place operation alters them. Altering the
+    result, or the input, never affects the other.
     :param music: the music structure to repeat
     :param n: how many times to repeat?
     :return: a new structure (so this should be called as a = times(b,n)
@@ -358,7 +512,7 @@ def times(music, n): # TO-DO: ONSET HANDLING
     return Seq([music]*n)
 
 
-def cut(x, amount): # Should not be affected by onset handling
+def cut(x, amount, durs=None): # Should not be affected by onset handling
     """
     Keeps only the first duration amount of a musical structure. The amount
     is in measures at the reference duration, which is 120bpm unless specified
@@ -366,78 +520,92 @@ def cut(x, amount): # Should not be affected by onset handling
     a lot of meaningless structure in place, with leaves occupied by Rest(0).
     :param x: the music value to alter
     :param amount: how many whole notes worth to take.
+    :param durs: durations of subtrees already worked out (see aggregate)
     :return: the furst amount of the music structure by time (whole note = 1.0)
     """
     #if (x.__class__.__name__ == 'Music'):
     #    cut(x.tree, amount)
     #    return x
-    if (x.__class__.__name__ == 'Note' or x.__class__.__name__ == 'Rest'):
+    if durs is None:
+        durs = dict()
+    durs.pop(id(x), None) # x is about to change
+    unshare(x)
+    touch(node=x)
+    kind = nodeKind(x)
+    if kind == NOTE or kind == REST:
         if amount <= x.dur:
             x.dur = amount
         return x
-    elif (x.__class__.__name__ == 'Seq'):
+    elif kind == SEQ:
         dLeft = amount
         newTree = []
         for t in x.trees:
-            newTree.append(cut(t, dLeft))
-            dLeft = max(0,dLeft - dur(t))
+            newTree.append(cut(t, dLeft, durs))
+            dLeft = max(0,dLeft - dur(t, durs))
         x.trees = newTree
         return x
-    elif isinstance(x, Par):
+    elif kind == PAR:
         newTrees = []
         for t in x.trees:
-            newTrees.append(cut(t,amount))
+            newTrees.append(cut(t,amount,durs))
         x.trees = newTrees
         return x
-    elif (x.__class__.__name__ == 'Part'):
+    elif kind == PART or kind == SHIFT:
         #if (x.mod.__class__.__name__ == 'Tempo'):
         #    cut(x.tree, amount*x.mod.value)
         #else:
-        cut(x.tree, amount)
+        cut(x.tree, amount, durs)
         return x
     else: raise MusEciException("Unrecognized musical structure: " + str(x))
 
 
-def remove(x, amount): # TO-DO: ONSET HANDLING (DO WE WANT IT TO NORMALIZE TO STARTING AT ZERO?)
+def remove(x, amount, durs=None): # TO-DO: ONSET HANDLING (DO WE WANT IT TO NORMALIZE TO STARTING AT ZERO?)
     """
     The opposite of "cut," chopping away the first amount. Note that this
     operation is messy - it can leave a lot of meaningless structure in
     place, with leaves occupied by Rest(0).
     :param x: the music structure to alter
     :param amount: how much to cut off of the beginning?
+    :param durs: durations of subtrees already worked out (see aggregate)
     :return:
     """
+    if durs is None:
+        durs = dict()
+    durs.pop(id(x), None) # x is about to change
+    unshare(x)
+    touch(node=x)
+    kind = nodeKind(x)
     if amount<=0:
         return x # nothing to remove!
     #elif (x.__class__.__name__ == 'Music'):
     #    remove(x.tree, amount)
     #    return x
-    elif (x.__class__.__name__ == 'Note' or x.__class__.__name__ == 'Rest'):
+    elif kind == NOTE or kind == REST:
         if amount >= x.dur:
             x.dur = 0
         if amount < x.dur:
             x.dur = x.dur - amount
         return x
-    elif (x.__class__.__name__ == 'Seq'):
+    elif kind == SEQ:
         dLeft = amount
         newTree = []
         for t in x.trees:
-            d = dur(t)
-            newTree.append(remove(t, dLeft))
+            d = dur(t, durs)
+            newTree.append(remove(t, dLeft, durs))
             dLeft = max(0,dLeft - d)
         x.trees = newTree
         return x
-    elif isinstance(x, Par):
+    elif kind == PAR:
         newTrees = []
         for t in x.trees:
-            newTrees.append(remove(t,amount))
+            newTrees.append(remove(t,amount,durs))
         x.trees = newTrees
         return x
-    elif (x.__class__.__name__ == 'Part'):
+    elif kind == PART or kind == SHIFT:
         #if (x.mod.__class__.__name__ == 'Tempo'):
         #    remove(x.tree, amount*x.mod.value)
         #else:
-        remove(x.tree, amount)
+        remove(x.tree, amount, durs)
         return x
     else: raise MusEciException("Unrecognized musical structure: " + str(x))
 
@@ -463,20 +631,29 @@ def mFold(x, noteOp, restOp, seqOp, parOp, modOp): # Onsets can't reasonably be
     """
     #if (x.__class__.__name__ == 'Music'):
     #    return mFold(x.tree, noteOp, restOp, seqOp, parOp, modOp) # todo?: update modOp to something relevant to Part
-    if (x.__class__.__name__ == 'Note'):
-        return noteOp(x)
-    elif (x.__class__.__name__ == 'Rest'):
-        return restOp(x)
-    elif (x.__class__.__name__ == 'Seq'):
-        vals = [mFold(t, noteOp, restOp, seqOp, parOp, modOp) for t in x.trees]
+    return mFoldOffsets(x, noteOp, restOp, seqOp, parOp, modOp, ())
+
+
+def mFoldOffsets(x, noteOp, restOp, seqOp, parOp, modOp, offsets):
+    # mFold for a value inside Shifts with the given offsets: Notes and Rests
+    # inside a Shift are passed as copies with the offset applied to them
+    kind = nodeKind(x)
+    if kind == NOTE:
+        return noteOp(withOffsets(x, offsets))
+    elif kind == REST:
+        return restOp(withOffsets(x, offsets))
+    elif kind == SEQ:
+        vals = [mFoldOffsets(t, noteOp, restOp, seqOp, parOp, modOp, offsets) for t in x.trees]
         return seqOp(vals)
-    elif isinstance(x, Par):
-        vals = [mFold(t, noteOp, restOp, seqOp, parOp, modOp) for t in x.trees]
+    elif kind == PAR:
+        vals = [mFoldOffsets(t, noteOp, restOp, seqOp, parOp, modOp, offsets) for t in x.trees]
         return parOp(vals)
-    elif (x.__class__.__name__ == 'Part'):
-        val = mFold(x.tree, noteOp, restOp, seqOp, parOp, modOp)
+    elif kind == PART:
+        val = mFoldOffsets(x.tree, noteOp, restOp, seqOp, parOp, modOp, offsets)
         #return modOp(x.mod, val)
         return val
+    elif kind == SHIFT:
+        return mFoldOffsets(x.tree, noteOp, restOp, seqOp, parOp, modOp, offsets + (x.offset,))
     else: raise MusEciException("Unrecognized musical structure: " + str(x))
 
 
@@ -489,17 +666,18 @@ def firstPitch(x): # TO-DO: ONSET HANDLING
     """
     #if (x.__class__.__name__ == 'Music'):
     #    return firstPitch(x.tree)
-    if (x.__class__.__name__ == 'Note'):
+    kind = nodeKind(x)
+    if kind == NOTE:
         return x.pitch
-    elif (x.__class__.__name__ == 'Rest'):
+    elif kind == REST:
         return None
-    elif (x.__class__.__name__ == 'Seq' or isinstance(x, Par)):
+    elif kind == SEQ or kind == PAR:
         vals = list(map(firstPitch, x.trees))
         if len(vals) > 0:
             return vals[0]
         else:
             return -1
-    elif (x.__class__.__name__ == 'Part'):
+    elif kind == PART or kind == SHIFT:
         return firstPitch(x.tree)
     else: raise MusEciException("Unrecognized musical structure: " + str(x))
 
@@ -559,7 +737,7 @@ def removeInstruments(x):
     :return:
     """
     def checkInstMod(x): # function to get rid of individual nodes
-        if x.__class__.__name__ == 'Part':
+        if nodeKind(x) == PART:
             #if x.mod.__class__.__name__ == 'Instrument': return x.tree
             #else: return x
             return x.tree
@@ -568,15 +746,18 @@ def removeInstruments(x):
     #    tNew = checkInstMod(x.tree)
      #   removeInstruments(x.tree)
     #    return x
-    if x.__class__.__name__ == 'Note' or x.__class__.__name__ == 'Rest':
+    unshare(x)
+    touch(node=x)
+    kind = nodeKind(x)
+    if kind == NOTE or kind == REST:
         return x
-    elif x.__class__.__name__ == 'Seq' or isinstance(x, Par):
+    elif kind == SEQ or kind == PAR:
         newTrees = []
         for t in x.trees:
             newTrees.append(checkInstMod(x.left))
         x.trees = list(map(removeInstruments, newTrees))
         return x
-    elif x.__class__.__name__ == 'Part':
+    elif kind == PART:
         xNew = checkInstMod(x)
         return xNew
     else: raise MusEciException("Unrecognized musical structure: " + str(x))
@@ -672,42 +853,54 @@ def chordListToMusic(chords, defDur=0.25, defVol=100):
     return line(cList)
 
 
-def removeZeros(x): # MAY NEED TO HANDLE ONSETS IN DURATION CALL
+def removeZeros(x, durs=None): # MAY NEED TO HANDLE ONSETS IN DURATION CALL
     #if (x.__class__.__name__ == 'Music'):
     #    x.tree = removeZeros(x.tree)
     #    return x
-    if (x.__class__.__name__ == 'Note' or x.__class__.__name__ == 'Rest'):
+    if durs is None:
+        durs = dict() # durations of subtrees already worked out (see aggregate)
+    durs.pop(id(x), None) # x is about to change
+    unshare(x)
+    touch(node=x)
+    kind = nodeKind(x)
+    if kind == NOTE or kind == REST:
         return x # can't remove at this stage
-    elif (x.__class__.__name__ == 'Seq' or isinstance(x, Par)):
+    elif kind == SEQ or kind == PAR:
         newTrees = []
         for t in x.trees:
-            t2 = removeZeros(t)
-            if dur(t2) > 0:
+            t2 = removeZeros(t, durs)
+            if dur(t2, durs) > 0:
                 newTrees.append(t2)
         x.trees = newTrees
         return x
-    elif (x.__class__.__name__ == 'Part'):
-        x.tree = removeZeros(x.tree)
+    elif kind == PART or kind == SHIFT:
+        x.tree = removeZeros(x.tree, durs)
         return x
     else:
         raise MusEciException("Unrecognized musical structure: " + str(x))
 
-def removeZerosOnset(x):  # MAY NEED TO HANDLE ONSETS IN DURATION CALL
+def removeZerosOnset(x, spans=None):  # MAY NEED TO HANDLE ONSETS IN DURATION CALL
     #if (x.__class__.__name__ == 'Music'):
     #    x.tree = removeZerosOnset(x.tree)
     #    return x
-    if (x.__class__.__name__ == 'Note' or x.__class__.__name__ == 'Rest'):
+    if spans is None:
+        spans = dict() # onset spans of subtrees already worked out (see aggregate)
+    spans.pop(id(x), None) # x is about to change
+    unshare(x)
+    touch(node=x)
+    kind = nodeKind(x)
+    if kind == NOTE or kind == REST:
         return x  # can't remove at this stage
-    elif (x.__class__.__name__ == 'Seq' or isinstance(x, Par)):
+    elif kind == SEQ or kind == PAR:
         newTrees = []
         for t in x.trees:
-            t2 = removeZerosOnset(t)
-            if durOnset(t2) > 0:
+            t2 = removeZerosOnset(t, spans)
+            if durOnset(t2, spans) > 0:
                 newTrees.append(t2)
         x.trees = newTrees
         return x
-    elif (x.__class__.__name__ == 'Part'):
-        x.tree = removeZerosOnset(x.tree)
+    elif kind == PART or kind == SHIFT:
+        x.tree = removeZerosOnset(x.tree, spans)
         return x
     else:
         raise MusEciException("Unrecognized musical structure: " + str(x))
@@ -769,13 +962,16 @@ def scaleInvert(m, scale):
     ret = scaleInvertAt(m, p, scale)
     return ret
 
-def isNote(x): return x.__class__.__name__ == "Note"
-def isRest(x): return x.__class__.__name__ == "Rest"
+def isNote(x): return nodeKind(x) == NOTE
+def isRest(x): return nodeKind(x) == REST
 
 def stripRests(x):
-    if x.__class__.__name__ == "Part":
+    unshare(x)
+    touch(node=x)
+    kind = nodeKind(x)
+    if kind == PART or kind == SHIFT:
         stripRests(x.tree)
-    elif x.__class__.__name__ == "Seq" or isinstance(x, Par):
+    elif kind == SEQ or kind == PAR:
         for t in x.trees: # recursively strip rests from subtrees
             stripRests(t)
         okTrees = [x for x in x.trees if not (isRest(x))] # remove any rests appearing at this level
@@ -785,9 +981,12 @@ def stripRests(x):
 
 
 def fillRests(x):
-    if x.__class__.__name__ == "Part:":
+    unshare(x)
+    touch(node=x)
+    kind = nodeKind(x)
+    if kind == PART or kind == SHIFT:
         fillRests(x.tree)
-    elif x.__class__.__name__ == "Seq": # Note: we assume a non-empty tree here! Probably need to update later
+    elif kind == SEQ: # Note: we assume a non-empty tree here! Probably need to update later
         newTrees = list()
         currOnset = getOnset(x)
         for t in x.trees:
@@ -795,7 +994,7 @@ def fillRests(x):
             if o > currOnset:
                 newTrees.append(Rest(o - currOnset, currOnset))
             newTrees.append(t)
-    elif isinstance(x, Par):
+    elif kind == PAR:
         for t in x.trees:
             fillRests(t) # Not sure how best to handle this. Do we necessarily want Rests within a Par?
     else:
@@ -821,19 +1020,28 @@ def retMusicOp(op, x):
         return result
 
 def flatten(musicVal): # remove unnecessary Seq and Par intermediate nodes
-    x = deepcopy(musicVal)
-    if x.__class__.__name__ == "Seq" or isinstance(x, Par):
-        newTrees = list()
-        print(len(x.trees))
-        for t in x.trees:
-            newTrees.append(flatten(t))
-        if len(newTrees) == 1:
-            return newTrees[0]
-        else:
-            x.trees = newTrees
-            return x
-    elif x.__class__.__name__ == "Note" or x.__class__.__name__ == "Rest":
-        return x
-    elif x.__class__.__name__ == "Part":
-        x.tree = flatten (x.tree)
-        return x
+    def single(x): # a Seq/Par of one thing is just that thing
+        return (nodeKind(x) == SEQ or nodeKind(x) == PAR) and len(x.trees) == 1
+    result = privateCopy(musicVal) # restructured in place below, so the input is left alone
+    while single(result):
+        result = result.trees[0]
+    seen = set() # nodes shared within the copy (like the motif of a Repeat) are only flattened once
+    stack = [result]
+    while stack:
+        x = stack.pop()
+        kind = nodeKind(x)
+        if id(x) in seen or isLeafKind(kind):
+            continue
+        seen.add(id(x))
+        trees = x.trees if (kind == SEQ or kind == PAR) else [x.tree]
+        for j in range(len(trees)):
+            t = trees[j]
+            while single(t):
+                if borrows(x, t):
+                    borrow(x, t.trees)
+                t = t.trees[0]
+            trees[j] = t
+            stack.append(t)
+        if kind == PART or kind == SHIFT:
+            x.tree = trees[0]
+    return result
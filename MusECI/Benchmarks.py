@@ -0,0 +1,680 @@
+# Performance and memory benchmarks for MusECI.
+# Run from the repository root with: python -m MusECI.Benchmarks
+
+import time
+import tracemalloc
+from MusECI.MusEciDataStructures import *
+from MusECI.MEvent import MEvent, musicToMEvents, iterMEvents
+from MusECI.MidiConversion import MEventMidi, ON, OFF
+
+
+def timeIt(f, *args, repeat=3):
+    '''
+    Run f(*args) several times and return the best wall-clock time in seconds.
+    :param f:
+    :param args:
+    :param repeat:
+    :return:
+    '''
+    best = None
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        f(*args)
+        t = time.perf_counter() - t0
+        if best is None or t < best:
+            best = t
+    return best
+
+
+def bytesPerItem(makeFun, n):
+    '''
+    Measure the average number of bytes allocated per object when building
+    a list of n objects with makeFun(i).
+    :param makeFun: function from an index to a new object
+    :param n: number of objects to build
+    :return: bytes per object (including the list slot holding it)
+    '''
+    tracemalloc.start()
+    vals = [makeFun(i) for i in range(n)]
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del vals
+    return current / n
+
+
+# =================================================================
+# LEAF MEMORY
+# The "Dict" classes below mirror the older __dict__-based layout of
+# the leaf classes so that both layouts can be measured side by side.
+# =================================================================
+
+class DictNote:
+    def __init__(self, pitch, dur=0.25, onset=None, vol=100, params=None):
+        self.pitch = pitch
+        self.dur = dur
+        self.vol = vol
+        self.onset = onset
+        self.params = params
+
+
+class DictMEvent:
+    def __init__(self, eTime, pitch, dur, vol=100, patch=(-1, INST)):
+        self.eTime = eTime
+        self.pitch = pitch
+        self.dur = dur
+        self.vol = vol
+        self.patch = patch
+
+
+class DictMEventMidi:
+    def __init__(self, eTime, eType, pitch, vol=100, patch=-1):
+        self.eTime = eTime
+        self.eType = eType
+        self.pitch = pitch
+        self.vol = vol
+        self.patch = patch
+
+
+def benchLeafMemory(n=1000000):
+    '''
+    Bytes per leaf object for the old (__dict__) and current (__slots__) layouts.
+    Onsets are shared across objects so that only the objects themselves are counted.
+    '''
+    patch = (0, INST)
+    cases = [("Note", lambda i: DictNote(60, QN, 0.0), lambda i: Note(60, QN, 0.0)),
+             ("MEvent", lambda i: DictMEvent(0.0, 60, QN, 100, patch), lambda i: MEvent(0.0, 60, QN, 100, patch)),
+             ("MEventMidi", lambda i: DictMEventMidi(0.0, ON, 60), lambda i: MEventMidi(0.0, ON, 60))]
+    for name, before, after in cases:
+        b = bytesPerItem(before, n)
+        a = bytesPerItem(after, n)
+        print("{0:12s} before: {1:6.1f} B/item   after: {2:6.1f} B/item   ratio: {3:.2f}x".format(name, b, a, b / a))
+
+
+# =================================================================
+# NODE DISPATCH
+# Compares the older class-name comparison chain used by the traversals
+# against dispatching on nodeKind.
+# =================================================================
+
+def nameDispatch(x):
+    if (x.__class__.__name__ == 'Music'):
+        return 0
+    elif (x.__class__.__name__ == 'Note' or x.__class__.__name__ == 'Rest'):
+        return 1
+    elif (x.__class__.__name__ == 'Seq' or isinstance(x, Par)):
+        return 2
+    elif (x.__class__.__name__ == 'Part'):
+        return 3
+    return -1
+
+
+def noDispatch(x):
+    return 1
+
+
+def kindDispatch(x):
+    kind = nodeKind(x)
+    if kind == NOTE or kind == REST:
+        return 1
+    elif kind == SEQ or kind == PAR:
+        return 2
+    elif kind == PART:
+        return 3
+    return -1
+
+
+def benchDispatch(n=1000000):
+    """
+    Per-node cost of deciding what kind of node is being visited, for a mix of
+    node types resembling a typical score (mostly Notes and Rests).
+    """
+    sample = [Note(60), Note(62), Rest(), Note(64), Seq([]), Chord([]), Part(Rest()), Note(65)]
+    nodes = (sample * (n // len(sample) + 1))[:n]
+    def run(f):
+        for x in nodes:
+            f(x)
+    tBase = timeIt(run, noDispatch)   # loop and call overhead, subtracted below
+    tName = timeIt(run, nameDispatch) - tBase
+    tKind = timeIt(run, kindDispatch) - tBase
+    print("dispatch     by name: {0:6.1f} ns/node   by kind: {1:6.1f} ns/node".format(tName * 1e9 / n, tKind * 1e9 / n))
+
+
+# =================================================================
+# EVENT CONVERSION
+# =================================================================
+
+def makeScore(n, parts=4, phrase=16):
+    '''
+    Build a score of roughly n notes: a Music value with several Parts, each a
+    Seq of phrases, where each phrase is a Seq of Notes.
+    :param n:
+    :param parts:
+    :param phrase:
+    :return:
+    '''
+    perPart = n // parts
+    trees = []
+    for p in range(parts):
+        phrases = []
+        for start in range(0, perPart, phrase):
+            notes = [Note(48 + (start + i) % 24, EN) for i in range(min(phrase, perPart - start))]
+            phrases.append(Seq(notes, inPlace=True))
+        trees.append(Part(Seq(phrases, inPlace=True), Instrument(p)))
+    return Music(trees, inPlace=True)
+
+
+def deepScore(depth):
+    '''
+    Build a right-nested Seq of the given depth (one Note per level).
+    '''
+    x = Note(60, SN)
+    for i in range(depth):
+        x = Seq([Note(60 + i % 12, SN), x], inPlace=True)
+    return x
+
+
+def benchMusicToMEvents(n=100000):
+    """
+    Time to convert a wide score and a deep (right-nested) score to MEvents.
+    """
+    wide = makeScore(n)
+    deep = deepScore(n)
+    tWide = timeIt(musicToMEvents, wide)
+    tDeep = timeIt(musicToMEvents, deep)
+    print("musicToMEvents  wide: {0:6.3f} s   deep: {1:6.3f} s   ({2} notes)".format(tWide, tDeep, n))
+
+
+def benchFirstEvent(n=100000):
+    """
+    Time until the first event is available, and peak memory for going through
+    all events, with musicToMEvents and with the lazy iterMEvents.
+    """
+    wide = makeScore(n)
+    def consume(mevs):
+        for e in mevs:
+            pass
+    tList = timeIt(lambda: musicToMEvents(wide)[0])
+    tIter = timeIt(lambda: next(iterMEvents(wide)))
+    print("first event  list: {0:6.3f} s   lazy: {1:6.3f} s   ({2} notes)".format(tList, tIter, n))
+    for name, f in [("list", musicToMEvents), ("lazy", iterMEvents)]:
+        tracemalloc.start()
+        consume(f(wide))
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("all events   {0}: peak {1:8.1f} KB".format(name, peak / 1024))
+
+
+# =================================================================
+# AGGREGATES
+# =================================================================
+
+def leftDeepScore(depth):
+    '''
+    Build a left-nested Seq: Seq([Seq([Seq([..., n3]), n2]), n1]). Without
+    remembering durations, deriveOnsets re-walks the whole left spine at every
+    level.
+    '''
+    x = Note(60, SN)
+    for i in range(depth):
+        x = Seq([x, Note(60 + i % 12, SN)], inPlace=True)
+    return x
+
+
+def benchAggregates(n=5000):
+    """
+    Time for dur with and without a memo that already holds the answer, and for
+    deriveOnsets on left-nested scores of increasing depth (which should grow
+    linearly).
+    """
+    from MusECI.BasicOperations import dur, deriveOnsets, removeOnsets
+    x = leftDeepScore(n)
+    memo = dict()
+    dur(x, memo)
+    tDur = timeIt(dur, x)
+    tDurMemo = timeIt(dur, x, memo)
+    print("dur          fresh: {0:8.5f} s   memo: {1:8.5f} s   ({2} levels)".format(tDur, tDurMemo, n))
+    for depth in [n, 2 * n, 4 * n]:
+        y = leftDeepScore(depth)
+        def derive():
+            removeOnsets(y)
+            deriveOnsets(y)
+        print("deriveOnsets {0:8.5f} s   ({1} levels, left-nested)".format(timeIt(derive), depth))
+
+
+def retainedBytes(makeFun):
+    """
+    Bytes still allocated after building a value with makeFun().
+    """
+    tracemalloc.start()
+    val = makeFun()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del val
+    return current
+
+
+def benchRepeatMemory(bars=64, times=100):
+    """
+    Memory for a loop of bars bars repeated times times: deep copies with
+    shifted onsets (the old Repeat), Repeat with Shifts, and the deep copies
+    after hashCons.
+    """
+    from copy import deepcopy
+    from MusECI.BasicOperations import deriveOnsets, durOnset, shiftOnsets, removeOnsets
+    from MusECI.MusEciOperations import Repeat
+    motif = Seq([Seq([Note(60 + (i * 7 + j) % 24, EN) for j in range(8)], inPlace=True) for i in range(bars)],
+                inPlace=True)
+    deriveOnsets(motif)
+    def copies():
+        ms = list()
+        offset = 0
+        d = durOnset(motif)
+        for i in range(times):
+            y = deepcopy(motif)
+            shiftOnsets(y, offset)
+            ms.append(y)
+            offset += d
+        return Seq(ms, inPlace=True)
+    def hashConsed(): # hashCons can only share bars with equal onsets, so these have none
+        return hashCons(Seq([deepcopy(plain) for i in range(times)], inPlace=True))
+    plain = deepcopy(motif)
+    removeOnsets(plain)
+    print("Repeat: {0} bars x {1}".format(bars, times))
+    print("  deep copies  {0:10d} bytes".format(retainedBytes(copies)))
+    print("  Shift        {0:10d} bytes".format(retainedBytes(lambda: Repeat(times).apply(motif))))
+    print("  hashCons     {0:10d} bytes".format(retainedBytes(hashConsed)))
+
+
+# =================================================================
+# MIDI CONVERSION
+# =================================================================
+
+def makeMEvents(n, patches=8):
+    '''
+    Build n MEvents in time order spread over several patches, with some
+    notes starting together and some ending together.
+    '''
+    return [MEvent((i // 3) * SN, 40 + i % 48, [SN, EN, QN][i % 3], 100, (i % patches, False)) for i in range(n)]
+
+
+def oldSplitByPatch(mevs, pList):
+    # splitByPatch as it used to be, for comparison
+    evsByPatch = []
+    unsorted = mevs
+    for p in pList:
+        pEvs = [x for x in unsorted if x.patch == p]
+        evsByPatch.append(pEvs)
+        unsorted = [x for x in unsorted if x not in pEvs]
+    return evsByPatch
+
+
+def oldMEventsToOnOff(mevs):
+    # mEventsToOnOff as it used to be, for comparison
+    onOffs = []
+    for e in mevs:
+        onOffs = onOffs + [MEventMidi(e.eTime, ON, e.pitch, e.vol, e.patch),
+                           MEventMidi(e.eTime+e.dur, OFF, e.pitch, e.vol, e.patch)]
+    return sorted(onOffs, key=lambda e: e.eTime)
+
+
+def benchSplitOnOff(sizes=(10000, 100000, 1000000), oldLimit=10000):
+    """
+    Time for splitByPatch and mEventsToOnOff on event lists of several sizes.
+    The old (quadratic) versions are only timed up to oldLimit events, and
+    their results are checked against the new ones.
+    """
+    from MusECI.MidiConversion import splitByPatch, mEventsToOnOff, eventPatchList
+    def fields(onOffs):
+        return [(e.eTime, e.eType, e.pitch, e.patch) for e in onOffs]
+    for n in sizes:
+        mevs = makeMEvents(n)
+        pList = eventPatchList(mevs)
+        tSplit = timeIt(splitByPatch, mevs, pList, repeat=1)
+        tOnOff = timeIt(mEventsToOnOff, mevs, repeat=1)
+        line = "splitByPatch {0:7.3f} s   mEventsToOnOff {1:7.3f} s".format(tSplit, tOnOff)
+        if n <= oldLimit:
+            assert splitByPatch(mevs, pList) == oldSplitByPatch(mevs, pList)
+            assert fields(mEventsToOnOff(mevs)) == fields(oldMEventsToOnOff(mevs))
+            tOldSplit = timeIt(oldSplitByPatch, mevs, pList, repeat=1)
+            tOldOnOff = timeIt(oldMEventsToOnOff, mevs, repeat=1)
+            line = line + "   (old: {0:7.3f} s, {1:7.3f} s)".format(tOldSplit, tOldOnOff)
+        print(line + "   ({0} events)".format(n))
+
+
+def benchRunningStatus(files=50, notes=4000):
+    """
+    Total size of a corpus of generated MIDI files with and without running
+    status, and the time taken to write them.
+    """
+    import random
+    from MusECI.MidiConversion import mEventsToPattern
+    from MusECI.MidiWriter import makeFile
+    rand = random.Random(0)
+    patterns = []
+    for i in range(files):
+        parts = rand.randint(1, 6)
+        score = makeScore(notes, parts=parts, phrase=rand.choice([4, 8, 16]))
+        patterns.append(mEventsToPattern(musicToMEvents(score)))
+    for runningStatus in [False, True]:
+        t0 = time.perf_counter()
+        total = sum([len(makeFile(p, runningStatus)) for p in patterns])
+        t = time.perf_counter() - t0
+        print("running status {0!s:5}: {1:9d} bytes in {2} files ({3:.3f} s)".format(runningStatus, total, files, t))
+
+def benchMusicToBytes(n=100000):
+    """
+    Notes per second written to MIDI bytes through the pattern classes
+    (mEventsToPattern, then makeFile) and with the direct writer.
+    """
+    from MusECI.MidiConversion import mEventsToPattern
+    from MusECI.MidiWriter import makeFile, musicToBytes
+    score = makeScore(n)
+    tPattern = timeIt(lambda: makeFile(mEventsToPattern(musicToMEvents(score))), repeat=1)
+    tDirect = timeIt(musicToBytes, score, repeat=1)
+    print("music to bytes  pattern: {0:9.0f} notes/s   direct: {1:9.0f} notes/s   ({2} notes)".format(
+        n / tPattern, n / tDirect, n))
+
+def benchBatchExport(files=200, notes=2000):
+    """
+    Files per second written by exportBatch in this process and with process
+    pools of increasing size (up to the number of CPUs).
+    """
+    import os
+    import shutil
+    import tempfile
+    from MusECI.MidiWriter import exportBatch
+    scores = [makeScore(notes, parts=1 + i % 4) for i in range(files)]
+    folder = tempfile.mkdtemp()
+    try:
+        counts = [0, 1]
+        while counts[-1] * 2 <= (os.cpu_count() or 1):
+            counts.append(counts[-1] * 2)
+        for workers in counts:
+            items = [(os.path.join(folder, str(i) + ".mid"), scores[i]) for i in range(files)]
+            t = timeIt(lambda: exportBatch(items, workers=workers), repeat=1)
+            print("exportBatch  {0} workers: {1:8.1f} files/s   ({2} files of {3} notes, {4} CPUs)".format(
+                workers, files / t, files, notes, os.cpu_count()))
+    finally:
+        shutil.rmtree(folder)
+
+
+def benchChannelSharing(sizes=(10000, 100000, 1000000), instruments=200):
+    """
+    Time taken to assign channels when there are more instruments than MIDI
+    channels, with eight voices changing instrument every 64 notes. The time
+    per event should only grow slowly (O(n log n) in all).
+    """
+    from MusECI.MidiConversion import channelTracks
+    for n in sizes:
+        mevs = [MEvent((i // 3) * SN, 40 + i % 48, [SN, EN, QN][i % 3], 100,
+                       (((i // 512) * 8 + i % 8) % instruments, False)) for i in range(n)]
+        t = timeIt(channelTracks, mevs, repeat=1)
+        programs = sum([len(p) for (c, p, evs) in channelTracks(mevs)])
+        print("channel sharing: {0:8d} events  {1:7.3f} s  {2:5.2f} us/event  ({3} program changes)".format(
+            n, t, t / n * 1e6, programs))
+
+
+def benchConductorCache(variations=200, changes=2000):
+    """
+    Time spent on conductor tracks when exporting variations of one piece that
+    share a tempo map, with the encoded track cached and with it encoded anew
+    each time.
+    """
+    import MusECI.MidiWriter as mw
+    meta = [Tempo(100 + i % 40, onset=i * QN) for i in range(changes)] + [TimeSig(3, 4), KeySig(2)]
+    metas = [list(meta) for i in range(variations)] # equal lists, but not the same list
+    def uncached():
+        for m in metas:
+            mw.conductorCache.clear()
+            mw.conductorTrack(m)
+    def cached():
+        for m in metas:
+            mw.conductorTrack(m)
+    tUncached = timeIt(uncached, repeat=1)
+    tCached = timeIt(cached, repeat=1)
+    print("conductor track  encoded each time: {0:6.3f} s   cached: {1:6.3f} s   ({2} variations, {3} tempo changes)".format(
+        tUncached, tCached, variations, changes))
+
+
+def benchTrackCache(parts=16, notes=2000, edits=10):
+    """
+    Re-exporting a score part by part after editing one part, in place and by
+    replacing it, with a TrackCache, against exporting it from scratch.
+    """
+    import io
+    import MusECI.MidiWriter as mw
+    from MusECI.BasicOperations import line, transpose
+    score = Music([Part(line([Note(40 + (i * 3 + p) % 40, [SN, EN, QN][i % 3]) for i in range(notes)]), Instrument(p, p == 9))
+                   for p in range(parts)], [Tempo(100)]) # (at most 15 parts besides percussion can play at once)
+    cache = mw.TrackCache()
+    def export(c):
+        mw.musicToMidi(io.BytesIO(), score, True, cache=c)
+    def full():
+        for i in range(edits):
+            export(None)
+    def inPlace():
+        for i in range(edits):
+            transpose(score.trees[i % parts], 1)
+            export(cache)
+    def replace():
+        for i in range(edits):
+            score.trees[i % parts] = Part(line([Note(60 + i, EN)] * notes), Instrument(i % parts, i % parts == 9))
+            export(cache)
+    def unchanged():
+        for i in range(edits):
+            export(cache)
+    export(cache)
+    tFull = timeIt(full, repeat=1)
+    tInPlace = timeIt(inPlace, repeat=1)
+    tReplace = timeIt(replace, repeat=1)
+    tUnchanged = timeIt(unchanged, repeat=1)
+    print("part tracks ({0} parts of {1} notes, {2} exports)  from scratch: {3:6.3f} s   cached, one part edited in place: "
+          "{4:6.3f} s   one part replaced: {5:6.3f} s   nothing changed: {6:6.4f} s".format(
+        parts, notes, edits, tFull, tInPlace, tReplace, tUnchanged))
+
+
+def oldTrackToMEvents(track, ticksPerBeat=96):
+    # MidiReader.trackToMEvents as it used to be (one scan of the rest of the track per note), for comparison
+    import MusECI.MidiReader as mr
+    currTicks = 0
+    channel = mr.getChannel(track)
+    mevs = []
+    for i in range(0, len(track)):
+        e = track[i]
+        currTicks = currTicks + e.time
+        if e.type == "note_on" and e.velocity > 0:
+            noteDur = mr.findNoteDuration(e.note, track[(i + 1):])
+            mevs.append(MEvent(mr.tickToDur(currTicks, ticksPerBeat), e.note, mr.tickToDur(noteDur, ticksPerBeat),
+                               e.velocity, patch=mr.toPatch(channel, -1)))
+    return mevs
+
+
+def pianoTrack(notes):
+    """
+    A dense piano-style track: four-note chords every eighth note, each held
+    for a half note, so about sixteen notes sound at once.
+    """
+    from mido import Message, MetaMessage
+    ons = []
+    for i in range(notes):
+        start = (i // 4) * 48
+        pitch = 36 + (i * 7 + (i // 4) * 5) % 60
+        ons.append((start, 1, pitch))
+        ons.append((start + 192, 0, pitch))
+    ons.sort()
+    track = []
+    last = 0
+    for (t, on, pitch) in ons:
+        track.append(Message('note_on' if on else 'note_off', note=pitch, velocity=80 if on else 0, time=t - last))
+        last = t
+    track.append(MetaMessage('end_of_track', time=0))
+    return track
+
+
+def benchReadTrack(sizes=(10000, 100000), oldLimit=10000):
+    """
+    Time for MidiReader.trackToMEvents on dense tracks of several sizes. The
+    old version is only timed up to oldLimit notes, and its results are
+    checked against the new one.
+    """
+    import MusECI.MidiReader as mr
+    def fields(mevs):
+        return [(e.eTime, e.pitch, e.dur, e.vol) for e in mevs]
+    for n in sizes:
+        track = pianoTrack(n)
+        t = timeIt(mr.trackToMEvents, track, repeat=1)
+        line = "trackToMEvents {0:7.3f} s".format(t)
+        if n <= oldLimit:
+            assert fields(mr.trackToMEvents(track)) == fields(oldTrackToMEvents(track))
+            line = line + "   (old: {0:7.3f} s)".format(timeIt(oldTrackToMEvents, track, repeat=1))
+        print(line + "   ({0} notes)".format(n))
+
+
+def benchMidiParse(n=100000, runningStatus=True):
+    """
+    Events per second parsed from the same MIDI bytes by mido and by midi.py,
+    alone and followed by pairing up the notes into MEvents (MidiReader).
+    """
+    import io
+    import mido
+    import MusECI.midi as midi
+    import MusECI.MidiReader as mr
+    from MusECI.MidiWriter import musicToBytes
+    data = musicToBytes(makeScore(n), runningStatus)
+    events = 2 * n
+    def parseMidiPy():
+        m = midi.MidiFile()
+        m.readstr(data)
+        return m
+    def readMido():
+        m = mido.MidiFile(file=io.BytesIO(data))
+        return [mr.trackToMEvents(t, m.ticks_per_beat) for t in m.tracks]
+    def readMidiPy():
+        m = parseMidiPy()
+        return [mr.midiTrackToMEvents(t, m.ticksPerQuarterNote) for t in m.tracks]
+    tMido = timeIt(lambda: mido.MidiFile(file=io.BytesIO(data)), repeat=1)
+    tMidiPy = timeIt(parseMidiPy, repeat=1)
+    tReadMido = timeIt(readMido, repeat=1)
+    tReadMidiPy = timeIt(readMidiPy, repeat=1)
+    print("parse MIDI  mido: {0:9.0f} events/s   midi.py: {1:9.0f} events/s   with MEvents  mido: {2:9.0f} events/s   "
+          "midi.py: {3:9.0f} events/s   ({4} events)".format(events / tMido, events / tMidiPy, events / tReadMido,
+                                                           events / tReadMidiPy, events))
+
+
+def benchMidiArchive(files=2000, notes=100):
+    """
+    Reading a corpus of small MIDI files: one file each with mido and with
+    midi.py, and all in one memory-mapped archive (MidiReader.MidiArchive).
+    Also the time and traced memory to open the archive with a saved index
+    and read a single song from it.
+    """
+    import os
+    import random
+    import shutil
+    import tempfile
+    import mido
+    import MusECI.midi as midi
+    import MusECI.MidiReader as mr
+    from MusECI.MidiWriter import musicToBytes
+    songs = [musicToBytes(makeScore(notes + i % 50, parts=2)) for i in range(files)]
+    folder = tempfile.mkdtemp()
+    try:
+        names = []
+        for i, data in enumerate(songs):
+            names.append(os.path.join(folder, str(i) + ".mid"))
+            with open(names[-1], 'wb') as f:
+                f.write(data)
+        archiveName = os.path.join(folder, "corpus.bin")
+        with open(archiveName, 'wb') as f:
+            f.write(b"".join(songs))
+        def readMido():
+            for name in names:
+                mido.MidiFile(name)
+        def readMidiPy():
+            for name in names:
+                m = midi.MidiFile()
+                m.open(name)
+                m.read()
+                m.close()
+        def readArchive():
+            with mr.MidiArchive(archiveName) as archive:
+                for i in range(len(archive)):
+                    archive.readMidi(i)
+        tMido = timeIt(readMido, repeat=1)
+        tMidiPy = timeIt(readMidiPy, repeat=1)
+        tArchive = timeIt(readArchive, repeat=1)
+        with mr.MidiArchive(archiveName) as archive:
+            index = archive.index
+        which = random.Random(0).randrange(files)
+        def readOne():
+            with mr.MidiArchive(archiveName, index) as archive:
+                archive.readMidi(which)
+        tOne = timeIt(readOne)
+        tracemalloc.start()
+        readOne()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print("read {0} files  mido: {1:6.3f} s   midi.py: {2:6.3f} s   archive: {3:6.3f} s   one song from the archive: "
+              "{4:7.5f} s, {5} bytes traced ({6} byte archive)".format(files, tMido, tMidiPy, tArchive, tOne, peak,
+                                                                     os.path.getsize(archiveName)))
+    finally:
+        shutil.rmtree(folder)
+
+
+def benchIngestCorpus(files=2000, notes=100, workers=None):
+    """
+    Files per second read by MidiReader.ingestCorpus in this process and with
+    a pool of processes (one per CPU by default), the traced memory of this
+    process while results are streamed and dropped, and the pickled size of a
+    file's result against its Music tree.
+    """
+    import os
+    import pickle
+    import shutil
+    import tempfile
+    import MusECI.MidiReader as mr
+    from MusECI.MidiWriter import musicToBytes
+    if workers is None:
+        workers = os.cpu_count() or 1
+    folder = tempfile.mkdtemp()
+    try:
+        for i in range(files):
+            with open(os.path.join(folder, "%05d.mid" % i), 'wb') as f:
+                f.write(musicToBytes(makeScore(notes + i % 50, parts=2)))
+        def ingest(w):
+            for r in mr.ingestCorpus(mr.corpusFiles(folder), workers=w):
+                pass
+        tSerial = timeIt(ingest, 0, repeat=1)
+        tPool = timeIt(ingest, workers, repeat=1)
+        tracemalloc.start() # (separately: tracing slows down unpickling the results a lot)
+        ingest(workers)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        first = next(mr.corpusFiles(folder))
+        compactSize = len(pickle.dumps(next(mr.ingestCorpus([first], workers=0))[1]))
+        musicSize = len(pickle.dumps(mr.midiToMusic(first, useMido=False)))
+        print("ingest {0} files  in process: {1:6.0f} files/s   {2} workers: {3:6.0f} files/s   peak traced: {4} bytes   "
+              "one result pickled: {5} bytes (Music: {6} bytes)".format(files, files / tSerial, workers, files / tPool,
+                                                                       peak, compactSize, musicSize))
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    benchLeafMemory()
+    benchDispatch()
+    benchMusicToMEvents()
+    benchFirstEvent()
+    benchAggregates()
+    benchRepeatMemory()
+    benchSplitOnOff()
+    benchRunningStatus()
+    benchMusicToBytes()
+    benchBatchExport()
+    benchChannelSharing()
+    benchConductorCache()
+    benchTrackCache()
+    benchReadTrack()
+    benchMidiParse()
+    benchMidiArchive()
+    benchIngestCorpus()
@@ -0,0 +1,84 @@
+# Testing exact (Fraction-based) time.
+# Run from the repository root with: python -m MusECI.ExactTimeTests
+
+import io
+import os
+import tempfile
+from fractions import Fraction
+from MusECI.MusEciDataStructures import *
+from MusECI.BasicOperations import deriveOnsets, dur, line, getOnsets
+from MusECI.MidiWriter import musicToMidi
+import MusECI.MidiWriter as mw
+import MusECI.MidiConversion as mc
+import MusECI.MEvent as me
+import MusECI.MidiReader as mr
+import MusECI.FromMidi2 as fm
+from mido import MidiFile
+
+
+def triplets(n):
+    return line([Note(60 + i % 7, EN * 2 / 3) for i in range(n)])
+
+
+# Floats drift: 3000 float triplet eighths don't add up to 250 whole notes
+x = triplets(3000)
+deriveOnsets(x)
+print("Float time: dur = " + str(dur(x)))
+
+setExactTime(True)
+try:
+    assert Note(60, QN).dur == Fraction(1, 4)
+    assert Note(60, 0.1).dur == Fraction(1, 10)
+    assert Rest(EN * 2 / 3).dur == Fraction(1, 12)
+    assert Note(60, QN, MetricalValue(0, 1)).onset.__class__ == MetricalValue
+    x = triplets(3000)
+    deriveOnsets(x)
+    assert dur(x) == 250
+    assert getOnsets(x)[-1] == Fraction(2999, 12)
+    print("Exact time: dur = " + str(dur(x)) + ": ok")
+
+    # MEvents stay exact, and onsets can be grouped with a dictionary
+    mevs = me.musicToMEvents(Par([x, triplets(3000)]))
+    assert all([isinstance(e.eTime, Fraction) for e in mevs])
+    chords = fm.chunkByChords(fm.initChunk(mevs))
+    assert len(chords) == 3000 and all([c.kind == "Chord" for c in chords])
+    print("Grouping by onset: ok")
+
+    # Round trip through MIDI gives back exactly the same times
+    x = triplets(48)
+    fd, path = tempfile.mkstemp(suffix=".mid")
+    os.close(fd)
+    try:
+        musicToMidi(path, x, partTracks=False)
+        y = mr.midiToMusic(path)
+    finally:
+        os.remove(path)
+    before = [(e.eTime, e.pitch, e.dur) for e in me.musicToMEvents(x)]
+    after = [(e.eTime, e.pitch, e.dur) for e in me.musicToMEvents(y)]
+    assert sorted(before) == sorted(after)
+    print("MIDI round trip: ok")
+
+    # A coarser grid for reading floats
+    setExactTime(True, ppq=4)
+    assert Note(60, 0.1).dur == Fraction(1, 10)
+    assert Note(60, 0.33).dur == Fraction(1, 3)
+
+    # ...which doesn't change the resolution of MIDI files
+    setExactTime(True, ppq=480)
+    x = line([Note(60, Fraction(1, 1920)), Note(62, QN)])
+    assert mw.musicToBytes(x) == mw.musicToBytes(x, resolution=mc.RESOLUTION)
+    assert MidiFile(file=io.BytesIO(mw.musicToBytes(x))).ticks_per_beat == mc.RESOLUTION
+    fd, path = tempfile.mkstemp(suffix=".mid")
+    os.close(fd)
+    try:
+        with open(path, 'wb') as f:
+            f.write(mw.musicToBytes(x, resolution=480))
+        y = mr.midiToMusic(path)
+    finally:
+        os.remove(path)
+    assert [e.eTime for e in me.musicToMEvents(y)] == [0, Fraction(1, 1920)]
+    print("PPQ setting: ok")
+finally:
+    setExactTime(False)
+
+assert isinstance(Note(60, QN).dur, float)
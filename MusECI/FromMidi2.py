@@ -92,7 +92,22 @@ def chunkByFun(chunks, f):
     return fChunks
 
 def chunkByChords(chunks0):
-    return chunkByFun(chunks0, extractChord)
+    '''
+    Group Chunks with identical onsets and durations into chords. This gives the
+    same result as chunkByFun(chunks0, extractChord), but looks the groups up in
+    a dictionary instead of comparing every pair of chunks. Grouping relies on
+    exact equality, so it works best with exact time (see setExactTime).
+    :param chunks0:
+    :return: Chord Chunks (and lone Chunks) in order of first appearance
+    '''
+    groups = dict() # (onset, dur) -> list of Chunks
+    for c in chunks0:
+        key = (c.onset, c.dur)
+        if key in groups:
+            groups[key].append(c)
+        else:
+            groups[key] = [c]
+    return [Chunk("Chord", g) if len(g) > 1 else g[0] for g in groups.values()]
 
 def chunkByMel(chunks0):
     return chunkByFun(chunks0, extractMel)
@@ -133,8 +148,8 @@ def restructure(inMusic, preserveTracks = True):
         parts.append(em)
     return Music(parts, 120)
 
-def midiToMusic2(filename, flatten=False, preserveTracks = True):
-    m = midiToMusic(filename)
+def midiToMusic2(filename, flatten=False, preserveTracks = True, useMido = True):
+    m = midiToMusic(filename, True, useMido)
     m2 = None
     if preserveTracks:
         newTrees = list()
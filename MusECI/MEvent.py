@@ -1,5 +1,7 @@
-from copy import deepcopy
-from MusECI.MusEciDataStructures import INST, Par, Music, Part
+from heapq import heappush, heappop
+from itertools import count
+from MusECI.MusEciDataStructures import INST, Par, Music, Part, MetricalValue, nodeKind, NOTE, REST, SEQ, PAR, PART, touch, \
+    TimeMode, toTime, SHIFT, applyOffsets, detach, privateCopy
 from MusECI.BasicOperations import dur, mMap
 
 # =================================================================
@@ -18,7 +20,7 @@ def applyTempo(x, tempo=1.0):
     :param tempo:
     :return:
     """
-    y = deepcopy(x)
+    y = privateCopy(x)
     y = applyTempoInPlace(y, tempo)
     return y
 
@@ -31,7 +33,10 @@ def applyTempoInPlace(x, tempo=1.0):
     :param tempo:
     :return:
     """
-    if (x.__class__.__name__ == 'Music'):
+    detach(x)
+    touch(node=x)
+    kind = nodeKind(x)
+    if isinstance(x, Music):
         #x.tree = applyTempo(x.tree, 120/x.bpm)
         #return x
         newTrees = []
@@ -40,24 +45,28 @@ def applyTempoInPlace(x, tempo=1.0):
         x.trees = newTrees
         x.bpm = 120
         return x
-    elif (x.__class__.__name__ == 'Note' or x.__class__.__name__ == 'Rest'):
+    elif kind == NOTE or kind == REST:
         x.dur = x.dur / tempo
         if not(x.onset is None):
             x.onset = x.onset / tempo
         return x
-    elif (x.__class__.__name__ == 'Par' or x.__class__.__name__ == 'Seq'):
+    elif kind == PAR or kind == SEQ:
         newTrees = []
         for t in x.trees:
             newTrees.append(applyTempo(t))
         x.trees = newTrees
         return x
-    elif (x.__class__.__name__ == 'Part'): # formerly Modify
+    elif kind == PART: # formerly Modify
         #if (x.mod.__class__.__name__ == 'Tempo'):
         #    x.tree = applyTempo(x.tree, x.mod.value)
         #    return x.tree
         #else:
         x.tree = applyTempo(x.tree, tempo)
         return x
+    elif kind == SHIFT:
+        x.tree = applyTempo(x.tree, tempo)
+        x.offset = x.offset / tempo
+        return x
     else:
         raise Exception("Unrecognized musical structure: "+str(x))
 
@@ -70,7 +79,12 @@ class MEvent:
     128bpm. The patch field should be a patch number, like the patch field of
     the Instrument class.
     """
+    __slots__ = ('eTime', 'pitch', 'dur', 'vol', 'patch')
+
     def __init__(self, eTime, pitch, dur, vol=100, patch=(-1, INST)):
+        if TimeMode.exact:
+            eTime = toTime(eTime)
+            dur = toTime(dur)
         self.eTime = eTime
         self.pitch = pitch
         self.dur = dur
@@ -84,58 +98,232 @@ class MEvent:
         return str(self)
 
 
+def midiLeaf(x, meta=None):
+    """
+    Get a MIDI-compatible version of a Note or Rest without altering it. The
+    leaf itself is returned if it is already compatible (the usual case);
+    otherwise a converted copy is returned.
+    :param x: a Note or Rest
+    :param meta: meta information used to interpret MetricalValues
+    :return:
+    """
+    if isinstance(x.dur, MetricalValue) or isinstance(x.onset, MetricalValue) or \
+            (nodeKind(x) == NOTE and not isinstance(x.pitch, int)):
+        x = privateCopy(x)
+        x.forceMIDICompatible(meta)
+    return x
+
+
 def musicToMEvents(musicVal, currentTime=0, currentInstrument=(-1,INST)): # TO-DO: finish onset handling
     """
     The musicToMEvents function converts a tree of Notes and Rests into an
-    event structure.
+    event structure. The input is not altered. The tree is walked once with an
+    explicit stack: each subtree reports its duration when it is finished, which
+    gives the start time of the next tree in a Seq. Events are collected in tree
+    order and sorted once at the end; since the sort is stable, events with the
+    same onset stay in tree order.
     :param x:
     :param currentTime:
     :param currentInstrument:
     :return:
     """
-    x = deepcopy(musicVal)
-    x.forceMIDICompatible()
-    if (x.__class__.__name__ == 'Music'):
-        #y = applyTempo(x) # interpret all tempo scaling factors before continuing
-        #return musicToMEvents(y.tree, 0, (-1,INST))
-        evs = []
-        for t in x.trees:
-            evs = evs + musicToMEvents(t, currentTime, currentInstrument)
-        return sorted(evs, key=lambda e: e.eTime) # need to sort events by onset
-    elif (x.__class__.__name__ == 'Note'):
-        if x.dur > 0: # one note = one event as long as the duration is positive
-            if (x.onset==None):
-                return [MEvent(currentTime, x.pitch, x.dur, x.vol, currentInstrument)] # relative placement used if no onset
+    evs = []
+    meta = musicVal.meta if isinstance(musicVal, Music) else None
+    # Meta information only reaches leaves outside of any Part (as with forceMIDICompatible).
+    d = None # duration of the most recently finished subtree
+    stack = [[musicVal, nodeKind(musicVal), 0, None, currentTime, currentInstrument, meta, ()]]
+    # frames are [node, kind, next tree index, running duration, start time of the next tree, instrument, meta,
+    #             offsets of enclosing Shifts]
+    while stack:
+        frame = stack[-1]
+        x, kind, i, total, currentTime, currentInstrument, meta, offsets = frame
+        if kind == NOTE or kind == REST:
+            x = midiLeaf(x, meta)
+            if kind == NOTE and x.dur > 0: # one note = one event as long as the duration is positive
+                if (x.onset==None):
+                    evs.append(MEvent(currentTime, x.pitch, x.dur, x.vol, currentInstrument)) # relative placement used if no onset
+                else: # onset used if it exists
+                    evs.append(MEvent(applyOffsets(x.onset, offsets), x.pitch, x.dur, x.vol, currentInstrument))
+            # when duration is <0, there should be no event. Rests don't contribute to an event representation.
+            d = x.dur
+            stack.pop()
+        elif kind == SEQ or kind == PAR: # including Music
+            if i > 0: # a tree just finished; d is its duration
+                if total is None:
+                    total = d
+                elif kind == SEQ:
+                    total = total + d
+                else:
+                    total = max(total, d)
+                frame[3] = total
+                if kind == SEQ: # the next tree in a Seq starts after the one that just finished
+                    currentTime = currentTime + d
+                    frame[4] = currentTime
+            if i < len(x.trees):
+                frame[2] = i + 1
+                if isinstance(x, Music):
+                    meta = x.meta
+                t = x.trees[i]
+                stack.append([t, nodeKind(t), 0, None, currentTime, currentInstrument, meta, offsets])
             else:
-                return [MEvent(x.onset, x.pitch, x.dur, x.vol, currentInstrument)] # onset used if it exists
-        else: # when duration is <0, there should be no event.
-            return []
-    elif (x.__class__.__name__ == 'Rest'):
-        return [] # rests don't contribute to an event representation
-    elif (x.__class__.__name__ == 'Seq'):
-        evs = []
-        nextCurrentTime = currentTime
-        for t in x.trees:
-            evs = evs + musicToMEvents(t, nextCurrentTime, currentInstrument)
-            nextCurrentTime = nextCurrentTime + dur(t)
-        #return evs # events can be concatenated, doesn't require sorting
-        return sorted(evs, key=lambda e: e.eTime)  # with Note onsets allowed, need to sort events by onset to be safe
-    elif isinstance(x, Par):
-        evs = []
-        for t in x.trees:
-            evs = evs + musicToMEvents(t, currentTime, currentInstrument)
-        return sorted(evs, key=lambda e: e.eTime) # need to sort events by onset
-    elif (x.__class__.__name__ == 'Part'): # formerly Modify
-        #if (x.mod.__class__.__name__ == 'Tempo'):
-        #    y = applyTempo(x)
-        #    return musicToMEvents(y, currentTime, currentInstrument)
-        #elif (x.mod.__class__.__name__ == 'Instrument'):
-        if x.instrument is None:
-            return musicToMEvents(x.tree, currentTime, (-1, INST))  # formerly x.mod
+                d = 0 if total is None else total
+                stack.pop()
+        elif kind == PART: # formerly Modify
+            #if (x.mod.__class__.__name__ == 'Tempo'):
+            #    y = applyTempo(x)
+            #    return musicToMEvents(y, currentTime, currentInstrument)
+            #elif (x.mod.__class__.__name__ == 'Instrument'):
+            if i == 0:
+                frame[2] = 1
+                if x.instrument is None:
+                    patch = (-1, INST)
+                else:
+                    patch = x.instrument.patch # formerly x.mod
+                stack.append([x.tree, nodeKind(x.tree), 0, None, currentTime, patch, None, offsets])
+            else:
+                stack.pop() # the Part's duration is its tree's duration, which is already in d
+        elif kind == SHIFT: # only explicit onsets are moved
+            if i == 0:
+                frame[2] = 1
+                stack.append([x.tree, nodeKind(x.tree), 0, None, currentTime, currentInstrument, meta, offsets + (x.offset,)])
+            else:
+                stack.pop()
         else:
-            return musicToMEvents(x.tree, currentTime, x.instrument.patch)  # formerly x.mod
-    else:
-        raise Exception("Unrecognized musical structure: "+str(x))
+            raise Exception("Unrecognized musical structure: "+str(x))
+    evs.sort(key=lambda e: e.eTime) # need to sort events by onset
+    return evs
+
+def midiSummaries(musicVal, meta=None):
+    """
+    Summarize every Seq, Par, Part and Shift in a tree for iterMEvents. A summary
+    is a tuple of the subtree's duration (as used by musicToMEvents), the smallest
+    explicit onset inside it (None if there are none) and its number of leaves.
+    Leaves are counted so that events can be ordered by tree position without
+    storing paths. The tree is walked once, bottom-up, with an explicit stack;
+    shared subtrees are only summarized once.
+    :param musicVal:
+    :param meta:
+    :return: a dictionary from (id(node), id(meta)) to summaries
+    """
+    summaries = dict()
+    d, o, n = None, None, 0 # summary of the most recently finished subtree
+    stack = [[musicVal, nodeKind(musicVal), 0, None, None, 0, meta]]
+    # frames are [node, kind, next tree index, running duration, min onset, leaf count, meta]
+    while stack:
+        frame = stack[-1]
+        x, kind, i, total, minOnset, count, meta = frame
+        if kind == NOTE or kind == REST:
+            y = midiLeaf(x, meta)
+            d, o, n = y.dur, y.onset, 1
+            stack.pop()
+            continue
+        if i == 0 and (id(x), id(meta)) in summaries: # a shared subtree that was seen already
+            d, o, n = summaries[(id(x), id(meta))]
+            stack.pop()
+            continue
+        if i > 0: # a tree just finished; d, o and n are its summary
+            if total is None:
+                total = d
+            elif kind == SEQ:
+                total = total + d
+            else:
+                total = max(total, d)
+            if minOnset is None or (o is not None and o < minOnset):
+                minOnset = o
+            count = count + n
+            frame[3:6] = [total, minOnset, count]
+        if kind == SEQ or kind == PAR:
+            if i < len(x.trees):
+                frame[2] = i + 1
+                t = x.trees[i]
+                stack.append([t, nodeKind(t), 0, None, None, 0, x.meta if isinstance(x, Music) else meta])
+                continue
+            d = 0 if total is None else total
+        elif kind == PART or kind == SHIFT:
+            if i == 0:
+                frame[2] = 1
+                stack.append([x.tree, nodeKind(x.tree), 0, None, None, 0, None if kind == PART else meta])
+                continue
+            if kind == SHIFT and minOnset is not None:
+                minOnset = minOnset + x.offset
+        else:
+            raise Exception("Unrecognized musical structure: "+str(x))
+        o, n = minOnset, count
+        summaries[(id(x), id(meta))] = (d, o, n)
+        stack.pop()
+    return summaries
+
+
+def iterMEvents(musicVal, currentTime=0, currentInstrument=(-1,INST)):
+    """
+    A lazy version of musicToMEvents: MEvents are generated one at a time in the
+    same order that musicToMEvents would return them. Pending subtrees are kept
+    in a heap keyed by the earliest time they could produce an event, and are
+    only taken apart once that time is reached. The children of Par and Music
+    are merged through the heap; a Seq is stepped through one tree at a time
+    unless it contains explicit onsets. Ties are broken by tree position.
+    Durations are assumed not to be negative.
+    :param musicVal:
+    :param currentTime:
+    :param currentInstrument:
+    :return: a generator of MEvents
+    """
+    summaries = midiSummaries(musicVal)
+    heap = [] # entries are (time, leaf index, counter, item), where item is an MEvent or a pending tree
+    counter = count() # only needed to break ties involving trees without any leaves
+
+    def push(t, time, index, instrument, meta, offsets):
+        """
+        Add a tree starting at time to the heap and return its duration and
+        number of leaves. Notes become events straight away. offsets are those
+        of the Shifts that t is inside of.
+        """
+        kind = nodeKind(t)
+        if kind == NOTE or kind == REST:
+            y = midiLeaf(t, meta)
+            if kind == NOTE and y.dur > 0:
+                eTime = time if y.onset is None else applyOffsets(y.onset, offsets)
+                heappush(heap, (eTime, index, next(counter), MEvent(eTime, y.pitch, y.dur, y.vol, instrument)))
+            return y.dur, 1
+        d, o, n = summaries[(id(t), id(meta))]
+        if n > 0:
+            if o is not None:
+                o = applyOffsets(o, offsets)
+            heappush(heap, (time if o is None else min(time, o), index, next(counter),
+                            [t, kind, time, instrument, meta, offsets, 0]))
+        return d, n
+
+    push(musicVal, currentTime, 0, currentInstrument, None, ())
+    while heap:
+        time, index, c, item = heappop(heap)
+        if isinstance(item, MEvent):
+            yield item
+            continue
+        x, kind, time, instrument, meta, offsets, i = item # i is the next tree of a Seq
+        if kind == SEQ:
+            stepwise = summaries[(id(x), id(meta))][1] is None
+            while i < len(x.trees):
+                d, n = push(x.trees[i], time, index, instrument, meta, offsets)
+                time = time + d
+                index = index + n
+                i = i + 1
+                if stepwise and i < len(x.trees): # the rest of the Seq can't start before time
+                    heappush(heap, (time, index, next(counter), [x, kind, time, instrument, meta, offsets, i]))
+                    break
+        elif kind == PAR: # including Music
+            if isinstance(x, Music):
+                meta = x.meta
+            for t in x.trees:
+                d, n = push(t, time, index, instrument, meta, offsets)
+                index = index + n
+        elif kind == PART:
+            if x.instrument is None:
+                push(x.tree, time, index, (-1, INST), None, offsets)
+            else:
+                push(x.tree, time, index, x.instrument.patch, None, offsets)
+        elif kind == SHIFT:
+            push(x.tree, time, index, instrument, meta, offsets + (x.offset,))
+
 
 def musicToMEventByPart(musicVal, currentTime=0):
     if isinstance(musicVal, Music):
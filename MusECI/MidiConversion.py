@@ -1,8 +1,10 @@
 
 #import midi  # This is the python-midi library
+from collections import deque
+from heapq import heappush, heappop
 from MusECI.MusEciDataStructures import *
 from MusECI.BasicOperations import *
-from MusECI.MEvent import musicToMEvents, musicToMEventByPart
+from MusECI.MEvent import musicToMEvents, musicToMEventByPart, iterMEvents
 
 def checkMidiCompatible(x):
     """
@@ -44,6 +46,7 @@ def forceMidiCompatible(x):
 #First, some constants:
 ON = 1  # note on event type
 OFF = 0  # note off event type
+PROGRAM = 2  # program change event type (see insertPrograms)
 
 class MEventMidi:
     """
@@ -53,8 +56,11 @@ class MEventMidi:
     Field information:
      - eTime will be either relative to the last event depending on the
        current step on the way to conversion to MIDI.
-     - eType should be either ON=1 or OFF=0.
+     - eType should be either ON=1 or OFF=0, or PROGRAM=2 for a program
+       change to the patch in the patch field (pitch and vol are unused).
     """
+    __slots__ = ('eTime', 'eType', 'pitch', 'vol', 'patch')
+
     def __init__(self, eTime, eType, pitch, vol=100, patch=-1):
         self.eTime = eTime
         self.eType = eType
@@ -62,7 +68,7 @@ class MEventMidi:
         self.vol = vol
         self.patch = patch
     def typeStr(self):
-        return ["OFF", "ON"][self.eType]
+        return ["OFF", "ON", "PROGRAM"][self.eType]
     def __str__(self):
         return "MEMidi("+str(self.eTime)+","+str(self.pitch)+","+self.typeStr()+")"
     def __repr__(self):
@@ -72,17 +78,42 @@ class MEventMidi:
 def mEventsToOnOff(mevs):
     """
     This function is an intermediate on the way from the MEvent-style
-    representation to MIDI format.
+    representation to MIDI format. Each MEvent's on and off messages go side by
+    side in one list, in the order of mevs, which is then sorted once by time.
+    The sort is stable and only looks at times, so messages at equal times stay
+    in the order of mevs, with a note's off after its own on. For MEvents in
+    time order this is the same order as iterOnOff.
     :param mevs:
     :return:
     """
-    def f(e):
-        return [MEventMidi(e.eTime, ON, e.pitch, e.vol, e.patch),
-                MEventMidi(e.eTime+e.dur, OFF, e.pitch, e.vol, e.patch)]
-    onOffs = []
+    onOffs = [None] * (2 * len(mevs))
+    i = 0
+    for e in mevs:
+        onOffs[i] = MEventMidi(e.eTime, ON, e.pitch, e.vol, e.patch)
+        onOffs[i+1] = MEventMidi(e.eTime+e.dur, OFF, e.pitch, e.vol, e.patch)
+        i = i + 2
+    onOffs.sort(key=lambda e: e.eTime)
+    return onOffs
+
+
+def iterOnOff(mevs):
+    """
+    A lazy version of mEventsToOnOff for MEvents that are already in time order,
+    such as those from iterMEvents. Each note off waits in a heap until no
+    earlier event can follow, so the result is the same as mEventsToOnOff.
+    :param mevs: an iterable of MEvents sorted by eTime
+    :return: a generator of MEventMidi values
+    """
+    offs = [] # (time, position, note off)
+    i = 0
     for e in mevs:
-        onOffs = onOffs + f(e)
-    return sorted(onOffs, key=lambda e: e.eTime)
+        while len(offs) > 0 and offs[0][0] <= e.eTime:
+            yield heappop(offs)[2]
+        yield MEventMidi(e.eTime, ON, e.pitch, e.vol, e.patch)
+        heappush(offs, (e.eTime+e.dur, i, MEventMidi(e.eTime+e.dur, OFF, e.pitch, e.vol, e.patch)))
+        i = i + 1
+    while len(offs) > 0:
+        yield heappop(offs)[2]
 
 
 def onOffToRelDur(evs):
@@ -127,34 +158,207 @@ def linearPatchMap(patchList):
     return sorted(pmap, key = lambda x: x[1])
 
 
+def addPatch(pmap, patch):
+    """
+    Assign a channel to one more patch, following the same rules as
+    linearPatchMap. This is for patch maps that are built up as instruments
+    are encountered, like during playback.
+    :param pmap: a patch map (list of (patch, channel) pairs), which is altered
+    :param patch:
+    :return: the channel assigned to the patch
+    """
+    if patch[1]: # do we have percussion?
+        chan = 9
+    else:
+        currChan = len([p for p in pmap if not p[0][1]]) # how many channels are already taken?
+        if currChan > 8: currChan = currChan+1 # step over percussion channel
+        if currChan==15:
+            raise Exception("ERROR: too many instruments. Only 15 unique instruments with percussion (channel 9) is allowed in MIDI.")
+        chan = currChan
+    pmap.append((patch, chan))
+    return chan
+
+
+MELODIC_CHANNELS = [c for c in range(0,16) if c != 9] # everything but percussion
+
+
+def patchSpans(mevs):
+    """
+    Find the stretches of time over which each patch is sounding. Each patch's
+    events are sorted by onset and merged into one span for as long as every
+    note starts before (or just as) the notes before it have ended.
+    :param mevs: a list of MEvents
+    :return: a list of (start, end, patch, events) tuples, sorted by start time
+    """
+    spans = []
+    pList = eventPatchList(mevs)
+    for (p, pEvs) in zip(pList, splitByPatch(mevs, pList)):
+        pEvs = sorted(pEvs, key=lambda e: e.eTime)
+        start = pEvs[0].eTime
+        end = start
+        evs = []
+        for e in pEvs:
+            if e.eTime > end: # a gap: close the current span
+                spans.append((start, end, p, evs))
+                start = e.eTime
+                evs = []
+            end = max(end, e.eTime + e.dur)
+            evs.append(e)
+        spans.append((start, end, p, evs))
+    spans.sort(key=lambda s: s[0])
+    return spans
+
+
+def overlapChannelTracks(mevs):
+    """
+    Assign channels to patches by when they are sounding rather than once for the
+    whole piece, so that any number of instruments can be used as long as no more
+    than 15 (plus percussion) play at once. The spans from patchSpans are swept
+    in time order, keeping a heap of busy channels by the time they come free. A
+    free channel already set to the span's patch is picked if there is one.
+    Otherwise a program change is needed, and the free channel whose patch is
+    needed again furthest in the future gets it (so a patch that only pauses
+    keeps its channel). Going through the spans costs O(log n) each, so with the
+    sorting the whole thing is O(n log n). Percussion stays on channel 9 as in
+    linearPatchMap.
+    :param mevs: a list of MEvents
+    :return: a list of (channel, programs, events) tuples, in channel order, where
+             programs is a list of (time, patch) program changes in time order
+    """
+    tracks = []
+    percussion = [e for e in mevs if e.patch[1]]
+    pList = eventPatchList(percussion)
+    for (p, pEvs) in zip(pList, splitByPatch(percussion, pList)):
+        tracks.append((9, [(0, p)] if p[0] >= 0 else [], pEvs))
+    spans = patchSpans([e for e in mevs if not e.patch[1]])
+    upcoming = dict() # start times of each patch's spans still to come
+    for (start, end, p, evs) in spans:
+        upcoming.setdefault(p, deque()).append(start)
+    def nextUse(chan): # when the patch on a channel is needed again
+        starts = upcoming.get(current.get(chan))
+        return starts[0] if starts else float('inf')
+    free = list(MELODIC_CHANNELS) # channels that aren't playing anything
+    busy = [] # heap of (end time, channel)
+    current = dict() # the patch each channel was last set to
+    programs = dict()
+    events = dict()
+    for (start, end, p, evs) in spans:
+        upcoming[p].popleft()
+        while len(busy) > 0 and busy[0][0] <= start:
+            free.append(heappop(busy)[1])
+        if len(free) == 0:
+            raise Exception("ERROR: too many instruments at once. Only 15 instruments can play at the same time with percussion (channel 9) in MIDI.")
+        matching = [c for c in free if current.get(c) == p]
+        if len(matching) > 0:
+            chan = matching[0]
+        else:
+            chan = max(free, key=nextUse) # unused channels have no next use either
+            if p[0] >= 0 or chan in current: # a negative patch on a used channel resets it
+                programs.setdefault(chan, []).append((start, p))
+            current[chan] = p
+        free.remove(chan)
+        heappush(busy, (end, chan))
+        events.setdefault(chan, []).extend(evs)
+    for chan in events:
+        tracks.append((chan, programs.get(chan, []), events[chan]))
+    return sorted(tracks, key=lambda t: t[0])
+
+
+def eventSpan(mevs):
+    """
+    The stretch of time that a list of MEvents covers.
+    :param mevs: a list of MEvents
+    :return: a (start, end) pair: the first onset and the last end time, or
+             (0, 0) if there are no events
+    """
+    if len(mevs) == 0:
+        return (0, 0)
+    return (min([e.eTime for e in mevs]), max([e.eTime + e.dur for e in mevs]))
+
+
+def partChannels(spans):
+    """
+    Assign channels for music written with one track per part (musicToMidi with
+    partTracks=True). Percussion parts go on channel 9. If there are at most 15
+    other parts, each gets a channel of its own, in order, skipping 9. With more
+    parts than that, channels are shared over time as in overlapChannelTracks:
+    the parts are swept in order of their start times, keeping a heap of busy
+    channels, and each one takes a free channel (one already set to its patch,
+    if there is one). Its program change then goes at its start rather than at
+    time 0, so that it doesn't change the instrument of an earlier part.
+    :param spans: a (patch, start, end) tuple for each part, as from getPatch
+                  and eventSpan
+    :return: a (channel, programs) pair for each part, where programs is a tuple
+             of (time, patch) program changes for the part's track
+    """
+    result = [None] * len(spans)
+    melodic = []
+    for i in range(len(spans)):
+        p = spans[i][0]
+        if p[1]:
+            result[i] = (9, ((0, p),) if p[0] >= 0 else ())
+        else:
+            melodic.append(i)
+    if len(melodic) <= len(MELODIC_CHANNELS):
+        for (i, chan) in zip(melodic, MELODIC_CHANNELS):
+            p = spans[i][0]
+            result[i] = (chan, ((0, p),) if p[0] >= 0 else ())
+        return result
+    free = list(MELODIC_CHANNELS) # channels that aren't playing anything
+    busy = [] # heap of (end time, channel)
+    current = dict() # the patch each channel was last set to
+    for i in sorted(melodic, key=lambda i: spans[i][1]):
+        (p, start, end) = spans[i]
+        while len(busy) > 0 and busy[0][0] <= start:
+            free.append(heappop(busy)[1])
+        if len(free) == 0:
+            raise Exception("ERROR: too many parts at once. With one track per part, only 15 parts can play at the same time "
+                            "with percussion (channel 9) in MIDI. Use partTracks=False to share channels between parts.")
+        matching = [c for c in free if current.get(c) == p]
+        chan = matching[0] if len(matching) > 0 else min(free)
+        if p[0] >= 0 or chan in current: # a negative patch on a used channel resets it
+            result[i] = (chan, ((start, p),))
+        else:
+            result[i] = (chan, ())
+        current[chan] = p
+        free.remove(chan)
+        heappush(busy, (end, chan))
+    return result
+
+
 def splitByPatch(mevs, pListIn=[]):
     """
     This function splits a list of MEvents (or MEventMidis) by their
-    patch number.
+    patch number. The events are grouped in a single pass using a dictionary
+    from patches to lists; each list keeps the events in their original order.
+    Events whose patch is not in pListIn are left out.
     :param mevs:
     :param pListIn:
-    :return:
+    :return: a list of event lists, one for each patch in pListIn
     """
     pList = []
     # did we already get a patch list?
     if len(pListIn)==0: pList = eventPatchList(mevs) # no - need to build it
     else: pList = pListIn # use what we already were supplied
-    evsByPatch = [] # list of lists to sort events
-    unsorted = mevs # our starting list to work with
-    for p in pList: # for each patch...
-        pEvs = [x for x in unsorted if x.patch == p] # fetch the list of matching events
-        evsByPatch.append(pEvs) # add them to the outer list of lists
-        unsorted = [x for x in unsorted if x not in pEvs] # which events are left over?
-    return evsByPatch
+    groups = dict([(p, []) for p in pList])
+    for x in mevs:
+        pEvs = groups.get(x.patch)
+        if pEvs is not None:
+            pEvs.append(x)
+    return [groups.pop(p, []) for p in pList] # a patch listed twice only gets its events once
 
 
-# Tick resolution constant
+# Tick resolution constant: the default number of ticks per quarter note. The
+# functions below take a resolution argument to use a different one for a
+# single conversion (None means this default).
 RESOLUTION = 96
 
 
-# Conversion from Kulitta's durations to MIDI ticks
-def toMidiTick(dur):
-    ticks = int(round(dur * RESOLUTION * 4)) # bug fix 26-June-2016
+# Conversion from Kulitta's durations to MIDI ticks (exact for Fraction durations)
+def toMidiTick(dur, resolution=None):
+    if resolution is None:
+        resolution = RESOLUTION
+    ticks = int(round(dur * resolution * 4)) # bug fix 26-June-2016
     return ticks
 
 
@@ -191,11 +395,11 @@ class ProgramChange:
         return repr(self)
 
 class KeyChange:
-    def __init__(self, timeStamp=None, channel=0, accidentals=0, mode=0):
+    def __init__(self, timeStamp=None, channel=0, accidentals=0, mode=0): # mode: 0 for major, 1 for minor
         self.timeStamp = timeStamp
         self.channel = channel
-        self.accidentals=0
-        self.mode=0
+        self.accidentals=accidentals
+        self.mode=mode
     def __repr__(self):
         return "KeyChange(" + str(self.timeStamp) + "," + str(self.channel) + "," + str(self.accidentals) +  "," + str(self.mode) +")"
 
@@ -214,25 +418,74 @@ class TempoChange:
         return repr(self)
 
 class TimeSignature:
-    def __init__(self, timeStamp=None, numerator=4, denominator=4, clocksPerClick=24, thirtysecondsPerQn=32):  # 120bpm = 500000
+    def __init__(self, timeStamp=None, numerator=4, denominator=4, clocksPerClick=24, thirtysecondsPerQn=8):
         self.timeStamp = timeStamp
         self.numerator = numerator
-        self.denominator = denominator
-        self.clocksPerClick = 24
-        self.thirtysecondsPerQn = 32
+        self.denominator = denominator # as written, like the 8 in 6/8 (not the power of 2 stored in the file)
+        self.clocksPerClick = clocksPerClick
+        self.thirtysecondsPerQn = thirtysecondsPerQn
 
     def __repr__(self):
-        return "TempoChange(" + str(self.timeStamp) + "," + str(self.microsecPerBeat) + ")"
+        return "TimeSignature(" + str(self.timeStamp) + "," + str(self.numerator) + "," + str(self.denominator) + ")"
 
     def __str__(self):
         return repr(self)
 
 
 
+def metaOnset(item, meta):
+    """
+    The onset of a meta item (Tempo, TimeSig or KeySig) as a time like eTime.
+    :param item: the meta item
+    :param meta: the whole meta list, for converting measures to beats
+    :return: the onset (0 if there is none)
+    """
+    onset = getattr(item, 'onset', None)
+    if onset is None:
+        return 0
+    elif isinstance(onset, MetricalValue):
+        return deepcopy(onset).toMIDICompatible(meta) # toBeats alters its input
+    return onset
+
+
+def metaToMessages(meta, resolution=None):
+    """
+    Turn the meta list of a Music value into the messages for a conductor track:
+    Tempo becomes TempoChange, TimeSig becomes TimeSignature and KeySig becomes
+    KeyChange. Anything else in the list is left out, as is a meta value that
+    isn't a list (the MIDI reader stores a bpm there).
+    :param meta: a list of meta items, or None
+    :param resolution: ticks per quarter note (None for RESOLUTION)
+    :return: a list of messages in time order, with relative timestamps
+    """
+    if not isinstance(meta, (list, tuple)):
+        return []
+    msgs = []
+    for item in meta:
+        ticks = toMidiTick(metaOnset(item, meta), resolution)
+        if isinstance(item, Tempo):
+            microsecs = int(round(60000000 / item.bpm))
+            msgs.append(TempoChange(ticks, min(max(microsecs, 1), 0xFFFFFF))) # 3 bytes at most
+        elif isinstance(item, TimeSig):
+            msgs.append(TimeSignature(ticks, item.numerator, item.denominator))
+        elif isinstance(item, KeySig):
+            mode = 1 if item.kind in [Mode.MINOR, Mode.PENTATONIC_MINOR] else 0
+            msgs.append(KeyChange(ticks, 0, item.root, mode))
+    msgs.sort(key=lambda m: m.timeStamp)
+    lastTicks = 0
+    for m in msgs: # absolute to relative
+        ticks = m.timeStamp
+        m.timeStamp = ticks - lastTicks
+        lastTicks = ticks
+    return msgs
+
+
 # Create a pythonmidi event from an MEventMidi value.
-def toMidiEvent(onOffMsg, chan):
+def toMidiEvent(onOffMsg, chan, resolution=None):
     m = None
-    ticks = toMidiTick(onOffMsg.eTime)
+    ticks = toMidiTick(onOffMsg.eTime, resolution)
+    if onOffMsg.eType==PROGRAM: # negative patches go back to the default program
+        return ProgramChange(ticks, chan, max(onOffMsg.patch[0], 0))
     p = int(onOffMsg.pitch)
     v = int(onOffMsg.vol)
     if onOffMsg.eType==ON: m = NoteOn(ticks, chan, p, v)
@@ -243,37 +496,78 @@ def toMidiEvent(onOffMsg, chan):
 # Class defs needed: program change, note on, note off
 # Must have these before pythonmidi can be removed as dependency
 
-def mEventsToPattern(mevs, alreadyByPatch=False):
+def channelTracks(mevs):
+    """
+    Work out the tracks for a list of MEvents: which channel each patch goes on
+    and which events go with it. This is shared by mEventsToPattern and the
+    direct writer in MidiWriter so that the two always agree. Up to 15 patches
+    (plus percussion) get a channel each with linearPatchMap; beyond that,
+    channels are shared over time with overlapChannelTracks.
+    :param mevs: a list of MEvents
+    :return: a list of (channel, programs, events) tuples, in channel order, where
+             programs is a list of (time, patch) program changes in time order
+    """
+    pList = eventPatchList(mevs) # get list of active patches
+    if len([p for p in pList if not p[1]]) > len(MELODIC_CHANNELS):
+        return overlapChannelTracks(mevs)
+    pList.reverse() # BUG FIX 30-Dec-2016: n-ary instrument list somehow ends up reversed - not sure why.
+    pmap = linearPatchMap(pList) # linear patch/channel assignment
+    usedChannels = [p[1] for p in pmap] # which channels are we using? (Important for drum track)
+    mevsByPatch = splitByPatch(mevs, pList) # split event list by patch
+    tracks = []
+    chanInd = 0
+    for i in range(0,16):
+        if i in usedChannels: # are we using this channel?
+            patch = pmap[chanInd][0]
+            programs = [(0, patch)] if patch[0] >= 0 else [] # are we assigning an instrument?
+            tracks.append((i, programs, mevsByPatch[chanInd]))
+            chanInd = chanInd+1
+    return tracks
+
+
+def insertPrograms(evs, programs):
+    """
+    Put program changes into a time-sorted list of on/off events. Each one goes
+    just before the first note on at or after its time, so that notes of the
+    previous patch ending at that moment are turned off first.
+    :param evs: a list of MEventMidis sorted by time
+    :param programs: a list of (time, patch) pairs in time order
+    :return: a new list with PROGRAM events added
+    """
+    result = []
+    p = 0
+    for e in evs:
+        while p < len(programs) and e.eType == ON and e.eTime >= programs[p][0]:
+            result.append(MEventMidi(programs[p][0], PROGRAM, None, None, programs[p][1]))
+            p = p+1
+        result.append(e)
+    for (t, patch) in programs[p:]: # only for tracks without notes
+        result.append(MEventMidi(t, PROGRAM, None, None, patch))
+    return result
+
+
+def mEventsToPattern(mevs, alreadyByPatch=False, resolution=None):
     """
     Converting MEvents to a MIDI file. The following function takes a music structure
     (Music, Seq, Par, etc.) and converts it to a pythonmidi Pattern. File-writing is
     not performed at this step.
     :param mevs:
+    :param resolution: ticks per quarter note (the same must be given when writing the file)
     :return:
     """
     #pattern = midi.Pattern() # Instantiate a MIDI Pattern (contains a list of tracks)
     #pattern.resolution = RESOLUTION # Set the tick per beat resolution
     pattern = []
-    pList = eventPatchList(mevs) # get list of active patches
-    pList.reverse() # BUG FIX 30-Dec-2016: n-ary instrument list somehow ends up reversed - not sure why.
-    pmap = linearPatchMap(pList) # linear patch/channel assignment
-    usedChannels = [p[1] for p in pmap] # which channels are we using? (Important for drum track)
-    mevsByPatch = splitByPatch(mevs, pList) # split event list by patch
-    chanInd = 0;
-    for i in range(0,16):
+    mevs = list(mevs) # all patches must be known before channels are assigned
+    for (i, programs, mevsP) in channelTracks(mevs):
         #track = midi.Track()
         track = list()
-        if i in usedChannels: # are we using this channel?
-            # if yes, then we add events to it
-            mevsP = mevsByPatch[chanInd] # get the relevant collection of events
-            if pmap[chanInd][0][0] >= 0: # are we assigning an instrument?
-                track.append(ProgramChange(0, i, pmap[chanInd][0][0])) # set the instrument
-            mevsOnOff = mEventsToOnOff(mevsP) # convert to on/off messages
-            onOffToRelDur(mevsOnOff) # convert to relative timestamps
-            for e in mevsOnOff: # for each on/off event...
-                m = toMidiEvent(e, i) # turn it into a pythonmidi event
-                track.append(m) # add that event to the track
-            chanInd = chanInd+1;
+        mevsOnOff = mEventsToOnOff(mevsP) # convert to on/off messages
+        mevsOnOff = insertPrograms(mevsOnOff, programs) # set the instruments
+        onOffToRelDur(mevsOnOff) # convert to relative timestamps
+        for e in mevsOnOff: # for each on/off event...
+            m = toMidiEvent(e, i, resolution) # turn it into a pythonmidi event
+            track.append(m) # add that event to the track
         if (len(track)>0):
             pattern.append(track) # add the track to the pattern
         # NOTE: end of track marker is delegated to bytes conversion step
@@ -284,40 +578,27 @@ def getPatch(mevents):
         return mevents[0].patch
     return (-1,False)
 
-def mEventsByPartToPattern(mevsByPart):
+def mEventsByPartToPattern(mevsByPart, resolution=None):
     """
     Converting MEvents to a MIDI file. The following function takes a music structure
     (Music, Seq, Par, etc.) and converts it to a pythonmidi Pattern. File-writing is
     not performed at this step.
     :param mevs:
+    :param resolution: ticks per quarter note (the same must be given when writing the file)
     :return:
     """
     #pattern = midi.Pattern() # Instantiate a MIDI Pattern (contains a list of tracks)
     #pattern.resolution = RESOLUTION # Set the tick per beat resolution
     pattern = list()
-    channel = 0
-    for mevs in mevsByPart:
-        print(mevs)
+    mevsByPart = list(mevsByPart)
+    channels = partChannels([(getPatch(mevs),) + eventSpan(mevs) for mevs in mevsByPart])
+    for (mevs, (c, programs)) in zip(mevsByPart, channels):
         track = list()
-        p = getPatch(mevs)
-        print(p)
-        patchNum = p[0]
-        isPerc = p[1]
-        c = channel
-        if isPerc:
-            c = 9
-        if (patchNum >= 0):
-            print("PROG CHANGE")
-            track.append(ProgramChange(0, c, patchNum))
         mevsOnOff = mEventsToOnOff(mevs)  # convert to on/off messages
-        print(mevsOnOff)
+        mevsOnOff = insertPrograms(mevsOnOff, programs) # set the instrument
         onOffToRelDur(mevsOnOff)  # convert to relative timestamps
-        print(mevsOnOff)
         for e in mevsOnOff:  # for each on/off event...
-            m = toMidiEvent(e, c)  # turn it into a pythonmidi event
+            m = toMidiEvent(e, c, resolution)  # turn it into a pythonmidi event
             track.append(m)  # add that event to the track
-        if not(isPerc):
-            channel += 1
         pattern.append(track)
-    print("Track count: ", len(pattern))
     return pattern
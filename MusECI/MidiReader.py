@@ -18,13 +18,22 @@ Things not yet supported:
   one track per instrument per channel.
 '''
 
-from mido import MidiFile
-from MusECI.MusEciDataStructures import Note, Rest, Music, Part, INST, PERC, Instrument
+try:
+    from mido import MidiFile
+except ImportError: # midiToMusic can read files with midi.py instead
+    MidiFile = None
+import mmap
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from fractions import Fraction
+from MusECI.MusEciDataStructures import Note, Rest, Music, Part, INST, PERC, Instrument, TimeMode
 from MusECI.BasicOperations import par, line, deriveOnsets
 #from MidiConversion import RESOLUTION
 from MusECI.MEvent import MEvent
 import MusECI.MusEciOperations as op
 import MusECI.BasicOperations as basic
+import MusECI.midi as midi
 
 def findNoteDuration(pitch, events):
     '''
@@ -71,6 +80,8 @@ def tickToDur(ticks, resolution = 96):
     :return:
     '''
     #return float(ticks) / float((RESOLUTION * 4))
+    if TimeMode.exact:
+        return Fraction(ticks, resolution * 4)
     return float(ticks) / float((resolution * 4))
 
 def getChannel(track):
@@ -90,7 +101,11 @@ def getChannel(track):
 
 def trackToMEvents(track, ticksPerBeat=96, defaultPatch = -1):
     '''
-    Turn a pythonmidi track (list of events) into MEvents
+    Turn a pythonmidi track (list of events) into MEvents. This is one pass
+    over the track: notes that are still sounding are kept by (channel, pitch)
+    until they end. A note ends at the next note-off, or note-on, of the same
+    pitch on the same channel (see findNoteDuration). Notes that never end are
+    cut off at the end of the track.
     :param track:
     :return:
     '''
@@ -98,19 +113,24 @@ def trackToMEvents(track, ticksPerBeat=96, defaultPatch = -1):
     currPatch = defaultPatch
     channel = getChannel(track);
     mevs = []
-    for i in range(0,len(track)):
-        e = track[i]
+    active = dict() # (channel, pitch) -> (MEvent, start tick)
+    for e in track:
         c = e.type
         currTicks = currTicks + e.time # add time after last event
         if c == "program_change":
             # assign new instrument
             currPatch = e.program # e.data[0]
-        elif c == "note_on":
-            # 1. find matching noteOn event OR another note on with the same pitch & channel
-            noteDur = findNoteDuration(e.note, track[(i + 1):])
-            # 2. create an MEvent for the note
-            n = MEvent(tickToDur(currTicks, ticksPerBeat), e.note, tickToDur(noteDur, ticksPerBeat), e.velocity, patch=toPatch(channel, currPatch))
-            mevs.append(n)
+        elif c == "note_on" or c == "note_off":
+            key = (e.channel, e.note)
+            # 1. end the note sounding on this channel and pitch, if there is one
+            sounding = active.pop(key, None)
+            if sounding is not None:
+                sounding[0].dur = tickToDur(currTicks - sounding[1], ticksPerBeat)
+            if c == "note_on" and e.velocity > 0: # a velocity of 0 means note off
+                # 2. create an MEvent for the new note; its duration is filled in when it ends
+                n = MEvent(tickToDur(currTicks, ticksPerBeat), e.note, 0, e.velocity, patch=toPatch(channel, currPatch))
+                mevs.append(n)
+                active[key] = (n, currTicks)
         #elif c == "SetTempoEvent":
             #print(("Tempo change ignored (not supported yet): ", e))
         elif c == 'time_signature':
@@ -122,11 +142,45 @@ def trackToMEvents(track, ticksPerBeat=96, defaultPatch = -1):
         elif c == 'key_signature':
             print("TO-DO: handle key signature event")
             pass # need to handle this later
-        elif c == 'note_off' or 'end_of_track':
-            pass # nothing to do here; note offs and track ends are handled in on-off matching in other cases.
+        elif c == 'end_of_track':
+            pass # notes still sounding are cut off below
         else:
-            print("Unsupported event type (ignored): ", e.type, vars(e),e)
-            pass
+            pass # other events are ignored
+    for (n, start) in active.values(): # truncate at the end of the track
+        n.dur = tickToDur(currTicks - start, ticksPerBeat)
+    return mevs
+
+def midiTrackToMEvents(track, ticksPerBeat=96, defaultPatch = -1):
+    '''
+    trackToMEvents for a track read by midi.py (a midi.MidiTrack) rather than
+    mido. Notes are paired up in the same way, so the MEvents are the same.
+    :param track: a midi.MidiTrack
+    :return:
+    '''
+    currTicks = 0
+    currPatch = defaultPatch
+    events = track.events[1::2] # the other half are midi.DeltaTimes
+    channel = -1
+    if len(events) > 0 and (events[0].type == "NOTE_ON" or events[0].type == "NOTE_OFF"):
+        channel = events[0].channel - 1 # midi.py counts channels from 1
+    mevs = []
+    active = dict() # (channel, pitch) -> (MEvent, start tick)
+    for e in events:
+        c = e.type
+        currTicks = e.time # midi.py times are from the start of the track
+        if c == "PROGRAM_CHANGE":
+            currPatch = e.data
+        elif c == "NOTE_ON" or c == "NOTE_OFF":
+            key = (e.channel, e.pitch)
+            sounding = active.pop(key, None)
+            if sounding is not None:
+                sounding[0].dur = tickToDur(currTicks - sounding[1], ticksPerBeat)
+            if c == "NOTE_ON" and e.velocity > 0:
+                n = MEvent(tickToDur(currTicks, ticksPerBeat), e.pitch, 0, e.velocity, patch=toPatch(channel, currPatch))
+                mevs.append(n)
+                active[key] = (n, currTicks)
+    for (n, start) in active.values(): # truncate at the end of the track
+        n.dur = tickToDur(currTicks - start, ticksPerBeat)
     return mevs
 
 def checkPatch(mevs):
@@ -159,26 +213,330 @@ def mEventsToMusic(mevs, preserveTracks=True):
         mTotal = Part(mTotal, i) # Modify(i, mTotal)
     return mTotal
 
-def midiToMusic(filename, preserveTracks = True):
+def tracksToMEvents(tracks, ticksPerBeat, toMEvents=trackToMEvents):
     '''
-    Read a MIDI file and convert it to a Music structure.
-    :param filename:
-    :return:
+    The MEvents of each track of a MIDI file that has notes in it. Tracks
+    without a program change get patches -1, -2 and so on.
+    :param tracks: mido tracks, or midi.MidiTracks
+    :param ticksPerBeat:
+    :param toMEvents: trackToMEvents for mido tracks, midiTrackToMEvents for midi.py ones
+    :return: a list of lists of MEvents
     '''
-    #pattern = read_midifile(filename) # a list of tracks
-    midi_file = MidiFile(filename)
-    mVals = []
-    #for t in pattern:
+    evsByTrack = []
     defaultInst = -1
-    for i, t in enumerate(midi_file.tracks):
-        evs = trackToMEvents(t, midi_file.ticks_per_beat, defaultInst)
+    for t in tracks:
+        evs = toMEvents(t, ticksPerBeat, defaultInst)
         if len(evs) > 0:
-            mVals.append(mEventsToMusic(evs, preserveTracks))
+            evsByTrack.append(evs)
             defaultInst -= 1
+    return evsByTrack
+
+def tracksToMusic(tracks, ticksPerBeat, toMEvents=trackToMEvents, preserveTracks=True):
+    '''
+    Convert the tracks of a MIDI file to a Music structure, one tree per
+    track that has notes in it.
+    :param tracks: mido tracks, or midi.MidiTracks
+    :param ticksPerBeat:
+    :param toMEvents: trackToMEvents for mido tracks, midiTrackToMEvents for midi.py ones
+    :param preserveTracks:
+    :return:
+    '''
+    mVals = [mEventsToMusic(evs, preserveTracks) for evs in tracksToMEvents(tracks, ticksPerBeat, toMEvents)]
     music = Music(mVals, 120)
     return basic.removeZeros(music)
 
+def midiToMusic(filename, preserveTracks = True, useMido = True):
+    '''
+    Read a MIDI file and convert it to a Music structure.
+    :param filename:
+    :param useMido: read the file with mido if it is installed, rather than with midi.py
+    :return:
+    '''
+    #pattern = read_midifile(filename) # a list of tracks
+    if useMido and MidiFile is not None:
+        midi_file = MidiFile(filename)
+        return tracksToMusic(midi_file.tracks, midi_file.ticks_per_beat, trackToMEvents, preserveTracks)
+    midi_file = midi.MidiFile()
+    midi_file.open(filename)
+    try:
+        midi_file.read()
+    finally:
+        midi_file.close()
+    return tracksToMusic(midi_file.tracks, midi_file.ticksPerQuarterNote, midiTrackToMEvents, preserveTracks)
+
+# =================================================================
+# MIDI ARCHIVES
+# A corpus can be kept as one file of many MIDI files, one after another.
+# MidiArchive memory-maps it, so only the pages of the songs that are
+# read are loaded, and each song is parsed in place.
+# =================================================================
+
+def midiIndex(data):
+    '''
+    Find the MIDI files in a concatenation of MIDI files by walking their
+    chunk headers. Each file starts at an MThd chunk; the contents of the
+    chunks aren't looked at.
+    :param data: bytes, a bytearray, a memoryview or an mmap
+    :return: a list of (offset, length) pairs, one per file
+    '''
+    index = []
+    pos = 0
+    start = None
+    size = len(data)
+    while pos + 8 <= size:
+        if data[pos:pos + 4] == b"MThd":
+            if start is not None:
+                index.append((start, pos - start))
+            start = pos
+        elif start is None:
+            raise Exception("Not a MIDI file: no MThd chunk at offset 0")
+        length = int.from_bytes(data[pos + 4:pos + 8], 'big')
+        pos = pos + 8 + length
+    if pos > size:
+        raise Exception("MIDI data cut off at offset " + str(size))
+    if start is not None:
+        index.append((start, pos - start))
+    return index
+
+class MidiArchive:
+    '''
+    One or more MIDI files stored one after another in a single file on disk.
+    The file is memory-mapped rather than read, and songs are parsed with
+    midi.py straight from the mapping. An index of (offset, length) pairs
+    (see midiIndex) can be given, for example one saved from an earlier run,
+    so that the archive isn't scanned at all. Use it as a context manager,
+    or call close.
+    '''
+    def __init__(self, filename, index=None):
+        self.file = open(filename, 'rb')
+        self.map = None # (close needs it if mapping fails)
+        try:
+            size = os.fstat(self.file.fileno()).st_size
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else None
+            if index is None:
+                index = midiIndex(self.map) if size > 0 else []
+        except Exception:
+            self.close()
+            raise
+        self.index = list(index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
 
+    def readMidi(self, i):
+        '''
+        Parse the i-th song of the archive.
+        :param i: a position in the index
+        :return: a midi.MidiFile
+        '''
+        offset, length = self.index[i]
+        m = midi.MidiFile()
+        with memoryview(self.map) as whole:
+            with whole[offset:offset + length] as song: # no copy
+                m.readstr(song)
+        return m
 
+    def mEvents(self, i):
+        '''
+        The MEvents of the i-th song, one list per track with notes in it
+        (see tracksToMEvents).
+        :param i: a position in the index
+        :return: a list of lists of MEvents
+        '''
+        m = self.readMidi(i)
+        return tracksToMEvents(m.tracks, m.ticksPerQuarterNote, midiTrackToMEvents)
 
+    def music(self, i, preserveTracks=True):
+        '''
+        The i-th song as a Music structure, as midiToMusic would give it.
+        :param i: a position in the index
+        :param preserveTracks:
+        :return:
+        '''
+        m = self.readMidi(i)
+        return tracksToMusic(m.tracks, m.ticksPerQuarterNote, midiTrackToMEvents, preserveTracks)
+
+# =================================================================
+# CORPUS INGESTION
+# Reading many MIDI files with a pool of processes. Workers send back
+# compact tuples rather than Music trees, which are slow to pickle.
+# =================================================================
+
+def corpusFiles(folder, extensions=('.mid', '.midi')):
+    '''
+    The MIDI files in a folder and its subfolders, in name order. This is
+    a generator, so a big corpus can be read before it has all been listed.
+    :param folder:
+    :param extensions: file name endings to look for (any case)
+    :return: a generator of filenames
+    '''
+    stack = [folder]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            entries = sorted(entries, key=lambda e: e.name)
+        for entry in reversed(entries): # subfolders go on the stack, so walk backwards
+            if entry.is_dir():
+                stack.append(entry.path)
+        for entry in entries:
+            if entry.is_file() and entry.name.lower().endswith(extensions):
+                yield entry.path
+
+def archiveSources(archiveName, index=None):
+    '''
+    The songs of a MidiArchive as sources for ingestCorpus.
+    :param archiveName:
+    :param index: a saved index (None to scan the archive)
+    :return: a generator of (archiveName, offset, length) tuples
+    '''
+    if index is None:
+        with MidiArchive(archiveName) as archive:
+            index = archive.index
+    for (offset, length) in index:
+        yield (archiveName, offset, length)
 
+def readSourceMEvents(source, useMido=False):
+    '''
+    The MEvents of one file or archive entry, one list per track with notes in it.
+    :param source: a filename, or an (archiveName, offset, length) tuple
+    :param useMido: read files with mido (if installed) rather than midi.py; archive
+                    entries are always read with midi.py
+    :return: a list of lists of MEvents
+    '''
+    if isinstance(source, tuple):
+        archiveName, offset, length = source
+        with MidiArchive(archiveName, [(offset, length)]) as archive:
+            return archive.mEvents(0)
+    if useMido and MidiFile is not None:
+        midi_file = MidiFile(source)
+        return tracksToMEvents(midi_file.tracks, midi_file.ticks_per_beat, trackToMEvents)
+    midi_file = midi.MidiFile()
+    midi_file.open(source)
+    try:
+        midi_file.read()
+    finally:
+        midi_file.close()
+    return tracksToMEvents(midi_file.tracks, midi_file.ticksPerQuarterNote, midiTrackToMEvents)
+
+def compactMEvents(evsByTrack):
+    '''
+    MEvents as plain tuples, which pickle much smaller and faster than MEvents
+    or Music trees. Equal patches share one tuple.
+    :param evsByTrack: a list of lists of MEvents
+    :return: a list of tuples of (eTime, pitch, dur, vol, patch) tuples
+    '''
+    patches = dict()
+    tracks = []
+    for evs in evsByTrack:
+        tracks.append(tuple([(e.eTime, e.pitch, e.dur, e.vol, patches.setdefault(e.patch, e.patch)) for e in evs]))
+    return tracks
+
+def expandMEvents(tracks):
+    '''
+    Turn the result of compactMEvents back into MEvents (for example to make
+    Music with mEventsToMusic).
+    :param tracks:
+    :return: a list of lists of MEvents
+    '''
+    return [[MEvent(*fields) for fields in track] for track in tracks]
+
+def ingestChunk(chunk):
+    '''
+    Read some sources for ingestCorpus. This runs in a worker process, so it
+    has to be a module-level function.
+    :param chunk: a tuple of (sources, useMido, summarize)
+    :return: a list of (source, result, error, seconds) tuples
+    '''
+    sources, useMido, summarize = chunk
+    results = []
+    for source in sources:
+        t0 = time.perf_counter()
+        try:
+            evsByTrack = readSourceMEvents(source, useMido)
+            result = compactMEvents(evsByTrack) if summarize is None else summarize(evsByTrack)
+            error = None
+        except Exception as ex:
+            result, error = None, ex
+        results.append((source, result, error, time.perf_counter() - t0))
+    return results
+
+def ingestCorpus(sources, useMido=False, summarize=None, workers=None, chunkSize=16, maxInFlight=None, progress=None):
+    '''
+    Read many MIDI files using a pool of processes. Results are given back as
+    soon as they are ready, so they may be out of order. Sources are taken a
+    chunk at a time, and only a limited number of chunks are in flight, so
+    memory use doesn't grow with the size of the corpus as long as results are
+    used (or dropped) as they come. An error in one file doesn't stop the others.
+    :param sources: an iterable of filenames and (archiveName, offset, length)
+                    tuples, such as corpusFiles or archiveSources give
+    :param useMido: as for readSourceMEvents
+    :param summarize: a module-level function applied in the worker to each
+                      file's MEvents (a list per track), whose result is sent
+                      back instead (default: compactMEvents)
+    :param workers: number of processes (default: one per CPU); 0 does all the
+                    work in this process, in order
+    :param chunkSize: sources per task sent to a worker
+    :param maxInFlight: most chunks submitted but not yet finished (default: 2 per worker)
+    :param progress: a function called as progress(done, failed) after each file
+    :return: a generator of (source, result, error, seconds) tuples, where error
+             is None on success and seconds is the time spent reading the file
+    '''
+    done, failed = 0, 0
+    def chunks():
+        chunk = []
+        for source in sources:
+            chunk.append(source)
+            if len(chunk) >= chunkSize:
+                yield chunk
+                chunk = []
+        if len(chunk) > 0:
+            yield chunk
+    if workers == 0:
+        for chunk in chunks():
+            for r in ingestChunk((chunk, useMido, summarize)):
+                done, failed = done + 1, failed + (r[2] is not None)
+                if progress is not None:
+                    progress(done, failed)
+                yield r
+        return
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if maxInFlight is None:
+        maxInFlight = 2 * workers
+    pool = ProcessPoolExecutor(max_workers=workers)
+    try:
+        pending = dict() # future -> the chunk's sources
+        todo = chunks()
+        while True:
+            while len(pending) < maxInFlight:
+                chunk = next(todo, None)
+                if chunk is None:
+                    break
+                pending[pool.submit(ingestChunk, (chunk, useMido, summarize))] = chunk
+            if len(pending) == 0:
+                break
+            finished, notFinished = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                chunk = pending.pop(future)
+                try:
+                    results = future.result()
+                except Exception as poolEx: # e.g. a result that can't be pickled
+                    results = [(source, None, poolEx, 0.0) for source in chunk]
+                for r in results:
+                    done, failed = done + 1, failed + (r[2] is not None)
+                    if progress is not None:
+                        progress(done, failed)
+                    yield r
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
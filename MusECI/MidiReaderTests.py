@@ -0,0 +1,328 @@
+# Testing the MIDI reader against the original (one scan per note) version.
+# Run from the repository root with: python -m MusECI.MidiReaderTests
+
+import io
+import mmap
+import os
+import random
+import shutil
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from mido import Message, MetaMessage, MidiFile, MidiTrack
+from MusECI.MusEciDataStructures import *
+import MusECI.MidiReader as mr
+import MusECI.MidiWriter as mw
+import MusECI.midi as midi
+from MusECI.BasicOperations import line
+from MusECI.MEvent import MEvent, musicToMEvents
+
+
+def oldTrackToMEvents(track, ticksPerBeat=96, defaultPatch=-1):
+    # trackToMEvents as it used to be, for comparison
+    currTicks = 0
+    currPatch = defaultPatch
+    channel = mr.getChannel(track)
+    mevs = []
+    for i in range(0, len(track)):
+        e = track[i]
+        currTicks = currTicks + e.time
+        if e.type == "program_change":
+            currPatch = e.program
+        elif e.type == "note_on" and e.velocity > 0:
+            noteDur = mr.findNoteDuration(e.note, track[(i + 1):])
+            mevs.append(MEvent(mr.tickToDur(currTicks, ticksPerBeat), e.note, mr.tickToDur(noteDur, ticksPerBeat),
+                               e.velocity, patch=mr.toPatch(channel, currPatch)))
+    return mevs
+
+
+def fields(mevs):
+    return [(e.eTime, e.pitch, e.dur, e.vol, e.patch) for e in mevs]
+
+
+def randomTrack(n, channel=0, pitches=6, seed=0):
+    # overlapping notes on a few pitches, so there are plenty of retriggers,
+    # note offs written both ways, program changes and notes left hanging
+    rng = random.Random(seed)
+    track = [Message('program_change', channel=channel, program=5)]
+    for i in range(n):
+        time = rng.choice([0, 0, 12, 24, 48])
+        pitch = 60 + rng.randrange(pitches)
+        r = rng.random()
+        if r < 0.45:
+            track.append(Message('note_on', channel=channel, note=pitch, velocity=rng.randrange(1, 128), time=time))
+        elif r < 0.7:
+            track.append(Message('note_off', channel=channel, note=pitch, velocity=64, time=time))
+        elif r < 0.95:
+            track.append(Message('note_on', channel=channel, note=pitch, velocity=0, time=time))
+        elif r < 0.98:
+            track.append(Message('program_change', channel=channel, program=rng.randrange(128), time=time))
+        else:
+            track.append(Message('control_change', channel=channel, control=7, value=100, time=time))
+    track.append(MetaMessage('end_of_track', time=96))
+    return track
+
+
+# Same events as before, in the same order
+for seed in range(20):
+    for channel in [0, 9]:
+        track = randomTrack(500, channel, seed=seed)
+        assert fields(mr.trackToMEvents(track)) == fields(oldTrackToMEvents(track)), seed
+        assert fields(mr.trackToMEvents(track, 480, 3)) == fields(oldTrackToMEvents(track, 480, 3)), seed
+setExactTime(True)
+try:
+    track = randomTrack(500, seed=1)
+    assert fields(mr.trackToMEvents(track, 384)) == fields(oldTrackToMEvents(track, 384))
+finally:
+    setExactTime(False)
+print("note pairing: ok")
+
+# Retriggers, velocity 0 note offs, and notes cut off at the end of the track
+track = [Message('note_on', note=60, velocity=90, time=0),
+         Message('note_on', note=64, velocity=80, time=0),
+         Message('note_on', note=60, velocity=70, time=96), # ends the first 60
+         Message('note_on', note=64, velocity=0, time=96),
+         Message('note_off', note=60, velocity=0, time=48),
+         Message('note_on', note=67, velocity=60, time=0),
+         MetaMessage('end_of_track', time=192)]
+assert [(e.eTime, e.pitch, e.dur) for e in mr.trackToMEvents(track)] == \
+       [(0, 60, 0.25), (0, 64, 0.5), (0.25, 60, 0.375), (0.625, 67, 0.5)]
+assert mr.trackToMEvents([]) == [] and mr.trackToMEvents([Message('note_off', note=60)]) == []
+print("note endings: ok")
+
+# midi.py reads the same messages as mido, from bytes, memoryviews and mmaps
+def midoEvents(midiFile):
+    tracks = []
+    for track in midiFile.tracks:
+        t, evs = 0, []
+        for m in track:
+            t = t + m.time
+            if m.type == 'sysex':
+                evs.append((t, b'sysex', bytes(m.data) + b'\xf7'))
+            else:
+                evs.append((t, bytes(m.bytes())))
+        tracks.append(evs)
+    return tracks
+
+def midiPyEvents(midiFile):
+    tracks = []
+    for track in midiFile.tracks:
+        evs = []
+        for e in track.events[1::2]:
+            if e.type == "F0_SYSEX_EVENT":
+                evs.append((e.time, b'sysex', e.data))
+            else:
+                evs.append((e.time, e.write()))
+        tracks.append(evs)
+    return tracks
+
+def readMidiPy(data):
+    m = midi.MidiFile()
+    m.readstr(data)
+    return m
+
+rng = random.Random(1)
+track = [MetaMessage('track_name', name='piano'), MetaMessage('set_tempo', tempo=500000),
+         Message('sysex', data=[1, 2, 3]), MetaMessage('device_name', name='synth')]
+for i in range(300):
+    channel = rng.randrange(3)
+    kind = rng.randrange(6)
+    time = rng.choice([0, 0, 10, 200, 20000])
+    if kind < 3:
+        track.append(Message('note_on', channel=channel, note=rng.randrange(128), velocity=rng.randrange(128), time=time))
+    elif kind == 3:
+        track.append(Message('note_off', channel=channel, note=rng.randrange(128), velocity=rng.randrange(128), time=time))
+    elif kind == 4:
+        track.append(Message('pitchwheel', channel=channel, pitch=rng.randrange(-8192, 8192), time=time))
+    else:
+        track.append(Message('control_change', channel=channel, control=rng.randrange(120), value=rng.randrange(128), time=time))
+    if i % 50 == 0:
+        track.append(MetaMessage('marker', text='m' + str(i)))
+stream = io.BytesIO()
+MidiFile(tracks=[MidiTrack(track), MidiTrack(randomTrack(200, 9))], ticks_per_beat=240).save(file=stream) # with running status
+written = mw.musicToBytes(Music([Part(line([Note(60 + i % 7, EN) for i in range(100)]), Instrument(4))], [Tempo(90), TimeSig(3, 4)]), True)
+for data in [stream.getvalue(), written]:
+    expected = midoEvents(MidiFile(file=io.BytesIO(data)))
+    for buffer in [data, bytearray(data), memoryview(data)]:
+        m = readMidiPy(buffer)
+        assert midiPyEvents(m) == expected
+    assert midiPyEvents(readMidiPy(m.writestr())) == expected # written back without running status
+    assert m.ticksPerQuarterNote == MidiFile(file=io.BytesIO(data)).ticks_per_beat
+folder = tempfile.mkdtemp()
+try:
+    filename = os.path.join(folder, "test.mid")
+    with open(filename, 'wb') as f:
+        f.write(stream.getvalue())
+    with open(filename, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            assert midiPyEvents(readMidiPy(mapped)) == midoEvents(MidiFile(filename))
+    # ...and midiToMusic gives the same music either way
+    for data in [stream.getvalue(), written]:
+        with open(filename, 'wb') as f:
+            f.write(data)
+        assert fields(musicToMEvents(mr.midiToMusic(filename, useMido=False))) == \
+               fields(musicToMEvents(mr.midiToMusic(filename)))
+finally:
+    shutil.rmtree(folder)
+# Sysex events cancel running status and meta events don't, both when writing and reading
+msgs = [bytes([0x91, 60, 100]), bytes([0x81, 60, 64]), bytes([0xF0, 3, 1, 2, 0xF7]), bytes([0x91, 62, 100]),
+        bytes([0xFF, 0x06, 1, ord('m')]), bytes([0x81, 62, 64]), bytes([0x91, 64, 100])]
+body, status, sizes = b'', None, []
+for msg in msgs:
+    msgBytes, status = mw.runningStatusBytes(msg, status)
+    sizes.append(len(msgBytes))
+    body += mw.to7Bits(10) + msgBytes
+assert sizes == [3, 2, 5, 3, 4, 2, 2]
+data = mw.makeHeader("SingleTrack", 1, 96) + mw.makeTrackHeader(body + mw.endOfTrack) + body + mw.endOfTrack
+expected = midoEvents(MidiFile(file=io.BytesIO(data)))
+assert [e[1] for e in expected[0][:-1]] == [msgs[0], bytes([0x91, 60, 0]), b'sysex', msgs[3], msgs[4],
+                                            bytes([0x91, 62, 0]), msgs[6]]
+assert midiPyEvents(readMidiPy(data)) == expected
+try:
+    readMidiPy(data.replace(bytes([0xF7, 0x0A, 0x91, 62, 100]), bytes([0xF7, 0x0A, 62, 100]))) # no status after sysex
+    assert False, "running status after a sysex event"
+except Exception as e:
+    assert "Running status" in str(e)
+print("midi.py: ok")
+
+# Files read from many threads at once give the same results as reading them one by one
+def channelFile(i):
+    # running status everywhere, on a different channel in each file and track
+    tracks = []
+    for t in range(3):
+        channel = (i + t) % 16
+        msgs = [Message('program_change', channel=channel, program=(i * 3 + t) % 128)]
+        for k in range(150):
+            msgs.append(Message('note_on', channel=channel, note=40 + (k * (i + 1)) % 50, velocity=90, time=k % 3 * 10))
+            msgs.append(Message('note_on', channel=channel, note=40 + (k * (i + 1)) % 50, velocity=0, time=10))
+        tracks.append(MidiTrack(msgs))
+    stream = io.BytesIO()
+    MidiFile(tracks=tracks).save(file=stream)
+    return stream.getvalue()
+
+corpus = [channelFile(i) for i in range(32)]
+serial = [midiPyEvents(readMidiPy(data)) for data in corpus]
+switchInterval = sys.getswitchinterval()
+sys.setswitchinterval(1e-5) # switch threads often
+try:
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        assert list(pool.map(lambda data: midiPyEvents(readMidiPy(data)), corpus)) == serial
+    folder = tempfile.mkdtemp()
+    try:
+        filenames = []
+        for i, data in enumerate(corpus[:8]):
+            filenames.append(os.path.join(folder, str(i) + ".mid"))
+            with open(filenames[-1], 'wb') as f:
+                f.write(data)
+        readFile = lambda filename: fields(musicToMEvents(mr.midiToMusic(filename, useMido=False)))
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            assert list(pool.map(readFile, filenames)) == [readFile(filename) for filename in filenames]
+    finally:
+        shutil.rmtree(folder)
+finally:
+    sys.setswitchinterval(switchInterval)
+print("reading in threads: ok")
+
+# MIDI archives: many files in one, memory-mapped and read one song at a time
+songs = [mw.musicToBytes(Music([Part(line([Note(50 + (i + k) % 20, [EN, QN][k % 2]) for k in range(20 + i)]), Instrument(i % 8)),
+                                Part(line([Note(40 + i, HN)] * 4), Instrument(32))], [Tempo(80 + i)]), i % 2 == 0)
+         for i in range(30)] + [stream.getvalue()]
+blob = b"".join(songs)
+offsets = [sum([len(d) for d in songs[:i]]) for i in range(len(songs))]
+index = mr.midiIndex(blob)
+assert index == [(o, len(d)) for (o, d) in zip(offsets, songs)]
+folder = tempfile.mkdtemp()
+try:
+    archiveName = os.path.join(folder, "corpus.bin")
+    with open(archiveName, 'wb') as f:
+        f.write(blob)
+    songName = os.path.join(folder, "song.mid")
+    with mr.MidiArchive(archiveName) as archive:
+        assert archive.index == index and len(archive) == len(songs)
+        for i in [0, 1, 17, len(songs) - 1]:
+            with open(songName, 'wb') as f:
+                f.write(songs[i])
+            assert fields(musicToMEvents(archive.music(i))) == fields(musicToMEvents(mr.midiToMusic(songName)))
+            midoFile = MidiFile(songName)
+            assert [fields(evs) for evs in archive.mEvents(i)] == \
+                   [fields(evs) for evs in mr.tracksToMEvents(midoFile.tracks, midoFile.ticks_per_beat)]
+            assert midiPyEvents(archive.readMidi(i)) == midoEvents(MidiFile(songName))
+    # with a saved index, only the songs in it are read
+    with mr.MidiArchive(archiveName, index[5:7]) as archive:
+        assert len(archive) == 2
+        assert midiPyEvents(archive.readMidi(1)) == midiPyEvents(readMidiPy(songs[6]))
+    with mr.MidiArchive(songName) as archive: # a single file is an archive of one song
+        assert archive.index == [(0, len(songs[-1]))]
+    with open(songName, 'wb') as f:
+        pass
+    with mr.MidiArchive(songName) as archive:
+        assert len(archive) == 0
+    for bad in [b"RIFF" + blob, blob[:-3]]:
+        try:
+            mr.midiIndex(bad)
+            rejected = False
+        except Exception:
+            rejected = True
+        assert rejected
+    # if the file can't be mapped, that error comes through (not one from close)
+    realMmap = mr.mmap.mmap
+    def failingMmap(*args, **kwargs):
+        raise OSError("can't map")
+    mr.mmap.mmap = failingMmap
+    try:
+        mr.MidiArchive(archiveName)
+        assert False, "mapping should have failed"
+    except OSError as ex:
+        assert str(ex) == "can't map"
+    finally:
+        mr.mmap.mmap = realMmap
+finally:
+    shutil.rmtree(folder)
+print("MIDI archive: ok")
+
+# Corpus ingestion: every file comes back once, with the same events as reading
+# it here, and a file that can't be read is reported without stopping the rest
+if __name__ == "__main__": # the workers may import this module
+    folder = tempfile.mkdtemp()
+    try:
+        os.makedirs(os.path.join(folder, "b", "c"))
+        names = []
+        for i, data in enumerate(songs):
+            names.append(os.path.join(folder, ["", "b", os.path.join("b", "c")][i % 3], "%02d.mid" % i))
+            with open(names[-1], 'wb') as f:
+                f.write(data)
+        broken = os.path.join(folder, "b", "broken.MID")
+        with open(broken, 'wb') as f:
+            f.write(songs[0][:40])
+        with open(os.path.join(folder, "notes.txt"), 'w') as f:
+            f.write("not MIDI")
+        archiveName = os.path.join(folder, "corpus.bin")
+        with open(archiveName, 'wb') as f:
+            f.write(blob)
+        files = list(mr.corpusFiles(folder))
+        assert sorted(files) == sorted(names + [broken]) and len(set(files)) == len(files)
+        expected = dict([(name, mr.compactMEvents(mr.readSourceMEvents(name))) for name in names])
+        sources = files + list(mr.archiveSources(archiveName))
+        for (i, (offset, length)) in enumerate(index):
+            expected[(archiveName, offset, length)] = expected[names[i]]
+        counts = []
+        for workers in [0, 2]:
+            results = list(mr.ingestCorpus(iter(sources), workers=workers, chunkSize=3, maxInFlight=2,
+                                           progress=lambda done, failed: counts.append((done, failed))))
+            assert sorted([str(r[0]) for r in results]) == sorted([str(s) for s in sources])
+            for (source, result, error, seconds) in results:
+                if source == broken:
+                    assert result is None and error is not None
+                else:
+                    assert error is None and result == expected[source] and seconds >= 0
+            assert counts[-1] == (len(sources), 1)
+            counts = []
+        assert [fields(evs) for evs in mr.expandMEvents(expected[names[3]])] == \
+               [fields(evs) for evs in mr.readSourceMEvents(names[3])]
+        results = list(mr.ingestCorpus(names[:5], summarize=len, workers=2)) # a summary instead of the events
+        assert sorted([(r[0], r[1]) for r in results]) == sorted([(name, 2) for name in names[:5]])
+        results = list(mr.ingestCorpus(names[:5], useMido=True, workers=2))
+        assert all([r[2] is None and r[1] == expected[r[0]] for r in results])
+    finally:
+        shutil.rmtree(folder)
+    print("corpus ingestion: ok")
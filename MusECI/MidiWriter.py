@@ -7,9 +7,15 @@
 # the vast majority of MIDI software, since there is no rule in the MIDI spec
 # forbidding it.
 
+import io
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import MusECI.MidiConversion as mc
 from copy import deepcopy
 import MusECI.MEvent as me
+from MusECI.MusEciDataStructures import Music, MetricalValue, nodeKind, NOTE, REST, SEQ, PAR, PART, SHIFT, TimeMode, \
+    editMark, editsSince
 
 '''
 > binStrToNum :: String -> Int
@@ -99,6 +105,29 @@ def padTo(amt, strData):
         return padTo(amt, "0"+strData)
 
 
+def encodeVLQ(number):
+    """
+    Encode a number as a MIDI variable-length quantity: 7 bits per byte, most
+    significant first, with the top bit set on every byte but the last. This gives
+    the same bytes as the binary string functions above (see to7Bits), but it
+    works on the number directly.
+    :param number: a non-negative integer
+    :return: the encoded bytes
+    """
+    if number < 0:
+        raise Exception("Negative value supplied to to7Bits: "+str(number))
+    vals = [number & 0x7F]
+    number = number >> 7
+    while number > 0:
+        vals.append(0x80 | (number & 0x7F))
+        number = number >> 7
+    vals.reverse()
+    return bytes(vals)
+
+# Delta times are nearly always small, so their encodings are worked out ahead of time.
+VLQ_TABLE_SIZE = 4096
+vlqTable = [encodeVLQ(i) for i in range(VLQ_TABLE_SIZE)]
+
 '''
 > to7Bits :: (Integral a, Show a) => a -> Byte.ByteString
 > to7Bits =  Byte.pack . map (fromIntegral . binStrToNum . reverse) .
@@ -107,14 +136,9 @@ def padTo(amt, strData):
 '''
 
 def to7Bits(number):
-    def padTo7Rev(input):
-        return padTo(7, input[::-1])
-    def binStrRev(input):
-        return binStrToNum(input[::-1])
-    step1 = breakBinStrs(7, (padTo(7, numToBinStr(number)))[::-1])
-    step2 = fixBinStrs(list(map(padTo7Rev, step1[::-1])))
-    step3 = bytes(list(map(binStrRev, step2)))
-    return step3
+    if 0 <= number < VLQ_TABLE_SIZE:
+        return vlqTable[number]
+    return encodeVLQ(number)
 
 '''
 > midiHeaderConst :: Byte.ByteString
@@ -149,6 +173,16 @@ def padByte(byteCount, value):
 #f = open('myfile2.txt', 'wb')
 #f.write(padByte(4,192))
 
+def toBigEndian(byteCount, value):
+    """
+    Fixed-width, big-endian encoding of a non-negative integer. Unlike padByte,
+    value can take up all of the bytes.
+    :param byteCount: how many bytes to use
+    :param value: the number to encode
+    :return: the encoded bytes
+    """
+    return int(value).to_bytes(byteCount, 'big')
+
 '''
 > trackHeaderConst :: Byte.ByteString
 > trackHeaderConst = Byte.pack [0x4D, 0x54, 0x72, 0x6B]
@@ -193,11 +227,12 @@ def msgToBytes(message):
     elif message.__class__.__name__ == "ProgramChange":
         return bytes([0xC0 + message.channel]) + padByte(1, message.patch)
     elif message.__class__.__name__ == "TempoChange":
-        return bytes([0xFF, 0x51, 0x03]) + padByte(3, message.microsecondsPerBeat)
-    elif message.__class__.__name__ == "KeyChange":
-        return bytes([0xFF, 0x59, 0x02]) + padByte(1, message.accidentals) + padByte(1, message.mode)
-    elif message.__class__.__name__ == "TimeSignature":
-        return bytes([0xFF, 0x58, 0x04]) + padByte(1, message.numerator) + padByte(1, message.denominator) + \
+        return bytes([0xFF, 0x51, 0x03]) + toBigEndian(3, message.microsecPerBeat)
+    elif message.__class__.__name__ == "KeyChange": # flats are negative, stored as a signed byte
+        return bytes([0xFF, 0x59, 0x02]) + padByte(1, message.accidentals & 0xFF) + padByte(1, message.mode)
+    elif message.__class__.__name__ == "TimeSignature": # the denominator is stored as a power of 2
+        return bytes([0xFF, 0x58, 0x04]) + padByte(1, message.numerator) + \
+               padByte(1, message.denominator.bit_length() - 1) + \
                padByte(1, message.clocksPerClick) + padByte(1, message.thirtysecondsPerQn)
     else:
         raise Exception("Unsupported message: "+str(message))
@@ -206,6 +241,30 @@ def msgToBytes(message):
 # Must have these before pythonmidi can be removed as dependency
 
 
+def runningStatusBytes(msgBytes, status):
+    """
+    Shorten an encoded message using running status: a channel message whose
+    status byte is the same as the one before it can leave the status byte out.
+    To make this happen more often, a NoteOff is sent as a NoteOn with a velocity
+    of 0 (which MIDI treats the same way). Sysex events cancel running status,
+    and meta events leave it as it is.
+    :param msgBytes: the message, as from msgToBytes
+    :param status: the status byte in effect (None if there isn't one)
+    :return: a tuple of the bytes to write and the status byte now in effect
+    """
+    first = msgBytes[0]
+    if first & 0xF0 == 0x80: # NoteOff
+        first = 0x90 | (first & 0x0F)
+        msgBytes = bytes([first, msgBytes[1], 0])
+    if first == 0xFF: # meta event
+        return msgBytes, status
+    if first >= 0xF0: # sysex event
+        return msgBytes, None
+    if first == status:
+        return msgBytes[1:], status
+    return msgBytes, first
+
+
 '''
 > makeTrackBody :: Track Ticks -> Byte.ByteString
 > makeTrackBody [] = endOfTrack -- end marker, very important!
@@ -237,12 +296,7 @@ def makeTrackBody(onOffMsgs):
 '''
 
 def makeTrackHeader(trackBodyBytes):
-    bodyLen = len(trackBodyBytes)
-    step1 = breakBinStrs(8, padX(8*4, '0', numToBinStr(bodyLen)))
-    def mapFun(value):
-        return binStrToNum(value[::-1])
-    step2 = bytes(list(map(mapFun, step1)))
-    return trackHeaderConst() + step2
+    return trackHeaderConst() + toBigEndian(4, len(trackBodyBytes))
 
 
 '''
@@ -253,11 +307,35 @@ def makeTrackHeader(trackBodyBytes):
 >     in  Byte.concat [header, body]
 '''
 
-def makeTrack(onOffMsgs):
-    bodyBytes = makeTrackBody(onOffMsgs)
-    headerBytes = makeTrackHeader(bodyBytes)
-    allBytes = headerBytes + bodyBytes
-    return allBytes # + endOfTrack # EOT shouldn't go here
+def makeTrack(onOffMsgs, runningStatus=False):
+    out = bytearray()
+    writeTrack(out, onOffMsgs, runningStatus)
+    return bytes(out) # + endOfTrack # EOT shouldn't go here
+
+
+def writeTrack(out, onOffMsgs, runningStatus=False):
+    """
+    Append a whole track (header and body) to a bytearray. The events are
+    encoded straight into out, and the length in the track header is filled
+    in once the body is done.
+    :param out: the bytearray to add to
+    :param onOffMsgs: the track's messages (NoteOn, NoteOff, etc.)
+    :param runningStatus: leave out repeated status bytes (see runningStatusBytes)
+    :return: nothing - out is altered
+    """
+    start = len(out)
+    out += trackHeaderConst()
+    out += bytes(4) # placeholder for the length
+    status = None
+    for e in onOffMsgs:
+        msgBytes = msgToBytes(e)
+        if (len(msgBytes) > 0):
+            out += to7Bits(e.timeStamp)
+            if runningStatus:
+                msgBytes, status = runningStatusBytes(msgBytes, status)
+            out += msgBytes
+    out += endOfTrack
+    out[start+4:start+8] = toBigEndian(4, len(out) - start - 8)
 
 '''
 > makeHeader :: FileType -> TrackCount -> TicksPerQN -> Byte.ByteString
@@ -275,8 +353,8 @@ def makeTrack(onOffMsgs):
 '''
 
 def makeHeader(fileTypeStr, numTracks, ticksPerQN):
-    if (numTracks > 16):
-        raise Exception("Too many tracks! MIDI file format only supports 16 tracks.")
+    if (numTracks > 0xFFFF): # the 16 track limit in Euterpea is for channels, not tracks
+        raise Exception("Too many tracks! MIDI file format only supports 65535 tracks.")
     fileTypeBytes = None
     if fileTypeStr == "SingleTrack":
         fileTypeBytes = bytes([0x00, 0x00])
@@ -284,8 +362,8 @@ def makeHeader(fileTypeStr, numTracks, ticksPerQN):
         fileTypeBytes = bytes([0x00, 0x01])
     else:
         raise Exception("Unsupported file type:" + fileTypeStr)
-    numTrackBytes = padByte(2, numTracks)
-    ticksPerQnBytes = padByte(2, ticksPerQN)
+    numTrackBytes = toBigEndian(2, numTracks)
+    ticksPerQnBytes = toBigEndian(2, ticksPerQN)
     return midiHeaderConst() + fileTypeBytes + numTrackBytes + ticksPerQnBytes
 
 '''
@@ -301,8 +379,14 @@ def makeHeader(fileTypeStr, numTracks, ticksPerQN):
 >     in  Byte.concat (header:body)
 '''
 
-def makeFile(pattern):
-    ticksPerQN = mc.RESOLUTION
+def makeFile(pattern, runningStatus=False, resolution=None, meta=None):
+    out = bytearray()
+    writeFile(out, pattern, runningStatus, resolution, meta)
+    return bytes(out)
+
+
+def patternHeader(pattern, resolution=None):
+    ticksPerQN = mc.RESOLUTION if resolution is None else resolution
     numTracks = len(pattern)
     fileTypeStr = ""
     if numTracks < 1:
@@ -311,35 +395,504 @@ def makeFile(pattern):
         fileTypeStr = "SingleTrack"
     else:
         fileTypeStr = "MultiTrack"
-    headerBytes = makeHeader(fileTypeStr, numTracks, ticksPerQN)
-    bodyBytes = makeTrack(pattern[0])
-    for i in range(1,len(pattern)):
-        bodyBytes = bodyBytes + makeTrack(pattern[i])
-    return headerBytes + bodyBytes
+    return makeHeader(fileTypeStr, numTracks, ticksPerQN)
+
+
+def writeFile(out, pattern, runningStatus=False, resolution=None, meta=None):
+    """
+    Write a whole MIDI file to a bytearray or to any writable binary file object
+    (an open file, BytesIO, socket.makefile('wb'), etc.). A bytearray has the
+    tracks encoded straight into it. For file objects, one track at a time is
+    encoded into a buffer and then written, so only the largest track is ever
+    held in memory.
+    :param out: a bytearray or binary file object
+    :param pattern: a list of tracks, each a list of messages
+    :param runningStatus: leave out repeated status bytes (see runningStatusBytes)
+    :param resolution: ticks per quarter note that the pattern was made with
+    :param meta: a Music meta list for a conductor track before the others (see conductorTrack)
+    :return: nothing
+    """
+    conductor = conductorTrack(meta, resolution)
+    headerBytes = patternHeader(([conductor] if conductor else []) + list(pattern), resolution)
+    if isinstance(out, bytearray):
+        out += headerBytes
+        out += conductor
+        for track in pattern:
+            writeTrack(out, track, runningStatus)
+    else:
+        out.write(headerBytes)
+        out.write(conductor)
+        buf = bytearray()
+        for track in pattern:
+            del buf[:]
+            writeTrack(buf, track, runningStatus)
+            out.write(buf)
+
+
+# Encoded conductor tracks, by the contents of their meta lists. Variations of
+# a piece usually share a tempo map, so it only has to be encoded once.
+conductorCache = dict()
+CONDUCTOR_CACHE_SIZE = 256
+
+
+def metaItemKey(item):
+    """
+    A hashable value that is equal for meta items giving equal MIDI events.
+    :param item: a meta item
+    :return: a tuple, or None for items that aren't written
+    """
+    onset = getattr(item, 'onset', None)
+    if isinstance(onset, mc.MetricalValue):
+        onset = (onset.measure.value, getattr(onset.beat, 'value', onset.beat))
+    if isinstance(item, mc.Tempo):
+        return ('Tempo', onset, item.bpm)
+    elif isinstance(item, mc.TimeSig):
+        return ('TimeSig', onset, item.numerator, item.denominator)
+    elif isinstance(item, mc.KeySig):
+        return ('KeySig', onset, item.root, item.kind)
+    return None
+
+
+def conductorTrack(meta, resolution=None):
+    """
+    The encoded conductor track (header included) for the meta list of a Music
+    value, holding its tempo, time signature and key signature events (see
+    mc.metaToMessages). Tracks are cached by the contents of the meta list, so
+    equal lists are only converted and encoded once, even if they are different
+    objects.
+    :param meta: a meta list, or None
+    :param resolution: ticks per quarter note (None for mc.RESOLUTION)
+    :return: the track's bytes, or empty bytes if there are no meta events
+    """
+    if not isinstance(meta, (list, tuple)) or len(meta) == 0:
+        return b''
+    if resolution is None:
+        resolution = mc.RESOLUTION
+    key = (resolution, tuple([metaItemKey(item) for item in meta]))
+    track = conductorCache.get(key)
+    if track is None:
+        msgs = mc.metaToMessages(meta, resolution)
+        track = makeTrack(msgs) if len(msgs) > 0 else b'' # meta events never use running status
+        if len(conductorCache) >= CONDUCTOR_CACHE_SIZE:
+            conductorCache.clear()
+        conductorCache[key] = track
+    return track
+
+
+# =================================================================
+# DIRECT OUTPUT
+# Music can also go straight from MEvents to bytes, skipping the
+# MEventMidi and NoteOn/NoteOff/ProgramChange stages. The bytes are
+# the same as from mEventsToPattern followed by writeFile.
+# =================================================================
+
+def writeEventTrack(out, chan, programs, mevs, runningStatus=False, resolution=None):
+    """
+    Append the track for one channel to a bytearray, straight from MEvents. Note
+    ons and offs are put in the same order as mEventsToOnOff, working on indices
+    rather than creating a message object for each. Program changes go where
+    mc.insertPrograms would put them.
+    :param out: the bytearray to add to
+    :param chan: the track's channel
+    :param programs: the track's (time, patch) program changes, as from mc.channelTracks
+    :param mevs: the track's MEvents
+    :param runningStatus: leave out repeated status bytes (see runningStatusBytes)
+    :param resolution: ticks per quarter note (None for mc.RESOLUTION)
+    :return: nothing - out is altered
+    """
+    start = len(out)
+    out += trackHeaderConst()
+    out += bytes(4) # placeholder for the length
+    status = None
+    programStatus = 0xC0 + chan
+    onStatus = 0x90 + chan
+    offStatus = onStatus if runningStatus else 0x80 + chan
+    mevs = sorted(mevs, key=lambda e: e.eTime)
+    times = [None] * (2 * len(mevs)) # on and off times side by side
+    for j in range(len(mevs)):
+        e = mevs[j]
+        times[2*j] = e.eTime
+        times[2*j+1] = e.eTime + e.dur
+    lastTime = 0
+    p = 0 # next program change
+    for k in sorted(range(len(times)), key=times.__getitem__) + [None]:
+        while p < len(programs) and (k is None or (not k & 1 and times[k] >= programs[p][0])):
+            (t, patch) = programs[p]
+            out += to7Bits(mc.toMidiTick(t - lastTime, resolution))
+            lastTime = t
+            if not runningStatus or programStatus != status:
+                out.append(programStatus)
+                status = programStatus
+            out.append(max(patch[0], 0))
+            p = p + 1
+        if k is None:
+            break
+        e = mevs[k >> 1]
+        out += to7Bits(mc.toMidiTick(times[k] - lastTime, resolution))
+        lastTime = times[k]
+        if k & 1: # note off
+            msgStatus = offStatus
+            vol = 0 if runningStatus else int(e.vol)
+        else:
+            msgStatus = onStatus
+            vol = int(e.vol)
+        if not runningStatus or msgStatus != status:
+            out.append(msgStatus)
+            status = msgStatus
+        out.append(int(e.pitch))
+        out.append(vol)
+    out += endOfTrack
+    out[start+4:start+8] = toBigEndian(4, len(out) - start - 8)
+
+
+def writeMusic(out, music, runningStatus=False, resolution=None):
+    """
+    Write music as a MIDI file (with one track per channel, like musicToMidi with
+    partTracks=False) to a bytearray or writable binary file object. If the music
+    has meta events, they go in a conductor track first.
+    :param out: a bytearray or binary file object
+    :param music: the music to write
+    :param runningStatus: leave out repeated status bytes (see runningStatusBytes)
+    :param resolution: ticks per quarter note (None for mc.RESOLUTION)
+    :return: nothing
+    """
+    conductor = conductorTrack(getattr(music, 'meta', None), resolution)
+    tracks = mc.channelTracks(me.musicToMEvents(music))
+    tracks = [t for t in tracks if len(t[1]) > 0 or len(t[2]) > 0] # as mEventsToPattern, no empty tracks
+    headerBytes = patternHeader(([conductor] if conductor else []) + tracks, resolution)
+    if isinstance(out, bytearray):
+        out += headerBytes
+        out += conductor
+        for (chan, programs, mevs) in tracks:
+            writeEventTrack(out, chan, programs, mevs, runningStatus, resolution)
+    else:
+        out.write(headerBytes)
+        out.write(conductor)
+        buf = bytearray()
+        for (chan, programs, mevs) in tracks:
+            del buf[:]
+            writeEventTrack(buf, chan, programs, mevs, runningStatus, resolution)
+            out.write(buf)
+
+
+def musicToBytes(music, runningStatus=False, resolution=None):
+    """
+    The bytes of a MIDI file for music (see writeMusic).
+    :param music:
+    :param runningStatus:
+    :param resolution:
+    :return:
+    """
+    out = bytearray()
+    writeMusic(out, music, runningStatus, resolution)
+    return bytes(out)
+
+# =================================================================
+# PART TRACK CACHE
+# When the same music is exported again and again while it is being
+# edited, the tracks of parts that didn't change can be reused. A
+# TrackCache remembers the encoded track of each top-level tree of a
+# Music value by a structural fingerprint of the tree.
+# =================================================================
+
+def partFingerprint(tree, nodeIds=None):
+    """
+    A structural key for a tree: trees with equal keys give the same MEvents.
+    It is a flat tuple of the leaf values, Part patches, Shift offsets and the
+    shape of each Seq and Par, in a fixed walk order.
+    :param tree: the music structure
+    :param nodeIds: a set to add the id of every node in the tree to (optional)
+    :return: a tuple, or None if the tree holds values that can't be compared
+             this way (MetricalValues and non-integer pitches). The tuple can
+             still be unhashable if leaves hold unusual values.
+    """
+    tokens = []
+    stack = [tree]
+    while stack:
+        x = stack.pop()
+        kind = nodeKind(x)
+        if nodeIds is not None:
+            nodeIds.add(id(x))
+        if kind == NOTE or kind == REST:
+            if isinstance(x.dur, MetricalValue) or isinstance(x.onset, MetricalValue):
+                return None
+            if kind == NOTE:
+                if not isinstance(x.pitch, int):
+                    return None
+                tokens.append((x.pitch, x.dur, x.vol, x.onset))
+            else:
+                tokens.append((x.dur, x.onset))
+        elif kind == SEQ or kind == PAR:
+            tokens.append(kind)
+            tokens.append(len(x.trees))
+            stack.extend(x.trees)
+        elif kind == PART:
+            tokens.append(kind)
+            tokens.append(None if x.instrument is None else x.instrument.patch)
+            stack.append(x.tree)
+        elif kind == SHIFT:
+            tokens.append(kind)
+            tokens.append(x.offset)
+            stack.append(x.tree)
+        else:
+            raise Exception("Unrecognized musical structure: "+str(x))
+    return tuple(tokens)
+
+
+def knownPart(fp, h, *tables):
+    """
+    Look up a part by its fingerprint in TrackCache.parts style tables.
+    :param fp: a fingerprint from partFingerprint (None for no lookup)
+    :param h: the hash of fp
+    :param tables: dictionaries from hashes to part entries, searched in order
+    :return: the first entry with a fingerprint equal to fp, or None
+    """
+    if fp is None:
+        return None
+    for table in tables:
+        part = table.get(h)
+        if part is not None and (part[0] is fp or part[0] == fp):
+            return part
+    return None
+
+
+class TrackCache:
+    """
+    Encoded part tracks from the last export of a piece, for musicToMidi with
+    partTracks=True. Use one cache per piece being edited. A tree that is the
+    same object as last time, and that no in-place change since has been made
+    inside of (see touch and editsSince in MusEciDataStructures), is reused
+    without looking at it at all. A change whose root isn't inside one of the
+    trees could have altered any of them (it may have been made to the whole
+    Music, or to something else holding one of the trees; the cache can't
+    tell these apart from changes to other music), so then every tree is
+    looked at again. This also keeps the node ids stored for a reused tree up
+    to date, since unshare only replaces nodes below the root of a change. Any other tree is fingerprinted
+    (partFingerprint), which is much cheaper than converting and encoding it,
+    and only trees with new fingerprints are encoded. Entries that the latest
+    export didn't use are dropped.
+    """
+    def __init__(self):
+        self.mark = None # editMark() at the latest export
+        self.trees = dict() # id(tree) -> (tree, fingerprint, hash of the fingerprint, ids of the tree's nodes)
+        self.parts = dict() # hash -> (fingerprint, patch of the first event, (start, end), {(channel, programs, settings): track bytes})
+        self.hits = 0 # tracks reused in the latest export
+        self.misses = 0 # tracks encoded in the latest export
+
+    def clear(self):
+        self.mark = None
+        self.trees.clear()
+        self.parts.clear()
+
+
+def writePartTracks(out, music, runningStatus=False, resolution=None, cache=None):
+    """
+    Write a Music value as a MIDI file with one track per top-level tree (as
+    musicToMidi does with partTracks=True) to a bytearray or writable binary
+    file object, reusing tracks from a TrackCache where possible. Channels are
+    given out by mc.partChannels, as in mc.mEventsByPartToPattern, and the
+    bytes are the same.
+    :param out: a bytearray or binary file object
+    :param music: a Music value
+    :param runningStatus: leave out repeated status bytes (see runningStatusBytes)
+    :param resolution: ticks per quarter note (None for mc.RESOLUTION)
+    :param cache: a TrackCache (None to encode everything)
+    :return: nothing
+    """
+    if cache is None:
+        cache = TrackCache()
+    edited = None if cache.mark is None else editsSince(cache.mark) # ids of changed subtrees
+    if edited and not all([any([i in entry[3] for entry in cache.trees.values()]) for i in edited]):
+        edited = None # a change made above the trees (to the whole Music, say) may have altered any of them
+    cache.mark = editMark()
+    settings = (runningStatus, mc.RESOLUTION if resolution is None else resolution, TimeMode.exact)
+    trees, parts = dict(), dict() # what this export uses
+    cache.hits, cache.misses = 0, 0
+    found = [] # (tree, fingerprint, hash, node ids, patch, span, MEvents or None) for each tree
+    for t in music.trees:
+        mevs = None
+        entry = cache.trees.get(id(t))
+        if entry is not None and entry[0] is t and edited is not None and edited.isdisjoint(entry[3]):
+            fp, h, nodeIds = entry[1], entry[2], entry[3]
+        else:
+            nodeIds = set()
+            fp = partFingerprint(t, nodeIds)
+            try:
+                h = None if fp is None else hash(fp) # tuples don't keep their hash, so only work it out once
+            except TypeError:
+                fp, h = None, None
+        part = knownPart(fp, h, parts, cache.parts)
+        if part is not None:
+            patch, span = part[1], part[2]
+        else:
+            mevs = me.musicToMEvents(t)
+            patch, span = mc.getPatch(mevs), mc.eventSpan(mevs)
+        if fp is not None and h not in parts:
+            parts[h] = (fp, patch, span, dict())
+        found.append((t, fp, h, nodeIds, patch, span, mevs))
+    channels = mc.partChannels([(patch,) + span for (t, fp, h, nodeIds, patch, span, mevs) in found])
+    chunks = []
+    for ((t, fp, h, nodeIds, patch, span, mevs), (c, programs)) in zip(found, channels):
+        key = (c, programs, settings)
+        chunk = None
+        for known in [parts, cache.parts]:
+            part = knownPart(fp, h, known)
+            if chunk is None and part is not None:
+                chunk = part[3].get(key)
+        if chunk is None:
+            if mevs is None:
+                mevs = me.musicToMEvents(t)
+            buf = bytearray()
+            writeEventTrack(buf, c, list(programs), mevs, runningStatus, resolution)
+            chunk = bytes(buf)
+            cache.misses += 1
+        else:
+            cache.hits += 1
+        if fp is not None:
+            trees[id(t)] = (t, fp, h, nodeIds)
+            part = knownPart(fp, h, parts)
+            if part is not None: # (otherwise two fingerprints share a hash)
+                part[3][key] = chunk
+        chunks.append(chunk)
+    cache.trees, cache.parts = trees, parts
+    conductor = conductorTrack(music.meta, resolution)
+    headerBytes = patternHeader(([conductor] if conductor else []) + chunks, resolution)
+    if isinstance(out, bytearray):
+        out += headerBytes
+        out += conductor
+        for chunk in chunks:
+            out += chunk
+    else:
+        out.write(headerBytes)
+        out.write(conductor)
+        for chunk in chunks:
+            out.write(chunk)
+
 
 #=====================================
 
-def write_midifile(filename,pattern):
-    patternBytes = makeFile(pattern)
-    f = open(filename, 'wb')
-    f.write(patternBytes)
+def write_midifile(filename,pattern, runningStatus=False, resolution=None, meta=None):
+    """
+    Write a pattern to a MIDI file.
+    :param filename: a file name, or a writable binary file object (which is not closed)
+    :param pattern:
+    :param runningStatus: leave out repeated status bytes to make the file smaller
+    :param resolution: ticks per quarter note that the pattern was made with
+    :param meta: a Music meta list for a conductor track
+    :return:
+    """
+    if hasattr(filename, 'write'):
+        writeFile(filename, pattern, runningStatus, resolution, meta)
+    else:
+        with open(filename, 'wb') as f:
+            writeFile(f, pattern, runningStatus, resolution, meta)
 
-def musicToMidi(filename, music, partTracks=True):
+def musicToMidi(filename, music, partTracks=True, runningStatus=False, resolution=None, cache=None):
     """
     musicToMidi takes a filename (which must end in ".mid") and a music structure and writes
-    a MIDI file.
+    a MIDI file. A writable binary file object can be given instead of a filename.
+    Tempo, time signature and key signature events in the music's meta list are
+    written to a conductor track.
     :param filename:
     :param music:
+    :param partTracks:
+    :param runningStatus: leave out repeated status bytes to make the file smaller
+    :param resolution: ticks per quarter note (None for mc.RESOLUTION)
+    :param cache: a TrackCache for exporting the same piece repeatedly (partTracks only)
     :return:
     """
     #mc.checkMidiCompatible(x) # are the volumes and pitches within 0-127?
-    if partTracks:
+    if partTracks and isinstance(music, Music): # one track per tree, straight from MEvents to bytes
+        if hasattr(filename, 'write'):
+            writePartTracks(filename, music, runningStatus, resolution, cache)
+        else:
+            with open(filename, 'wb') as f:
+                writePartTracks(f, music, runningStatus, resolution, cache)
+    elif partTracks:
         es = me.musicToMEventByPart(music)
-        print(es)
-        p = mc.mEventsByPartToPattern(es)
-        print(p)
-        write_midifile(filename,p)
+        p = mc.mEventsByPartToPattern(es, resolution)
+        write_midifile(filename,p, runningStatus, resolution, getattr(music, 'meta', None))
+    elif hasattr(filename, 'write'):
+        writeMusic(filename, music, runningStatus, resolution) # straight from MEvents to bytes
     else:
-        e = me.musicToMEvents(music) # convert to MEvents
-        p = mc.mEventsToPattern(e) # convert to a pattern (mido)
-        write_midifile(filename,p)
+        with open(filename, 'wb') as f:
+            writeMusic(f, music, runningStatus, resolution)
+
+
+# =================================================================
+# BATCH EXPORT
+# =================================================================
+
+def exportItem(item):
+    """
+    Write one item for exportBatch. This runs in a worker process, so it has
+    to be a module-level function.
+    :param item: a tuple of (destination, music, partTracks, runningStatus, resolution)
+    :return: a tuple of (bytes or None, error or None). Bytes are returned when
+             the destination is not a filename, so that the caller can write them.
+    """
+    dest, music, partTracks, runningStatus, resolution = item
+    try:
+        if isinstance(dest, (str, bytes, os.PathLike)):
+            musicToMidi(dest, music, partTracks, runningStatus, resolution)
+            return None, None
+        else:
+            buf = io.BytesIO()
+            musicToMidi(buf, music, partTracks, runningStatus, resolution)
+            return buf.getvalue(), None
+    except Exception as ex:
+        return None, ex
+
+
+def exportBatch(items, partTracks=True, runningStatus=False, workers=None, maxInFlight=None, resolution=None):
+    """
+    Write many pieces of music as MIDI files using a pool of processes. Each item
+    is converted and encoded in a worker; files are written by the worker when
+    the destination is a filename, and otherwise (for file objects) by the caller.
+    Only a limited number of items are in flight at once, so items can come from
+    a generator. Results come back in the same order as the items, and an error
+    in one item does not stop the others.
+    :param items: an iterable of (destination, music) pairs, where a destination
+                  is a filename or a writable binary file object
+    :param partTracks: as for musicToMidi
+    :param runningStatus: as for musicToMidi
+    :param workers: number of processes (default: one per CPU); 0 does all the
+                    work in this process
+    :param maxInFlight: most items submitted but not yet finished (default: 4 per worker)
+    :param resolution: as for musicToMidi
+    :return: a list of (destination, error) pairs, where error is None on success
+    """
+    results = []
+    def finish(dest, value, ex):
+        if ex is None and value is not None:
+            try:
+                dest.write(value)
+            except Exception as writeEx:
+                ex = writeEx
+        results.append((dest, ex))
+    if workers == 0:
+        for (dest, music) in items:
+            value, ex = exportItem((dest, music, partTracks, runningStatus, resolution))
+            finish(dest, value, ex)
+        return results
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if maxInFlight is None:
+        maxInFlight = 4 * workers
+    pending = deque() # (destination, future) in item order
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        def collect():
+            dest, future = pending.popleft()
+            try:
+                value, ex = future.result()
+            except Exception as poolEx: # e.g. music that can't be pickled
+                value, ex = None, poolEx
+            finish(dest, value, ex)
+        for (dest, music) in items:
+            if len(pending) >= maxInFlight:
+                collect()
+            target = None if hasattr(dest, 'write') else dest # file objects stay here; the worker sends back bytes
+            pending.append((dest, pool.submit(exportItem, (target, music, partTracks, runningStatus, resolution))))
+        while len(pending) > 0:
+            collect()
+    return results
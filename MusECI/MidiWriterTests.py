@@ -0,0 +1,390 @@
+# Testing the byte encoders and file writing in MidiWriter against the original
+# versions, with a small benchmark of each.
+# Run from the repository root with: python -m MusECI.MidiWriterTests
+
+import io
+import os
+import pickle
+import random
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from MusECI.MusEciDataStructures import *
+import MusECI.MidiWriter as mw
+import MusECI.MidiConversion as mc
+import MusECI.MEvent as me
+from MusECI.BasicOperations import line, transpose
+import MusECI.MidiReader as mr
+from mido import MidiFile
+
+
+def strTo7Bits(number):
+    # to7Bits as it used to be, built from the binary string functions
+    def padTo7Rev(input):
+        return mw.padTo(7, input[::-1])
+    def binStrRev(input):
+        return mw.binStrToNum(input[::-1])
+    step1 = mw.breakBinStrs(7, (mw.padTo(7, mw.numToBinStr(number)))[::-1])
+    step2 = mw.fixBinStrs(list(map(padTo7Rev, step1[::-1])))
+    return bytes(list(map(binStrRev, step2)))
+
+
+def strTrackHeader(trackBodyBytes):
+    # makeTrackHeader as it used to be
+    step1 = mw.breakBinStrs(8, mw.padX(8*4, '0', mw.numToBinStr(len(trackBodyBytes))))
+    step2 = bytes(list(map(lambda value: mw.binStrToNum(value[::-1]), step1)))
+    return mw.trackHeaderConst() + step2
+
+
+def concatFile(pattern):
+    # makeFile as it used to be: each track's bytes are added on with +
+    fileTypeStr = "SingleTrack" if len(pattern) == 1 else "MultiTrack"
+    allBytes = mw.makeHeader(fileTypeStr, len(pattern), mc.RESOLUTION)
+    for track in pattern:
+        body = mw.makeTrackBody(track)
+        allBytes = allBytes + mw.makeTrackHeader(body) + body
+    return allBytes
+
+
+def peakBytes(f, *args):
+    tracemalloc.start()
+    f(*args)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def bestTime(f, vals, repeat=3):
+    best = None
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        for v in vals:
+            f(v)
+        t = time.perf_counter() - t0
+        if best is None or t < best:
+            best = t
+    return best
+
+
+# Variable-length quantities, inside and outside of the table
+vals = list(range(0, 20000)) + [2**k + d for k in range(14, 36) for d in [-1, 0, 1]]
+for v in vals:
+    assert mw.to7Bits(v) == strTo7Bits(v), v
+assert mw.to7Bits(0) == b'\x00' and mw.to7Bits(0x0FFFFFFF) == b'\xff\xff\xff\x7f'
+assert mw.endOfTrack == strTo7Bits(96) + bytes([0xFF, 0x2F, 0x00])
+rejected = False
+try:
+    mw.to7Bits(-1)
+except Exception:
+    rejected = True
+assert rejected, "negative values should be rejected"
+print("to7Bits: ok")
+
+# Fixed-width values
+for n in [0, 1, 127, 128, 255, 256, 4000, 65535, 65536, 70000]:
+    body = bytes(n)
+    assert mw.makeTrackHeader(body) == strTrackHeader(body), n
+assert mw.makeHeader("MultiTrack", 3, 96) == mw.midiHeaderConst() + bytes([0, 1]) + mw.padByte(2, 3) + mw.padByte(2, 96)
+assert mw.makeHeader("SingleTrack", 1, 480)[-2:] == bytes([0x01, 0xE0])
+print("track and file headers: ok")
+
+# Whole files, written to bytes, to file objects and to disk
+parts = [Part(line([Note(40 + (i * 5 + p) % 40, [SN, EN, QN][i % 3]) for i in range(3000)]), Instrument(p * 8))
+         for p in range(6)]
+pattern = mc.mEventsToPattern(me.musicToMEvents(Music(parts)))
+expected = concatFile(pattern)
+assert mw.makeFile(pattern) == expected
+assert mw.makeTrack(pattern[0]) == concatFile(pattern[:1])[14:]
+stream = io.BytesIO()
+mw.write_midifile(stream, pattern)
+assert stream.getvalue() == expected and not stream.closed
+fd, path = tempfile.mkstemp(suffix=".mid")
+os.close(fd)
+try:
+    mw.write_midifile(path, pattern)
+    with open(path, 'rb') as f:
+        assert f.read() == expected
+finally:
+    os.remove(path)
+print("whole files: ok")
+print("peak memory for a {0} byte file: concatenation {1} bytes, makeFile {2} bytes, BytesIO {3} bytes".format(
+    len(expected), peakBytes(concatFile, pattern), peakBytes(mw.makeFile, pattern),
+    peakBytes(mw.writeFile, io.BytesIO(), pattern)))
+
+# Running status: mido must read the same messages, apart from note offs
+# turning into note ons with a velocity of 0 (their release velocity is lost)
+def midoMessages(data):
+    tracks = []
+    for track in MidiFile(file=io.BytesIO(data)).tracks:
+        msgs = []
+        for m in track:
+            if m.type == 'note_off' or (m.type == 'note_on' and m.velocity == 0):
+                msgs.append((m.time, 'off', m.channel, m.note))
+            else:
+                msgs.append((m.time,) + tuple(sorted(m.dict().items())))
+        tracks.append(msgs)
+    return tracks
+
+drums = Part(line([Note(36 + i % 3, SN) for i in range(64)]), Instrument(0, PERC))
+for music in [Music(parts), Music(parts[:1]), Music([drums, parts[2]])]:
+    for mevs in [me.musicToMEvents(music), []]:
+        pattern = mc.mEventsToPattern(mevs) if mevs else [[mc.ProgramChange(0, 0, 5)]]
+        plain = mw.makeFile(pattern)
+        small = mw.makeFile(pattern, runningStatus=True)
+        assert midoMessages(small) == midoMessages(plain)
+        assert len(small) <= len(plain)
+fd, path = tempfile.mkstemp(suffix=".mid")
+os.close(fd)
+try: # MidiReader gives back the same music either way
+    read = []
+    for runningStatus in [False, True]:
+        mw.musicToMidi(path, Music([drums, parts[2]]), partTracks=False, runningStatus=runningStatus)
+        read.append(sorted([(e.eTime, e.pitch, e.dur, e.vol, e.patch) for e in me.musicToMEvents(mr.midiToMusic(path))]))
+    assert read[0] == read[1] and len(read[0]) == 64 + 3000
+finally:
+    os.remove(path)
+pattern = mc.mEventsToPattern(me.musicToMEvents(Music(parts)))
+print("running status: ok ({0} bytes instead of {1})".format(len(mw.makeFile(pattern, True)), len(mw.makeFile(pattern))))
+
+# Straight from music to bytes gives the same files as going through a pattern
+def pipelineBytes(music, runningStatus=False):
+    return mw.makeFile(mc.mEventsToPattern(me.musicToMEvents(music)), runningStatus)
+
+rand = random.Random(5)
+def randomMusic(depth):
+    if depth == 0 or rand.random() < 0.3:
+        if rand.random() < 0.8:
+            return Note(rand.randint(30, 90), rand.choice([SN, EN, 1/3, 0.1, 0]),
+                        rand.choice([None, None, rand.random()]), rand.randint(1, 127))
+        return Rest(rand.choice([EN, 1/3]))
+    trees = [randomMusic(depth - 1) for i in range(rand.randint(1, 4))]
+    c = rand.random()
+    if c < 0.4:
+        return Seq(trees, inPlace=True)
+    elif c < 0.7:
+        return Par(trees, inPlace=True)
+    return Part(Seq(trees, inPlace=True), rand.choice([None, Instrument(rand.randint(0, 5)), Instrument(0, PERC)]))
+
+tests = [Music(parts), Music([drums, parts[2]]), Music([Part(drums.tree, Instrument(3, PERC)), drums])]
+tests = tests + [randomMusic(5) for i in range(300)]
+for music in tests:
+    if len(me.musicToMEvents(music)) > 0:
+        for runningStatus in [False, True]:
+            assert mw.musicToBytes(music, runningStatus) == pipelineBytes(music, runningStatus)
+setExactTime(True)
+try:
+    music = line([Note(60 + i % 5, EN * 2 / 3) for i in range(300)])
+    assert mw.musicToBytes(music) == pipelineBytes(music)
+finally:
+    setExactTime(False)
+stream = io.BytesIO()
+mw.musicToMidi(stream, Music(parts), partTracks=False)
+assert stream.getvalue() == pipelineBytes(Music(parts))
+print("music to bytes: ok")
+
+# Tick resolution is chosen per export, and threads can use different ones at once
+music = line([Note(60 + i % 7, 0.1) for i in range(200)]) # tenths of a whole note don't fit 96 ticks per beat
+assert mw.musicToBytes(music, resolution=96) == mw.musicToBytes(music)
+for resolution in [96, 480, 1000]:
+    data = mw.musicToBytes(music, resolution=resolution)
+    pattern = mc.mEventsToPattern(me.musicToMEvents(music), resolution=resolution)
+    assert data == mw.makeFile(pattern, resolution=resolution)
+    assert MidiFile(file=io.BytesIO(data)).ticks_per_beat == resolution
+with ThreadPoolExecutor(max_workers=4) as pool:
+    resolutions = [96, 480, 960, 120] * 5
+    outputs = list(pool.map(lambda r: mw.musicToBytes(music, resolution=r), resolutions))
+for (r, data) in zip(resolutions, outputs):
+    assert data == mw.musicToBytes(music, resolution=r)
+print("resolution: ok")
+
+# More than 15 instruments: channels are shared by instruments that don't overlap
+def eventKeys(mevs):
+    return sorted([(e.eTime, e.pitch, e.dur, e.vol, e.patch) for e in mevs])
+
+def entrances(n, instr):
+    # n instruments, each playing a bar and coming in a beat after the one before
+    return Music([Part(Seq([Rest(i * QN), line([Note(40 + i % 50, EN) for j in range(8)])], inPlace=True), instr(i))
+                  for i in range(n)])
+
+tests = [entrances(40, Instrument), entrances(20, lambda i: None if i % 7 == 3 else Instrument(i)),
+         Music([entrances(30, Instrument), Part(entrances(15, Instrument).trees[0].tree, Instrument(100)),
+                Part(line([Note(36, QN)] * 40), Instrument(0, PERC))])]
+for music in tests:
+    mevs = me.musicToMEvents(music)
+    tracks = mc.channelTracks(mevs)
+    for (chan, programs, evs) in tracks:
+        for e in evs: # each note plays with the last program set before it
+            current = [p for (t, p) in programs if t <= e.eTime]
+            assert chan == 9 or (current + [(-1, False)])[len(current) - 1] == e.patch
+    assert eventKeys([e for t in tracks for e in t[2]]) == eventKeys(mevs)
+    for runningStatus in [False, True]:
+        assert mw.musicToBytes(music, runningStatus) == pipelineBytes(music, runningStatus)
+read = [] # the program changes put every note back on its own instrument
+for track in MidiFile(file=io.BytesIO(mw.musicToBytes(tests[0]))).tracks:
+    read = read + mr.trackToMEvents(track)
+assert eventKeys(read) == eventKeys(me.musicToMEvents(tests[0]))
+tracks = mc.channelTracks(me.musicToMEvents(tests[0]))
+assert len(tracks) == 15 and sum([len(t[1]) for t in tracks]) == 40
+music = Music([Part(line([Note(60, QN), Rest(WN), Note(60, QN)]), Instrument(i)) for i in range(15)] +
+              [Part(Seq([Rest(HN), Note(60, QN)], inPlace=True), Instrument(15))])
+assert [len(t[1]) for t in mc.channelTracks(me.musicToMEvents(music))] == [3] + [1] * 14 # the others come back to their channels
+music = Music([Part(Note(60, QN), Instrument(i)) for i in range(16)])
+rejected = False
+try:
+    mw.musicToBytes(music)
+except Exception:
+    rejected = True
+assert rejected, "16 instruments at once should be rejected"
+print("channel sharing: ok")
+
+# Tempo, time signature and key signature go in a conductor track
+meta = [Tempo(90), TimeSig(6, 8), KeySig(-3, Mode.MINOR), Tempo(140, onset=1.0), KeySig(2, Mode.MAJOR, onset=Onset(2, 0))]
+music = Music([Part(line([Note(60 + i % 5, EN) for i in range(64)]), Instrument(3))], meta)
+data = mw.musicToBytes(music)
+assert data == mw.makeFile(mc.mEventsToPattern(me.musicToMEvents(music)), meta=meta)
+stream = io.BytesIO()
+mw.musicToMidi(stream, music)
+for midi in [MidiFile(file=io.BytesIO(data)), MidiFile(file=io.BytesIO(stream.getvalue()))]:
+    assert midi.type == 1 and len(midi.tracks) == 2
+    conductor = [(m.time, m.type, m.dict().get('tempo'), m.dict().get('key')) for m in midi.tracks[0]]
+    assert conductor == [(0, 'set_tempo', 666667, None), (0, 'time_signature', None, None),
+                         (0, 'key_signature', None, 'Cm'), (384, 'set_tempo', 428571, None),
+                         (768, 'key_signature', None, 'D'), (96, 'end_of_track', None, None)]
+    assert (midi.tracks[0][1].numerator, midi.tracks[0][1].denominator) == (6, 8)
+assert mw.musicToBytes(Music(music.trees, [])) == mw.musicToBytes(Music(music.trees, 120)) == mw.musicToBytes(music.trees[0])
+assert mw.conductorTrack(meta, 480) is not mw.conductorTrack(meta)
+assert mw.conductorTrack([Tempo(90), TimeSig(6, 8), KeySig(-3, Mode.MINOR), Tempo(140, onset=1.0),
+                          KeySig(2, Mode.MAJOR, onset=Onset(2, 0))]) is mw.conductorTrack(meta) # encoded once
+print("conductor track: ok")
+
+# Re-exporting with a TrackCache: only parts that changed are encoded again
+def partTracksBytes(music, runningStatus=False, resolution=None):
+    pattern = mc.mEventsByPartToPattern(me.musicToMEventByPart(music), resolution)
+    return mw.makeFile(pattern, runningStatus, resolution, music.meta)
+
+def cachedBytes(music, cache, runningStatus=False, resolution=None):
+    stream = io.BytesIO()
+    mw.musicToMidi(stream, music, True, runningStatus, resolution, cache)
+    return stream.getvalue()
+
+score = Music([Part(line([Note(40 + (i * 3 + p) % 40, [SN, EN, QN][i % 3]) for i in range(50)]), Instrument(p, p == 9))
+               for p in range(16)], [Tempo(100), TimeSig(3, 4)])
+cache = mw.TrackCache()
+assert cachedBytes(score, cache) == partTracksBytes(score) and (cache.hits, cache.misses) == (0, 16)
+assert cachedBytes(score, cache) == partTracksBytes(score) and (cache.hits, cache.misses) == (16, 0)
+transpose(score.trees[3], 2) # in place
+assert cachedBytes(score, cache) == partTracksBytes(score) and (cache.hits, cache.misses) == (15, 1)
+score.trees[5] = Part(line([Note(70, EN)] * 8), Instrument(5))
+assert cachedBytes(score, cache) == partTracksBytes(score) and (cache.hits, cache.misses) == (15, 1)
+score.trees[6] = Part(line([Note(40 + (i * 3 + 6) % 40, [SN, EN, QN][i % 3]) for i in range(50)]), Instrument(6))
+assert cachedBytes(score, cache) == partTracksBytes(score) and (cache.hits, cache.misses) == (16, 0) # equal to the old one
+score.trees[7].tree.trees[1].pitch += 1 # by hand: everything gets looked at again, but only this part is encoded
+touch()
+assert cachedBytes(score, cache) == partTracksBytes(score) and (cache.hits, cache.misses) == (15, 1)
+assert cachedBytes(score, cache, True, 480) == partTracksBytes(score, True, 480) and cache.misses == 16
+assert cachedBytes(score, cache) == partTracksBytes(score) and cache.misses == 16 # only the latest settings are kept
+assert cachedBytes(score, mw.TrackCache()) == cachedBytes(score, None)
+transpose(score, 5) # above the parts: every part is looked at again
+assert cachedBytes(score, cache) == partTracksBytes(score) and (cache.hits, cache.misses) == (0, 16)
+transpose(Seq([score.trees[2], score.trees[4]], inPlace=True), 1) # through something else holding two parts
+assert cachedBytes(score, cache) == partTracksBytes(score) and (cache.hits, cache.misses) == (14, 2)
+unshareAll(score)
+assert cachedBytes(score, cache) == partTracksBytes(score) and cache.misses == 0
+transpose(score.trees[8].tree.trees[3], -3) # a single Note inside a part
+assert cachedBytes(score, cache) == partTracksBytes(score) and (cache.hits, cache.misses) == (15, 1)
+transpose(score.trees[8], 3)
+transpose(score.trees[8].tree.trees[3], 3)
+assert cachedBytes(score, cache) == partTracksBytes(score) and (cache.hits, cache.misses) == (15, 1)
+print("track cache: ok")
+
+# One track per part: melodic parts never use channel 9, and with more than 15
+# of them, parts that don't overlap share channels
+def trackChannels(data):
+    return [sorted(set([m.channel for m in track if hasattr(m, 'channel')])) for track in MidiFile(file=io.BytesIO(data)).tracks]
+
+assert trackChannels(cachedBytes(score, None)) == [[]] + [[c] for c in range(16)]
+music = entrances(17, Instrument)
+data = cachedBytes(music, mw.TrackCache())
+assert data == partTracksBytes(music)
+channels = trackChannels(data)
+assert len(channels) == 17 and all([len(c) == 1 and c[0] < 16 and c[0] != 9 for c in channels])
+read = []
+for track in MidiFile(file=io.BytesIO(data)).tracks:
+    read = read + mr.trackToMEvents(track)
+assert eventKeys(read) == eventKeys(me.musicToMEvents(music))
+music = Music([Part(line([Note(60, QN)] * 4), Instrument(i)) for i in range(17)])
+for cache in [None, mw.TrackCache()]:
+    rejected = False
+    try:
+        cachedBytes(music, cache)
+    except Exception:
+        rejected = True
+    assert rejected, "17 parts at once should be rejected"
+print("part channels: ok")
+
+# Notes and Rests pickle as tuples, and pickles from older versions still load
+oldSeq = (b'\x80\x02cMusECI.MusEciDataStructures\nSeq\nq\x00)\x81q\x01}q\x02(X\x05\x00\x00\x00treesq\x03]q\x04('
+          b'cMusECI.MusEciDataStructures\nNote\nq\x05)\x81q\x06}q\x07(X\x05\x00\x00\x00pitchq\x08K<X\x03\x00\x00'
+          b'\x00durq\tG?\xd0\x00\x00\x00\x00\x00\x00X\x03\x00\x00\x00volq\nKZX\x05\x00\x00\x00onsetq\x0bG?\xe0'
+          b'\x00\x00\x00\x00\x00\x00X\x06\x00\x00\x00paramsq\x0cNubcMusECI.MusEciDataStructures\nRest\nq\r)\x81q\x0e}'
+          b'q\x0f(h\tG?\xc0\x00\x00\x00\x00\x00\x00h\x0bNh\x0c}q\x10X\x01\x00\x00\x00aq\x11K\x01subeh\x0cNub.')
+oldNote = (b'ccopy_reg\n_reconstructor\np0\n(cMusECI.MusEciDataStructures\nNote\np1\nc__builtin__\nobject\np2\nNtp3\n'
+           b'Rp4\n(dp5\nVpitch\np6\nI62\nsVdur\np7\nF0.25\nsVvol\np8\nI100\nsVonset\np9\nNsVparams\np10\nNsb.')
+x = pickle.loads(oldSeq)
+n, r = x.trees
+assert (n.pitch, n.dur, n.onset, n.vol, n.params) == (60, 0.25, 0.5, 90, None)
+assert (r.dur, r.onset, r.params) == (0.125, None, {'a': 1})
+n = pickle.loads(oldNote)
+assert (n.pitch, n.dur, n.onset, n.vol, n.params) == (62, 0.25, None, 100, None)
+n = Note(64, EN, 0.5, 70, {'b': 2})
+n.__setstate__((None, {'pitch': 64, 'dur': EN, 'vol': 70, 'onset': 0.5, 'params': {'b': 2}})) # default format for slots
+assert (n.pitch, n.dur, n.onset, n.vol, n.params) == (64, EN, 0.5, 70, {'b': 2})
+for v in [n, Rest(HN, 0.25), Seq([Note(60), Rest(QN)])]:
+    assert str(pickle.loads(pickle.dumps(v))) == str(v)
+print("pickles: ok")
+
+# Batch export: results in order, and errors don't stop the batch
+def defaultBytes(music):
+    stream = io.BytesIO()
+    mw.musicToMidi(stream, music)
+    return stream.getvalue()
+
+if __name__ == "__main__": # the workers may import this module
+    folder = tempfile.mkdtemp()
+    try:
+        stream = io.BytesIO()
+        items = [(os.path.join(folder, "m1.mid"), Music(parts[:1])),
+                 (os.path.join(folder, "bad.mid"), Note(300, QN)), # pitch out of range
+                 (os.path.join(folder, "m2.mid"), Music(parts[:2])),
+                 (stream, Music([drums])),
+                 (os.path.join(folder, "empty.mid"), Rest(QN)), # no tracks
+                 (os.path.join(folder, "m3.mid"), Music(parts[:3]))]
+        for workers in [0, 2]:
+            results = mw.exportBatch(iter(items), workers=workers, maxInFlight=2)
+            assert [r[0] for r in results] == [i[0] for i in items]
+            assert [r[1] is None for r in results] == [True, False, True, True, False, True]
+            for (dest, music), (d, error) in zip(items, results):
+                if error is None and dest is stream:
+                    assert stream.getvalue() == defaultBytes(music) # the same defaults as musicToMidi
+                elif error is None:
+                    with open(dest, 'rb') as f:
+                        assert f.read() == defaultBytes(music)
+            stream.seek(0)
+            stream.truncate()
+    finally:
+        for name in os.listdir(folder):
+            os.remove(os.path.join(folder, name))
+        os.rmdir(folder)
+    print("batch export: ok")
+
+# Microbenchmark: mostly small delta times, as in real files
+deltas = [(i * 37) % 400 for i in range(100000)] + [(i * 7919) % 1000000 for i in range(1000)]
+tStr = bestTime(strTo7Bits, deltas, repeat=1)
+tNew = bestTime(mw.to7Bits, deltas)
+tVLQ = bestTime(mw.encodeVLQ, deltas)
+print("to7Bits on {0} deltas: binary strings {1:.3f} s, table {2:.4f} s, encodeVLQ {3:.4f} s".format(
+    len(deltas), tStr, tNew, tVLQ))
+bodies = [bytes(n) for n in range(0, 5000, 5)]
+print("makeTrackHeader on {0} bodies: binary strings {1:.4f} s, bytes {2:.4f} s".format(
+    len(bodies), bestTime(strTrackHeader, bodies), bestTime(mw.makeTrackHeader, bodies)))
@@ -3,7 +3,11 @@
 # An adaptation of PythonEuterpeaN's classes.
 # ===============================================================================
 
+from collections import deque
+import weakref
 from copy import deepcopy
+import copy as _copy # private, so star imports still get the copy module
+from fractions import Fraction
 from MusECI.GMInstruments import gmNames  # Bring in a bunch of GM instrument names
 # from GMInstruments import gmNames
 import math
@@ -37,6 +41,54 @@ DTN = 0.046875  # dotted thirtysecond
 TN = 0.03125    # thirtysecond note
 
 
+# =================================================================
+# TIME MODE
+# By default, durations and onsets are floats (0.25 = QN). Floats can
+# drift when they are added up, so two times that should be the same may
+# not compare equal. In exact time mode, Notes, Rests and MEvents store
+# their times as Fractions instead. These add up exactly and can be used
+# safely as dictionary keys (e.g. to group notes by onset).
+# =================================================================
+
+class TimeMode:
+    exact = False   # store times as Fractions?
+    ppq = 96        # ticks per quarter note; only sets how finely floats are interpreted in exact mode
+
+
+def setExactTime(exact=True, ppq=96):
+    """
+    Turn exact time mode on or off. Only values created afterwards are affected.
+    In exact mode, floats are read as the nearest fraction whose denominator
+    is at most 4*ppq (the number of ticks in a whole note), so QN becomes 1/4
+    and a float triplet eighth (0.0833...) becomes 1/12. Arithmetic with other
+    Fractions or ints stays exact; mixing in floats (e.g. a float scaling
+    factor) gives floats again.
+    ppq only controls how floats are read. It doesn't change the resolution of
+    MIDI files: writers take a resolution argument (MidiConversion.RESOLUTION
+    by default) and readers use the file's own. Exact times that don't fall on
+    a tick are rounded when written, so pass the same value as the resolution
+    to keep them.
+    :param exact:
+    :param ppq: ticks per quarter note used to read floats
+    :return:
+    """
+    TimeMode.exact = exact
+    TimeMode.ppq = ppq
+
+
+def toTime(t):
+    """
+    Convert a duration or onset to the current time mode's representation.
+    Outside of exact mode, values are returned unchanged. None and
+    MetricalValues are always returned unchanged.
+    :param t:
+    :return:
+    """
+    if TimeMode.exact and isinstance(t, (int, float)) and not isinstance(t, bool):
+        return Fraction(t).limit_denominator(4 * TimeMode.ppq)
+    return t
+
+
 # =================================================================
 # MUSICAL STRUCTURE REPRESENTATIONS
 # Haskell Euterpea features a type called Music, that is polymorphic
@@ -55,14 +107,29 @@ class Note:
     numbers. For example, MetricalValue(0,2) is the Euterpean value 0.75 (3 beats). This exists for both duration and
     onset values.
     '''
+    # Notes are by far the most numerous objects in a score, so they use slots
+    # rather than a per-instance __dict__ to keep memory down.
+    __slots__ = ('pitch', 'dur', 'vol', 'onset', 'params')
+
     # TODO?: store params?  Perhaps as python dictionary param: **params ?
     def __init__(self, pitch, dur=0.25, onset=None, vol=100, params=None):
+        if TimeMode.exact:
+            dur = toTime(dur)
+            onset = toTime(onset)
         self.pitch = pitch
         self.dur = dur
         self.vol = vol
         self.onset = onset
         self.params = params
 
+    # A plain tuple is much quicker to pickle (e.g. to send to other processes)
+    # and deepcopy than the default state for slots.
+    def __getstate__(self):
+        return (self.pitch, self.dur, self.vol, self.onset, self.params)
+
+    def __setstate__(self, state):
+        restoreSlots(self, state, Note.__slots__)
+
     def __str__(self):
         return 'Note' + str((self.pitch, self.dur, self.onset, self.vol))
 
@@ -114,6 +181,32 @@ class Note:
             pass
 
 
+def restoreSlots(x, state, fields):
+    """
+    Restore a Note or Rest from a pickle (or deepcopy). Besides the tuple made
+    by __getstate__, older formats are accepted: a dictionary of fields (from
+    before Notes and Rests had slots) and the default format for slots, a pair
+    of dictionaries. Fields that an older format doesn't have keep their
+    defaults, and ones that are no longer used are ignored.
+    :param x: the Note or Rest being restored
+    :param state: the pickled state
+    :param fields: names of the fields in a state tuple, in order
+    :return:
+    """
+    x.params = None
+    if isinstance(state, dict):
+        state = (None, state)
+    if len(state) == 2 and all([d is None or isinstance(d, dict) for d in state]):
+        for d in state:
+            if d is not None:
+                for k, v in d.items():
+                    if k in fields:
+                        setattr(x, k, v)
+    else:
+        for k, v in zip(fields, state):
+            setattr(x, k, v)
+
+
 class Rest:
     '''
     A Euterpea Rest has just a duration. It's a temporal place-holder just like a
@@ -124,11 +217,22 @@ class Rest:
     numbers. For example, MetricalValue(0,2) is the Euterpean value 0.75 (3 beats). This exists for both duration and
     onset values.
     '''
+    __slots__ = ('dur', 'onset', 'params')
+
     def __init__(self, dur=0.25, onset=None, params=None):
+        if TimeMode.exact:
+            dur = toTime(dur)
+            onset = toTime(onset)
         self.dur = dur
         self.onset = onset  # TO-DO: fill in later
         self.params = params
 
+    def __getstate__(self): # see Note
+        return (self.dur, self.onset, self.params)
+
+    def __setstate__(self, state):
+        restoreSlots(self, state, Rest.__slots__)
+
     def forceMIDICompatible(self, meta=None):
         if isinstance(self.dur, MetricalValue):
             self.dur = self.dur.toMIDICompatible(meta)
@@ -225,10 +329,19 @@ class Seq:
     Seq is similar to Haskell Euterpexa's (:+:) operator. It composes n
     musical objects in sequence, or left to right in trees.
     """
+    _borrowed = False   # see shareCopy and borrow
+    _borrowers = None
+
     def __init__(self, trees=[], params=None, inPlace=False):
         self.trees = handleInPlace(trees, inPlace)
         self.params = params
 
+    def __getstate__(self): # see restoreNode
+        return nodeState(self)
+
+    def __setstate__(self, state):
+        restoreNode(self, state)
+
     def __str__(self):
         return 'Seq(' + str(self.trees) + ')'
 
@@ -236,6 +349,8 @@ class Seq:
         return str(self)
 
     def forceMIDICompatible(self, meta=None):
+        unshare(self)
+        touch(node=self)
         for t in self.trees:
             t.forceMIDICompatible(meta)
 
@@ -255,10 +370,19 @@ class Par:  # For composing two things in parallel
     Par is similar to Haskell Euterpea's (:=:) operator. It composes n
     musical objects in parallel (all at the same starting time).
     """
+    _borrowed = False   # see shareCopy and borrow
+    _borrowers = None
+
     def __init__(self, trees=[], params=None, inPlace=False):
         self.trees = handleInPlace(trees, inPlace)
         self.params = params
 
+    def __getstate__(self): # see restoreNode
+        return nodeState(self)
+
+    def __setstate__(self, state):
+        restoreNode(self, state)
+
     def __str__(self):
         return 'Par(' + str(self.trees) + ')'
 
@@ -266,6 +390,8 @@ class Par:  # For composing two things in parallel
         return str(self)
 
     def forceMIDICompatible(self, meta=None):
+        unshare(self)
+        touch(node=self)
         for t in self.trees:
             t.forceMIDICompatible(meta)
 
@@ -288,6 +414,8 @@ class Chord(Par):
         self.kind = kind    # Not being used for anything within MusECI; seems potentially redundant with Harmony objects
 
     def forceMIDICompatible(self, meta=None):
+        unshare(self)
+        touch(node=self)
         for t in self.trees:
             t.forceMIDICompatible(meta)
 
@@ -316,6 +444,8 @@ class Music(Par):
         return str(self)
 
     def forceMIDICompatible(self):  # no meta argument
+        unshare(self)
+        touch(node=self)
         for t in self.trees:
             t.forceMIDICompatible(self.meta)
 
@@ -336,14 +466,24 @@ class LeadSheetMusic(Music):
 
 
 class Part(object):     # Part is not a Par for most instruments
+    _borrowed = False   # see shareCopy and borrow
+    _borrowers = None
 
     def __init__(self, component, instrument=None, params=None):    # vol removed, see below
         # super(Part, self).__init__(trees=components, params=params)
         self.tree = component   # part should hold just one thing
         self.instrument = instrument
 
+    def __getstate__(self): # see restoreNode
+        return nodeState(self)
+
+    def __setstate__(self, state):
+        restoreNode(self, state)
+
     def forceMIDICompatible(self, meta=None):
         #self.tree.forceMIDICompatible(meta) # todo: fix this later
+        unshare(self)
+        touch(node=self)
         self.tree.forceMIDICompatible()
 
     def __str__(self):
@@ -353,6 +493,39 @@ class Part(object):     # Part is not a Par for most instruments
         return str(self)
 
 
+class Shift(object):
+    """
+    Shift places a music value later (or earlier) in time: every onset inside it
+    is read as onset + offset. The tree inside a Shift is usually shared, which
+    lets repeated material be stored once (see Repeat and hashCons). In-place
+    operations call unshare first, which gives the Shift its own copy of the
+    tree with the offset applied to it.
+    """
+    _borrowed = False   # see shareCopy and borrow
+    _borrowers = None
+
+    def __init__(self, tree, offset=0):
+        self.tree = tree
+        self.offset = offset
+
+    def __getstate__(self): # see restoreNode
+        return nodeState(self)
+
+    def __setstate__(self, state):
+        restoreNode(self, state)
+
+    def forceMIDICompatible(self, meta=None):
+        unshare(self)
+        touch(node=self)
+        self.tree.forceMIDICompatible(meta)
+
+    def __str__(self):
+        return "Shift({0}, {1})".format(self.offset, self.tree)
+
+    def __repr__(self):
+        return str(self)
+
+
 # class Modify:
 #     """
 #     Modify is equivalent to Haskell Euterpea's Modify constructor and allows
@@ -425,10 +598,614 @@ def gmName(patch):
 
 
 def handleInPlace(obj, inPlace):
+    """
+    Either use a value as-is (inPlace=True) or give back a copy of it that can be
+    altered without affecting the original. Copies are structurally shared: only
+    the top node (and the Notes and Rests right below it) is copied, and the
+    subtrees below that are borrowed from the original (see shareCopy). Nothing
+    about the original changes. Borrowed subtrees are copied later by unshare,
+    one level at a time, when either side alters them in place.
+    :param obj: a music value or a list of music values (as given to Seq/Par/Music)
+    :param inPlace: whether to skip copying
+    :return:
+    """
     if inPlace:
         return obj
+    elif isinstance(obj, (list, tuple)):
+        return [shareCopy(x) for x in obj]
+    else:
+        return shareCopy(obj)
+
+
+def shareCopy(x):
+    """
+    Copy a single node of a music tree. Notes and Rests right below it are
+    copied as well, since they are small, but the other subtrees are borrowed:
+    the copy refers to the same ones as x (see borrow). x itself is left alone,
+    so both x and the copy can still be altered in place; unshare makes sure
+    that a change to either one doesn't reach the other. Notes and Rests are
+    simply copied.
+    :param x: the music value to copy
+    :return: a copy of x that borrows the subtrees of x
+    """
+    kind = nodeKind(x)
+    if kind != SEQ and kind != PAR and kind != PART and kind != SHIFT:
+        return deepcopy(x)
+    y = copyNode(x)
+    subtrees = False
+    if kind == SEQ or kind == PAR:
+        trees = y.trees
+        for i in range(len(trees)):
+            if isLeafKind(nodeKind(trees[i])):
+                trees[i] = deepcopy(trees[i])
+            else:
+                subtrees = True
+    elif isLeafKind(nodeKind(y.tree)):
+        y.tree = deepcopy(y.tree)
+    else:
+        subtrees = True
+    if subtrees:
+        borrow(y)
+    return y
+
+
+def copyNode(x):
+    """
+    Copy a Seq, Par, Part or Shift on its own. The copy has its own list of
+    trees (and its own params and meta), but refers to the same subtrees as x.
+    It doesn't borrow them (see borrow), so the caller has to replace them or
+    call borrow on the copy.
+    :param x: a Seq, Par, Part or Shift
+    :return: the copy
+    """
+    y = x.__class__.__new__(x.__class__)
+    y.__dict__.update(x.__dict__)
+    y.__dict__.pop('_borrowed', None)
+    y.__dict__.pop('_borrowers', None)
+    if isinstance(x, (Seq, Par)):
+        y.trees = list(x.trees)
+    if getattr(x, 'params', None) is not None:
+        y.params = deepcopy(x.params)
+    if getattr(x, 'meta', None) is not None:
+        y.meta = deepcopy(x.meta)
+    return y
+
+
+def privateCopy(x):
+    """
+    Deep copy a music value. The copy shares nothing with x, so either of them
+    can be altered in place without affecting the other. (Subtrees that are
+    shared within x, like the motif of a Repeat, are shared within the copy.)
+    Unlike deepcopy, this works on trees of any depth.
+    :param x: the music value to copy
+    :return: a deep copy of x
+    """
+    copies = dict() # id of a node in x -> its copy
+    stack = [x]
+    while stack:
+        node = stack.pop()
+        kind = nodeKind(node)
+        if copies.get(id(node)) is not None: # already copied (it's shared within x)
+            continue
+        if isLeafKind(kind):
+            copies[id(node)] = deepcopy(node)
+            continue
+        trees = node.trees if (kind == SEQ or kind == PAR) else [node.tree]
+        if id(node) not in copies: # first visit: copy the children first
+            copies[id(node)] = None
+            stack.append(node)
+            stack.extend([t for t in trees if id(t) not in copies])
+            continue
+        y = copyNode(node)
+        newTrees = [copies[id(t)] for t in trees]
+        if kind == SEQ or kind == PAR:
+            y.trees = newTrees
+        else:
+            y.tree = newTrees[0]
+        if getattr(node, '_borrowed', False):
+            if kind == SHIFT: # (a Shift may borrow a Note or Rest)
+                borrow(y)
+            else:
+                borrow(y, [newTrees[i] for i in range(len(trees)) if borrows(node, trees[i])])
+        copies[id(node)] = y
+    return copies[id(x)]
+
+
+def borrow(x, subtrees=None):
+    """
+    Mark x as borrowing some of its subtrees: they may belong to other music
+    values as well. Before x is altered in place, unshare gives it its own
+    copies of them. The other way around, each borrowed Seq, Par, Part or Shift
+    keeps a weak reference to x, so that before it is altered itself it can
+    give x a copy of its own (see detach). Notes and Rests right below a Seq,
+    Par or Part always belong to it (but a Shift may borrow a Note or Rest).
+    :param x: a Seq, Par, Part or Shift
+    :param subtrees: the borrowed children of x (by default all of them)
+    :return: x
+    """
+    if subtrees is None:
+        subtrees = x.trees if (nodeKind(x) == SEQ or nodeKind(x) == PAR) else [x.tree]
+    ref = weakref.ref(x)
+    for t in subtrees:
+        if not isLeafKind(nodeKind(t)):
+            borrowers = t._borrowers
+            if borrowers is None:
+                t._borrowers = [ref]
+            elif borrowers[-1] is not ref: # (x may hold t more than once)
+                if len(borrowers) & (len(borrowers) - 1) == 0: # now and then, forget borrowers that are gone
+                    borrowers[:] = [r for r in borrowers if r() is not None]
+                borrowers.append(ref)
+    x._borrowed = True
+    return x
+
+
+def borrows(x, t):
+    """
+    Whether x borrows its child t (see borrow).
+    :param x: a Seq, Par, Part or Shift
+    :param t: one of its children
+    :return:
+    """
+    if not getattr(x, '_borrowed', False) or isLeafKind(nodeKind(t)) or t._borrowers is None:
+        return False
+    return any([r() is x for r in t._borrowers])
+
+
+def isLeafKind(kind):
+    # Notes, Rests and other things that are copied rather than borrowed
+    return kind == NOTE or kind == REST or kind == OTHER
+
+
+def detach(x):
+    """
+    Get x ready to be altered in place by giving everything that borrowed it
+    (see borrow) a copy of its own instead, so that the change doesn't reach
+    them. The copies borrow the subtrees of x in turn.
+    :param x: the music value that is about to be altered
+    :return: x
+    """
+    borrowers = getattr(x, '_borrowers', None)
+    if borrowers:
+        x._borrowers = None
+        for ref in borrowers:
+            p = ref()
+            if p is None:
+                continue
+            if nodeKind(p) == SEQ or nodeKind(p) == PAR:
+                trees = p.trees
+                for i in range(len(trees)):
+                    if trees[i] is x:
+                        trees[i] = shareCopy(x)
+            elif p.tree is x:
+                p.tree = shareCopy(x)
+    return x
+
+
+# Music nodes leave out their borrowers (weak references can't be pickled) and
+# work them out again when they are loaded or copied (see borrow).
+
+def nodeState(x):
+    """
+    The state of a Seq, Par, Part or Shift for pickling and copying.
+    :param x:
+    :return: a dictionary of its fields, without the borrowers, and with the
+             positions of the borrowed children (if any) under _borrowed
+    """
+    state = x.__dict__.copy()
+    state.pop('_borrowers', None)
+    if state.get('_borrowed', False):
+        if nodeKind(x) == SEQ or nodeKind(x) == PAR:
+            state['_borrowed'] = tuple([i for i in range(len(x.trees)) if borrows(x, x.trees[i])])
+        elif nodeKind(x) == SHIFT or borrows(x, x.tree): # (a Shift may borrow a Note or Rest)
+            state['_borrowed'] = (0,)
+        else:
+            state['_borrowed'] = ()
+    return state
+
+
+def restoreNode(x, state):
+    """
+    Restore a Seq, Par, Part or Shift from nodeState (or from the default state
+    of older versions, which is a dictionary of its fields).
+    :param x: the node being restored
+    :param state: the pickled state
+    :return:
+    """
+    x.__dict__.update(state)
+    borrowed = state.get('_borrowed', False)
+    if borrowed:
+        trees = x.trees if (nodeKind(x) == SEQ or nodeKind(x) == PAR) else [x.tree]
+        borrow(x, [trees[i] for i in borrowed if i < len(trees)])
+    else:
+        x.__dict__.pop('_borrowed', None)
+
+
+# =================================================================
+# NODE KINDS
+# Traversals dispatch on the kind of a node rather than comparing class
+# names. The kind of each class is looked up once (following its base
+# classes, so Chord and Music are Pars) and then cached by class.
+# =================================================================
+
+NOTE = 0
+REST = 1
+SEQ = 2
+PAR = 3     # Par, Chord, Music, LeadSheetMusic, ...
+PART = 4
+OTHER = 5   # anything else (Harmony, etc.)
+SHIFT = 6
+
+baseKinds = {Note: NOTE, Rest: REST, Seq: SEQ, Par: PAR, Part: PART, Shift: SHIFT}
+kindCache = dict(baseKinds)
+
+
+def nodeKind(x):
+    """
+    Determine what kind of music node x is (NOTE, REST, SEQ, PAR, PART, SHIFT or OTHER).
+    :param x: a music value
+    :return: one of the node kind constants
+    """
+    try:
+        return kindCache[x.__class__]
+    except KeyError:
+        return registerKind(x.__class__)
+
+
+def registerKind(cls):
+    """
+    Work out and cache the node kind for a class that is not yet in the cache.
+    Subclasses take the kind of their nearest base class with a known kind.
+    :param cls:
+    :return: the node kind for cls
+    """
+    kind = OTHER
+    for base in cls.__mro__:
+        if base in baseKinds:
+            kind = baseKinds[base]
+            break
+    kindCache[cls] = kind
+    return kind
+
+
+def unshare(x):
+    """
+    Get x ready to be altered in place. Anything that borrowed x gets a copy of
+    its own (see detach), subtrees that x borrowed are replaced with copies that
+    belong to x, and Shifts right below x are expanded (see materialize). Only
+    the children of x are copied; operations that descend further must call
+    unshare again at each level they alter. This keeps the total amount of
+    copying proportional to what actually gets changed.
+    :param x: the music value that is about to be altered
+    :return: x (altered in place)
+    """
+    detach(x)
+    kind = nodeKind(x)
+    borrowed = getattr(x, '_borrowed', False)
+    if kind == PART:
+        if nodeKind(x.tree) == SHIFT:
+            x.tree = materialize(x.tree)
+        elif borrowed and borrows(x, x.tree):
+            x.tree = shareCopy(x.tree)
+    elif kind == SEQ or kind == PAR:
+        trees = x.trees
+        for i in range(len(trees)):
+            if nodeKind(trees[i]) == SHIFT:
+                trees[i] = materialize(trees[i])
+            elif borrowed and borrows(x, trees[i]):
+                trees[i] = shareCopy(trees[i])
+    elif kind == SHIFT:
+        if x.offset != 0 or nodeKind(x.tree) == SHIFT or borrowed:
+            x.tree = materialize(x)
+            x.offset = 0
+    if borrowed:
+        x.__dict__.pop('_borrowed', None)
+    return x
+
+
+def unshareAll(x):
+    """
+    Give every node in x its own private copy, so that anything reached from x
+    by indexing into trees can be altered without affecting other music values
+    (an in-place operation on a subtree only copies what is below it, so a
+    subtree that x borrowed would otherwise be altered in the value it belongs
+    to). Shifts are expanded as well. This copies everything that x borrowed,
+    so it should only be used when it is really needed.
+    :param x: a music value
+    :return: x (altered in place)
+    """
+    stack = [x]
+    while stack:
+        t = stack.pop()
+        unshare(t)
+        kind = nodeKind(t)
+        if kind == SEQ or kind == PAR:
+            stack.extend(t.trees)
+        elif kind == PART or kind == SHIFT:
+            stack.append(t.tree)
+    return x
+
+
+def resolvePath(x, path):
+    """
+    Find the subtree at the end of a path from x, ready to be altered in place
+    as part of x. Along the way, everything that borrowed a node on the path
+    gets a copy of its own (see detach), borrowed nodes on the path are copied,
+    and a Shift on the path is expanded (see materialize) so that the subtree
+    found is the one that is really played, with its onsets. Nothing off the
+    path is copied. This is how searches (select, findBy) give back subtrees
+    that the caller can alter.
+    :param x: the music value that was searched
+    :param path: a (kind, index) step for each node from x down to the subtree,
+                 where kind is the node kind and index is the position of the
+                 next node in its trees (0 for a Part or Shift)
+    :return: the subtree
+    """
+    if len(path) > 0 and nodeKind(x) == SHIFT:
+        unshare(x) # so that the onsets below x are the real ones
+    last = len(path) - 1
+    for j in range(len(path)):
+        kind, i = path[j]
+        k = nodeKind(x)
+        if k != kind:
+            if kind == SHIFT: # already expanded
+                continue
+            raise MusEciException("Path doesn't match the music: " + str(x))
+        detach(x)
+        trees = x.trees if (k == SEQ or k == PAR) else [x.tree]
+        t = trees[i]
+        if nodeKind(t) == SHIFT and j < last:
+            t = materialize(t) # the rest of the path is in the copy (without the Shifts)
+        elif borrows(x, t):
+            t = shareCopy(t)
+        if t is not trees[i]:
+            if k == SEQ or k == PAR:
+                x.trees[i] = t
+            else:
+                x.tree = t
+        x = t
+    return x
+
+
+def materialize(x):
+    """
+    Turn a Shift into an ordinary tree: a private copy of its tree with the
+    offset added to every onset (Shifts inside it are expanded as well, inner
+    offsets first). The Shift itself is not altered.
+    :param x: a Shift
+    :return: the expanded copy
+    """
+    result = [None]
+    stack = [(x.tree, (x.offset,), result, 0)] # (subtree, offsets from outermost, where to put its copy)
+    while stack:
+        t, offsets, dest, i = stack.pop()
+        kind = nodeKind(t)
+        if kind == SHIFT:
+            stack.append((t.tree, offsets + (t.offset,), dest, i))
+            continue
+        if isLeafKind(kind):
+            y = deepcopy(t)
+            if kind != OTHER and y.onset is not None:
+                y.onset = applyOffsets(y.onset, offsets)
+        else:
+            y = copyNode(t)
+            if kind == SEQ or kind == PAR:
+                for j in range(len(y.trees)):
+                    stack.append((y.trees[j], offsets, y.trees, j))
+            elif kind == PART:
+                stack.append((y.tree, offsets, y, None))
+        if i is None:
+            dest.tree = y
+        else:
+            dest[i] = y
+    return result[0]
+
+
+def applyOffsets(onset, offsets):
+    """
+    The onset of a leaf that is inside of Shifts with the given offsets. Inner
+    offsets are added first, so the result is the same as expanding the Shifts.
+    :param onset: an explicit onset
+    :param offsets: offsets of the enclosing Shifts, outermost first
+    :return:
+    """
+    for o in reversed(offsets):
+        onset = onset + o
+    return onset
+
+
+def withOffsets(x, offsets):
+    """
+    What x looks like from outside of Shifts with the given offsets, for
+    traversals that report subtrees without altering anything. With no offsets
+    this is x itself; otherwise it is a private copy of x with the offsets
+    applied to its onsets, so altering it doesn't alter the music it came from.
+    :param x: a music value inside the Shifts
+    :param offsets: offsets of the enclosing Shifts, outermost first
+    :return:
+    """
+    if len(offsets) == 0:
+        return x
+    kind = nodeKind(x)
+    if kind == NOTE or kind == REST:
+        y = _copy.copy(x)
+        if y.onset is not None:
+            y.onset = applyOffsets(y.onset, offsets)
+        return y
+    for o in reversed(offsets):
+        x = Shift(x, o)
+    return materialize(x)
+
+
+def hashCons(x, table=None):
+    """
+    Share structurally identical subtrees. Every subtree of x is looked up in
+    table by its contents; if an identical one was seen before (in x or in
+    anything else hashed with the same table), that one is used instead. The
+    result is equivalent to x, but repeated material is stored only once.
+    Nodes of the result borrow the subtrees that are used more than once, or
+    that are also in x (see borrow), so in-place operations copy them before
+    making any changes. x is not altered,
+    and can still be altered in place without affecting the result (unless
+    nothing in x was repeated, in which case the result is x).
+    :param x: a music value
+    :param table: dictionary of known subtrees; pass the same one to share
+                  subtrees between several music values
+    :return: the hash-consed version of x
+    """
+    if table is None:
+        table = dict()
+    d = None # result for the most recently finished subtree
+    fresh = False # whether d was made by this call and isn't used anywhere else yet
+    stack = [[x, nodeKind(x), 0, [], []]] # frames are [node, kind, next tree index, new trees, borrowed new trees]
+    while stack:
+        frame = stack[-1]
+        x, kind, i, newTrees, borrowed = frame
+        if kind == SEQ or kind == PAR or kind == PART or kind == SHIFT:
+            trees = x.trees if (kind == SEQ or kind == PAR) else [x.tree]
+            if i > 0:
+                newTrees.append(d)
+                if not fresh:
+                    borrowed.append(d)
+            if i < len(trees):
+                frame[2] = i + 1
+                stack.append([trees[i], nodeKind(trees[i]), 0, [], []])
+                continue
+        stack.pop()
+        if isLeafKind(kind):
+            d, fresh = x, True # leaves aren't shared, but their keys are part of their parents' keys
+            continue
+        key = consKey(x, kind, newTrees)
+        if key is not None and key in table:
+            d, fresh = table[key], False
+        else:
+            d, fresh = x, False
+            if kind == SEQ or kind == PAR:
+                if any([newTrees[j] is not x.trees[j] for j in range(len(newTrees))]):
+                    d, fresh = withTrees(x, kind, newTrees, borrowed), True
+            elif newTrees[0] is not x.tree:
+                d, fresh = withTrees(x, kind, newTrees, borrowed), True
+            if key is not None: # otherwise it's not safe to share
+                table[key] = d
+    return d
+
+
+def withTrees(x, kind, newTrees, borrowed):
+    """
+    Copy a node for hashCons, giving the copy newTrees as its children. The copy
+    borrows the ones that are in x or elsewhere in the result as well; its Notes
+    and Rests are copies.
+    :param x: a Seq, Par, Part or Shift
+    :param kind: the node kind of x
+    :param newTrees: the hash-consed children of x
+    :param borrowed: the ones that the copy doesn't own
+    :return: the copy
+    """
+    y = copyNode(x)
+    trees = [deepcopy(t) if isLeafKind(nodeKind(t)) else t for t in newTrees]
+    if kind == SEQ or kind == PAR:
+        y.trees = trees
     else:
-        return deepcopy(obj)
+        y.tree = trees[0]
+    if borrowed:
+        borrow(y, borrowed)
+    return y
+
+
+def consKey(x, kind, newTrees):
+    """
+    The key used by hashCons for a node whose children have already been
+    hash-consed (newTrees). Returns None for things that can't be compared
+    reliably, such as Music (meta information) or values with params.
+    :param x:
+    :param kind:
+    :param newTrees:
+    :return:
+    """
+    if getattr(x, 'params', None) is not None or isinstance(x, Music):
+        return None
+    try:
+        if kind == NOTE:
+            key = (x.__class__, x.pitch, x.dur, x.onset, x.vol)
+        elif kind == REST:
+            key = (x.__class__, x.dur, x.onset)
+        elif kind == SEQ or kind == PAR or kind == PART or kind == SHIFT:
+            children = []
+            for t in newTrees: # the same shared subtree, or equal leaves
+                k = nodeKind(t)
+                childKey = consKey(t, k, None) if isLeafKind(k) else id(t)
+                if childKey is None:
+                    return None
+                children.append(childKey)
+            if kind == SEQ or kind == PAR:
+                key = (x.__class__, getattr(x, 'kind', None), tuple(children))
+            elif kind == PART:
+                inst = None if x.instrument is None else (x.instrument.patch, x.instrument.name)
+                key = (x.__class__, inst, children[0])
+            else:
+                key = (x.__class__, x.offset, children[0])
+        else:
+            return None
+        hash(key)
+    except TypeError: # unhashable values (e.g. MetricalValues)
+        return None
+    return key
+
+
+# =================================================================
+# EDIT LOG
+# Caches for whole subtrees (like MidiWriter's TrackCache) need to know what
+# has been altered in place since they were filled. In-place operations call
+# touch with the root of the subtree they change, which is kept in a short
+# log. Aggregates like dur aren't cached on nodes (see aggregate in
+# BasicOperations), so they are right even after changes made by hand.
+# =================================================================
+
+EDIT_LOG_SIZE = 1024
+editLog = deque(maxlen=EDIT_LOG_SIZE) # (edit number, id of the changed subtree or None if unknown)
+editCount = [0]
+
+
+def touch(node=None):
+    """
+    Record that music has been altered in place. Operations in this library
+    do this themselves; call it directly after changing Notes, Rests or trees
+    by hand, so that caches of whole subtrees (see editsSince) notice.
+    :param node: the root of the subtree that was changed, if there is one
+                 (nothing outside of it may have changed)
+    :return:
+    """
+    editCount[0] += 1
+    editLog.append((editCount[0], None if node is None else id(node)))
+
+
+def editMark():
+    """
+    A stamp for the current point in the edit log, for use with editsSince.
+    :return:
+    """
+    return editCount[0]
+
+
+def editsSince(mark):
+    """
+    Find where music has been changed in place since editMark returned mark.
+    :param mark: a value from editMark
+    :return: a set of ids of the roots of the changed subtrees, or None if
+             some change wasn't given a root (or the log doesn't go back far
+             enough), in which case anything may have changed
+    """
+    if mark == editCount[0]:
+        return set()
+    if len(editLog) == 0 or editLog[0][0] > mark + 1:
+        return None
+    roots = set()
+    for (n, root) in reversed(editLog):
+        if n <= mark:
+            break
+        if root is None:
+            return None
+        roots.add(root)
+    return roots
 
 # ============================================================
 # New things for TRIPS compatibility
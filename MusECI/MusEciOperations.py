@@ -170,13 +170,14 @@ class Repeat(MusEciOp):
     def __repr__(self):
         return str(self)
     def apply(self, musicVal):
+        # The repetitions all share one copy of musicVal, each with its own offset.
+        # The copy is only expanded if one of the repetitions is altered later.
         ms = list()
         offset = 0
         d = basic.durOnset(musicVal)
+        motif = ds.shareCopy(musicVal)
         for i in range (0,self.times):
-            x = deepcopy(musicVal)
-            basic.shiftOnsets(x, offset)
-            ms.append(x)
+            ms.append(ds.borrow(ds.Shift(motif, offset)))
             offset += d
         return ds.Seq(trees=ms, inPlace=True) # in place is allowable here because we are already copying
 
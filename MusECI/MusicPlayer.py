@@ -65,18 +65,17 @@ class MusicPlayer:
         event the CPU gets horribly delayed (so it can be useful for testing).
         """
         self.initialize()
-        mEvs = mev.musicToMEvents(music)                 # convert to note event representation
-        onOffs = mex.mEventsToOnOff(mEvs)                # convert to on-off pairs
-        mex.onOffToRelDur(onOffs)                        # convert durations to relative durs
-        onsetToSeconds(onOffs)                          # convert Euterpea time to seconds
-        patches = mex.eventPatchList(mEvs)               # which Instruments are in use?
-        pmap = mex.linearPatchMap(patches)               # build a patch map
-        for p in pmap:                                  # for each patch that needs to be assigned...
-            if p[0][0] > 0:
-                self.outDev.set_instrument(p[0][0], p[1])      # set instrument for channel (instID, chan)
-        for e in onOffs:                                # for each on/off event...
-            time.sleep(e.eTime)                         # wait until the event should occur
+        mEvs = mev.iterMEvents(music)                   # lazily convert to note event representation
+        pmap = list()                                   # patch map, built up as instruments appear
+        lastTime = 0
+        for e in mex.iterOnOff(mEvs):                   # for each on/off event...
             chanID = findChannel(pmap, e.patch)         # which channel are we on?
+            if chanID < 0:                              # first event for this patch?
+                chanID = mex.addPatch(pmap, e.patch)     # assign it a channel
+                if e.patch[0] > 0:
+                    self.outDev.set_instrument(e.patch[0], chanID) # set instrument for channel (instID, chan)
+            time.sleep((e.eTime - lastTime) * 2)           # wait until the event should occur (1 measure is 2 seconds at 120bpm)
+            lastTime = e.eTime
             if e.eType == mex.ON:                        # turn a note on?
                 self.outDev.note_on(e.pitch, e.vol, chanID)    # need to update channel
             elif e.eType == mex.OFF:                     # turn a note off?
@@ -88,27 +87,27 @@ class MusicPlayer:
         This version of the playback function tries to correct for lost time
         by shifting future events forward in time if the current one gets delayed.
         """
-        mEvs = mex.musicToMEvents(music)             # convert to note event representation
-        onOffs = mex.mEventsToOnOff(mEvs)            # convert to on-off pairs
-        mex.onOffToRelDur(onOffs)                    # convert durations to relative durs
-        onsetToSeconds(onOffs)                      # convert Euterpea time to seconds
-        patches = mex.eventPatchList(mEvs)           # which Instruments are in use?
-        pmap = mex.linearPatchMap(patches)           # build a patch map
-        for p in pmap:                              # for each patch that needs to be assigned...
-            if p[0][0] > 0:
-                self.outDev.set_instrument(p[0][0], p[1])  # set instrument for channel (instID, chan)
+        mEvs = mev.iterMEvents(music)                # lazily convert to note event representation
+        pmap = list()                                # patch map, built up as instruments appear
+        lastTime = 0
         t = time.time()     # get the current time
         tDelta = 0
-        for e in onOffs:    # for each on/off event...
-            # debugging: print 'time, delta:', e.eTime, tDelta, e.eTime - tDelta
-            time.sleep(max(0, e.eTime - tDelta))        # wait until the event should occur, correcting for lateness
+        for e in mex.iterOnOff(mEvs):    # for each on/off event...
             chanID = findChannel(pmap, e.patch)         # which channel are we on?
+            if chanID < 0:                              # first event for this patch?
+                chanID = mex.addPatch(pmap, e.patch)     # assign it a channel
+                if e.patch[0] > 0:
+                    self.outDev.set_instrument(e.patch[0], chanID) # set instrument for channel (instID, chan)
+            eTime = (e.eTime - lastTime) * 2            # seconds since the last event (1 measure is 2 seconds at 120bpm)
+            lastTime = e.eTime
+            # debugging: print 'time, delta:', eTime, tDelta, eTime - tDelta
+            time.sleep(max(0, eTime - tDelta))          # wait until the event should occur, correcting for lateness
             if e.eType == mex.ON:                        # turn a note on?
                 self.outDev.note_on(e.pitch, e.vol, chanID)    # need to update channel
             elif e.eType == mex.OFF:                     # turn a note off?
                 self.outDev.note_off(e.pitch, e.vol, chanID)   # need to update channel
             tActual = time.time() - t                   # how long did we actually sleep?
-            tDelta = tActual - e.eTime  # max(0, tActual - e.eTime) # if we slept too long, speed up the next event
+            tDelta = tActual - eTime  # max(0, tActual - eTime) # if we slept too long, speed up the next event
             t = time.time()                             # update our last timestamp
 
 
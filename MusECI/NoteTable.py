@@ -0,0 +1,186 @@
+'''
+Columnar note storage for flat scores.
+
+A NoteTable holds the same information as a list of MEvents (onset, pitch,
+duration, volume and patch), but keeps each field in its own contiguous NumPy
+array. This is much more compact than a tree of Note objects and lets common
+operations like transposition run as a single vectorized step instead of a
+Python callback per Note.
+
+NumPy is required for this module only. Nothing else in MusECI imports it, so
+the rest of the package still works without NumPy installed.
+'''
+
+import numpy as np
+from MusECI.MusEciDataStructures import Note, Par, Part, Music, Instrument, INST
+from MusECI.MEvent import MEvent, musicToMEvents
+import MusECI.MidiConversion as mc
+
+
+class NoteTable:
+    """
+    A flat, column-oriented collection of notes. Columns:
+     - pitch: MIDI pitch number (int64)
+     - onset: absolute start time in Euterpean units, 0.25 = QN (float64)
+     - dur: duration in Euterpean units (float64)
+     - vol: volume (float64, since scaleVolume can produce fractional values)
+     - patch: patch/instrument number, -1 for none (int16)
+     - perc: whether the patch is a percussion patch (bool)
+    All columns always have the same length.
+    """
+    def __init__(self, pitch=(), onset=(), dur=(), vol=(), patch=(), perc=()):
+        self.pitch = np.array(pitch, dtype=np.int64)
+        self.onset = np.array(onset, dtype=np.float64)
+        self.dur = np.array(dur, dtype=np.float64)
+        self.vol = np.array(vol, dtype=np.float64)
+        self.patch = np.array(patch, dtype=np.int16)
+        self.perc = np.array(perc, dtype=bool)
+        n = len(self.pitch)
+        for col in [self.onset, self.dur, self.vol, self.patch, self.perc]:
+            if len(col) != n:
+                raise ValueError("All NoteTable columns must have the same length.")
+
+    def __len__(self):
+        return len(self.pitch)
+
+    def __str__(self):
+        return "NoteTable(" + str(len(self)) + " notes)"
+
+    def __repr__(self):
+        return str(self)
+
+    def copy(self):
+        return NoteTable(self.pitch, self.onset, self.dur, self.vol, self.patch, self.perc)
+
+    # =================================================================
+    # CONVERSION
+    # =================================================================
+
+    @staticmethod
+    def fromMEvents(mevs):
+        '''
+        Build a NoteTable from a list of MEvents.
+        :param mevs:
+        :return:
+        '''
+        return NoteTable([e.pitch for e in mevs], [e.eTime for e in mevs], [e.dur for e in mevs],
+                         [e.vol for e in mevs], [e.patch[0] for e in mevs], [e.patch[1] for e in mevs])
+
+    @staticmethod
+    def fromMusic(music):
+        '''
+        Build a NoteTable from a music structure. Rests are not stored, since
+        they don't produce any events.
+        :param music:
+        :return:
+        '''
+        return NoteTable.fromMEvents(musicToMEvents(music))
+
+    def toMEvents(self):
+        '''
+        Convert back to a list of MEvents in table order.
+        :return:
+        '''
+        vols = [toNumber(v) for v in self.vol.tolist()]
+        patches = list(zip(self.patch.tolist(), self.perc.tolist()))
+        return [MEvent(o, p, d, v, pt) for (o, p, d, v, pt) in
+                zip(self.onset.tolist(), self.pitch.tolist(), self.dur.tolist(), vols, patches)]
+
+    def toMusic(self):
+        '''
+        Convert back to a Music value. There is one Part per distinct patch, in
+        order of first appearance, and every Note carries its onset. Converting
+        the result with musicToMEvents gives back the same events.
+        :return:
+        '''
+        parts = []
+        for (patchNum, isPerc) in self.patchList():
+            inds = np.nonzero((self.patch == patchNum) & (self.perc == isPerc))[0]
+            notes = [Note(p, d, o, toNumber(v)) for (p, d, o, v) in
+                     zip(self.pitch[inds].tolist(), self.dur[inds].tolist(),
+                         self.onset[inds].tolist(), self.vol[inds].tolist())]
+            parts.append(Part(Par(notes, inPlace=True), Instrument(patchNum, isPerc)))
+        return Music(parts, inPlace=True)
+
+    def toTicks(self, resolution=None):
+        '''
+        Quantize every onset and note end to MIDI ticks in one step. Rounding is
+        to the nearest tick, with halves going to even (like round in toMidiTick).
+        Times are rounded from the start of the piece rather than from the event
+        before, so rounding errors don't add up.
+        :param resolution: ticks per quarter note (None for MidiConversion.RESOLUTION)
+        :return: a tuple of on ticks, off ticks (both int64 arrays in table order)
+                 and the largest rounding error, in Euterpean time (0.25 = QN)
+        '''
+        if resolution is None:
+            resolution = mc.RESOLUTION
+        scale = resolution * 4
+        on = self.onset * scale
+        off = (self.onset + self.dur) * scale
+        onTicks = np.rint(on)
+        offTicks = np.rint(off)
+        maxError = 0.0
+        if len(self) > 0:
+            maxError = float(max(np.abs(onTicks - on).max(), np.abs(offTicks - off).max())) / scale
+        return onTicks.astype(np.int64), offTicks.astype(np.int64), maxError
+
+    def patchList(self):
+        '''
+        List of distinct (patch, isPercussion) pairs in order of first appearance.
+        :return:
+        '''
+        seen = dict()
+        for key in zip(self.patch.tolist(), self.perc.tolist()):
+            if key not in seen:
+                seen[key] = True
+        return list(seen.keys())
+
+    def sortByOnset(self):
+        '''
+        Reorder all columns by onset. The sort is stable, so notes with equal
+        onsets keep their relative order (matching musicToMEvents).
+        :return:
+        '''
+        order = np.argsort(self.onset, kind='stable')
+        self.pitch = self.pitch[order]
+        self.onset = self.onset[order]
+        self.dur = self.dur[order]
+        self.vol = self.vol[order]
+        self.patch = self.patch[order]
+        self.perc = self.perc[order]
+
+    # =================================================================
+    # VECTORIZED OPERATIONS
+    # These mirror the functions of the same name in BasicOperations and,
+    # like them, alter the table in place.
+    # =================================================================
+
+    def transpose(self, amount):
+        self.pitch += amount
+
+    def invertAt(self, pitchRef):
+        self.pitch = 2 * pitchRef - self.pitch
+
+    def setVolume(self, volume):
+        self.vol[:] = volume
+
+    def scaleVolume(self, factor):
+        self.vol *= factor
+
+    def scaleDurations(self, factor):
+        self.dur *= factor
+
+    def shiftOnsets(self, shiftAmt):
+        self.onset += shiftAmt
+
+
+def toNumber(value):
+    '''
+    Give back whole-number floats as ints so that volumes survive a round trip
+    through the float column unchanged.
+    :param value:
+    :return:
+    '''
+    if value.is_integer():
+        return int(value)
+    return value
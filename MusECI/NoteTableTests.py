@@ -0,0 +1,93 @@
+# Testing NoteTable against the tree versions: conversions are checked against
+# musicToMEvents, and each vectorized operation against the BasicOperations
+# function of the same name.
+# Run from the repository root with: python -m MusECI.NoteTableTests
+
+from copy import deepcopy
+from MusECI.MusEciDataStructures import *
+import MusECI.BasicOperations as basic
+import MusECI.MEvent as me
+from MusECI.NoteTable import NoteTable
+
+
+def eventFields(mevs):
+    return [(e.eTime, e.pitch, e.dur, e.vol, e.patch) for e in mevs]
+
+
+def makeMusic():
+    melody = Seq([Note(60, QN, vol=90), Note(62, EN), Rest(EN), Note(64, HN, vol=75)], inPlace=True)
+    chords = Seq([Par([Note(48, WN), Note(55, WN, vol=64)], inPlace=True),
+                  Par([Note(50, HN), Seq([Note(57, QN), Note(59, 1/5)], inPlace=True)], inPlace=True)], inPlace=True)
+    drums = Seq([Note(36, QN), Note(38, QN), Rest(QN), Note(42, EN), Note(42, EN)], inPlace=True)
+    return Music([Part(melody, Instrument(0)), Part(chords, Instrument(32)), Part(drums, Instrument(0, True)),
+                  Seq([Note(72, QN), Note(71, QN)], inPlace=True)], inPlace=True)
+
+
+# Conversions
+music = makeMusic()
+events = me.musicToMEvents(music)
+table = NoteTable.fromMusic(music)
+assert len(table) == len(events) == 14
+assert eventFields(table.toMEvents()) == eventFields(events)
+assert eventFields(NoteTable.fromMEvents(events).toMEvents()) == eventFields(events)
+assert [type(e.vol) for e in table.toMEvents()] == [type(e.vol) for e in events]
+assert table.patchList() == [(0, False), (32, False), (0, True), (-1, False)]
+assert eventFields(me.musicToMEvents(table.toMusic())) == eventFields(events)
+assert eventFields(NoteTable.fromMusic(table.toMusic()).toMEvents()) == eventFields(events)
+empty = NoteTable.fromMusic(Rest(WN))
+assert len(empty) == 0 and empty.toMEvents() == [] and empty.patchList() == []
+try:
+    NoteTable([60, 62], [0, 0.25], [QN], [100, 100], [0, 0], [False, False])
+    assert False, "columns of different lengths"
+except ValueError:
+    pass
+print("conversions: ok")
+
+# sortByOnset is stable, like the sort in musicToMEvents
+shuffled = NoteTable.fromMEvents(list(reversed(events)))
+shuffled.sortByOnset()
+assert eventFields(shuffled.toMEvents()) == eventFields(sorted(reversed(events), key=lambda e: e.eTime))
+print("sortByOnset: ok")
+
+# Vectorized operations match the tree operations
+def treeOp(f):
+    x = makeMusic()
+    f(x)
+    return eventFields(me.musicToMEvents(x))
+
+def tableOp(f):
+    t = NoteTable.fromMusic(makeMusic())
+    f(t)
+    return eventFields(t.toMEvents())
+
+# Table onsets are absolute, so the tree needs explicit onsets wherever an
+# operation would otherwise move later notes
+ops = [("transpose", lambda x: basic.transpose(x, 7), lambda t: t.transpose(7)),
+       ("invertAt", lambda x: basic.invertAt(x, 60), lambda t: t.invertAt(60)),
+       ("setVolume", lambda x: basic.setVolume(x, 80), lambda t: t.setVolume(80)),
+       ("scaleVolume", lambda x: basic.scaleVolume(x, 0.5), lambda t: t.scaleVolume(0.5)),
+       ("scaleDurations", lambda x: (basic.deriveOnsets(x), basic.scaleDurations(x, 2)), lambda t: t.scaleDurations(2)),
+       ("shiftOnsets", lambda x: (basic.deriveOnsets(x), basic.shiftOnsets(x, 0.5)), lambda t: t.shiftOnsets(0.5))]
+for (name, f, g) in ops:
+    assert tableOp(g) == treeOp(f), name
+original = NoteTable.fromMusic(makeMusic())
+changed = original.copy()
+changed.transpose(1)
+assert original.pitch.tolist() == [e.pitch for e in events]
+print("operations: ok")
+
+# Quantizing to ticks in one step matches rounding each event
+import MusECI.MidiConversion as mc
+music = makeMusic()
+table = NoteTable.fromMusic(music)
+events = me.musicToMEvents(music)
+errors = dict()
+for resolution in [None, 96, 480, 1000]:
+    onTicks, offTicks, errors[resolution] = table.toTicks(resolution)
+    r = mc.RESOLUTION if resolution is None else resolution
+    assert onTicks.tolist() == [round(e.eTime * r * 4) for e in events]
+    assert offTicks.tolist() == [round((e.eTime + e.dur) * r * 4) for e in events]
+    worst = max([abs(t / (r * 4) - o) for (t, o) in zip(onTicks.tolist(), table.onset.tolist())])
+    assert worst <= errors[resolution] + 1e-12
+assert errors[96] > 1e-4 and errors[1000] < 1e-12 and errors[480] < errors[96]
+print("toTicks: ok (largest rounding error {0:.2e} at 96, {1:.2e} at 480)".format(errors[96], errors[480]))
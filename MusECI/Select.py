@@ -2,29 +2,31 @@ from MusECI.MusEciDataStructures import *
 import MusECI.BasicOperations as basic
 import inspect
 
-def compare(queryVal, targetVal):
+def compare(queryVal, targetVal, offsets=()):
+    # offsets are those of the Shifts around targetVal (see applyOffsets)
     if queryVal==None:
         return True
     elif sameClass(queryVal, targetVal):
-        if targetVal.__class__.__name__=="Note":
+        kind = nodeKind(targetVal)
+        if kind == NOTE:
             if compareVals(queryVal.pitch, targetVal.pitch):
                 if compareVals(queryVal.dur, targetVal.dur):
                     if compareVals(queryVal.vol, targetVal.vol):
-                        if compareVals(queryVal.onset, targetVal.onset):
+                        if compareVals(queryVal.onset, shiftedOnset(targetVal, offsets)):
                             if compareParams(queryVal.params, targetVal.params):
                                 return True
             return False
-        elif targetVal.__class__.__name__=="Rest":
+        elif kind == REST:
             if compareVals(queryVal.dur, targetVal.dur):
-                if compareVals(queryVal.onset, targetVal.onset):
+                if compareVals(queryVal.onset, shiftedOnset(targetVal, offsets)):
                     if compareParams(queryVal.params, targetVal.params):
                         return True
             return False
-        elif targetVal.__class__.__name__=="Seq" or targetVal.__class__.__name__=="Par":
+        elif kind == SEQ or kind == PAR: # including Music
             if compareParams(queryVal.params, targetVal.params):
                 if len(queryVal.trees) == len(targetVal.trees):
                     for i in range(0, len(targetVal.trees)):
-                        if not(compare(queryVal.trees[i], targetVal.trees[i])):
+                        if not(compare(queryVal.trees[i], targetVal.trees[i], offsets)):
                             return False
                     return True
             return False
@@ -33,15 +35,24 @@ def compare(queryVal, targetVal):
         #        if compareVals(queryVal.mod, targetVal.mod):
         #            return compare(queryVal.tree, targetVal.tree)
         #    return False
-        elif targetVal.__class__.__name__=="Music":
-            if compareParams(queryVal.params, targetVal.params):
-                if compareVals(queryVal.bpm, targetVal.bpm):
-                    return compare(queryVal.tree, targetVal.tree)
+        elif kind == PART:
+            if compareVals(queryVal.instrument, targetVal.instrument):
+                return compare(queryVal.tree, targetVal.tree, offsets)
+            return False
+        elif kind == SHIFT:
+            if compareVals(queryVal.offset, targetVal.offset):
+                return compare(queryVal.tree, targetVal.tree, offsets)
+            return False
         else:
             raise MusEciException("Unknown class: "+targetVal.__class__.__name__)
     else:
         return False
 
+def shiftedOnset(x, offsets):
+    if x.onset is None or len(offsets) == 0:
+        return x.onset
+    return applyOffsets(x.onset, offsets)
+
 def compareVals(query, target):
     if inspect.isfunction(query):
         return query(target)
@@ -59,28 +70,36 @@ def select(query, target):
     '''
     Looks for matching parts of a Music structure. If a subtree matches completely, it is appended whole and
     not recursively checked. This means that if a chord matches, its individual notes do NOT appear elsewhere
-    in the returned list.
+    in the returned list. Onsets inside a Shift are compared with the offset applied. The matches belong to the
+    target, so altering them in place alters the target (and nothing else): subtrees it shares with other music
+    are copied, and Shifts are expanded, along the way to each match (see resolvePath).
     :param query:
     :param target:
     :return:
     '''
-    retVals = []
-    if target.__class__.__name__=="Note" or target.__class__.__name__=="Rest":
-        if compare(query, target):
-            retVals.append(target)
-    elif target.__class__.__name__=="Seq" or target.__class__.__name__=="Par":
-        if compare(query, target):
-            retVals.append(target)
-        else:
-            for t in target.trees:
-                retVals = retVals + select(query, t)
-    elif target.__class__.__name__=="Music": # of target.__class__.__name__=="Modify"
-        if compare(query, target):
-            retVals.append(target)
-        else:
-            for t in target.tree:
-                retVals = retVals + select(query, t)
-    else:
-        raise MusEciException("Unknown class: "+target.__class__.__name__)
-    return retVals
+    paths = []
+    search(query, target, (), [], paths)
+    return [resolvePath(target, path) for path in paths]
 
+
+def search(query, target, offsets, path, paths):
+    # adds the paths (see resolvePath) to the matches in target to paths, without altering anything;
+    # offsets are those of the Shifts around target, and path is the one to target
+    kind = nodeKind(target)
+    if compare(query, target, offsets):
+        paths.append(tuple(path))
+    elif kind == SEQ or kind == PAR: # including Music
+        for i in range(len(target.trees)):
+            path.append((kind, i))
+            search(query, target.trees[i], offsets, path, paths)
+            path.pop()
+    elif kind == PART: # formerly Modify
+        path.append((kind, 0))
+        search(query, target.tree, offsets, path, paths)
+        path.pop()
+    elif kind == SHIFT:
+        path.append((kind, 0))
+        search(query, target.tree, offsets + (target.offset,), path, paths)
+        path.pop()
+    elif kind != NOTE and kind != REST:
+        raise MusEciException("Unknown class: "+target.__class__.__name__)
@@ -0,0 +1,231 @@
+# Testing shared subtrees: Shift, Repeat and hashCons. Every check compares
+# against the same music built with ordinary (unshared) copies.
+# Run from the repository root with: python -m MusECI.SharingTests
+
+from copy import deepcopy
+from MusECI.MusEciDataStructures import *
+import MusECI.BasicOperations as basic
+import MusECI.MusEciOperations as op
+import MusECI.MEvent as me
+import MusECI.Select as sel
+
+
+def eventFields(mevs):
+    return [(e.eTime, e.pitch, e.dur, e.vol, e.patch) for e in mevs]
+
+
+def unsharedRepeat(x, n):
+    # how Repeat used to work: n deep copies with shifted onsets
+    ms = list()
+    offset = 0
+    d = basic.durOnset(x)
+    for i in range(n):
+        y = deepcopy(x)
+        basic.shiftOnsets(y, offset)
+        ms.append(y)
+        offset += d
+    return Seq(ms, inPlace=True)
+
+
+def check(x, y, label):
+    assert eventFields(me.musicToMEvents(x)) == eventFields(me.musicToMEvents(y)), label + ": events"
+    assert eventFields(me.iterMEvents(x)) == eventFields(me.musicToMEvents(y)), label + ": lazy events"
+    assert basic.dur(x) == basic.dur(y), label + ": dur"
+    assert basic.onsetSpan(x) == basic.onsetSpan(y), label + ": onsetSpan"
+    assert basic.pitchRange(x) == basic.pitchRange(y), label + ": pitchRange"
+    assert basic.getOnsets(x) == basic.getOnsets(y), label + ": onsets"
+    print(label + ": ok")
+
+
+def makeMusic():
+    m1 = Seq([Note(60, QN), Note(62, EN), Rest(EN), Note(64, HN)], inPlace=True)
+    m2 = Par([Note(48, WN), Seq([Note(55, QN), Note(57, 1/3)], inPlace=True)], inPlace=True)
+    x = Seq([Part(m1, Instrument(0)), m2], inPlace=True)
+    basic.deriveOnsets(x)
+    return x
+
+
+# Repeat shares one copy of its input
+x = makeMusic()
+y = op.Repeat(4).apply(x)
+z = unsharedRepeat(x, 4)
+check(y, z, "Repeat")
+assert all([isinstance(t, Shift) and t.tree is y.trees[0].tree for t in y.trees])
+assert y.trees[0].tree is not x # ...but not the input itself
+basic.transpose(x, 1)
+check(y, z, "Repeat after changing its input")
+
+# Altering one repetition leaves the others alone
+basic.transpose(y.trees[2], 5)
+basic.transpose(z.trees[2], 5)
+check(y, z, "transpose one repetition")
+assert y.trees[2].offset == 0 and y.trees[2].tree is not y.trees[1].tree
+y = op.Repeat(4).apply(makeMusic())
+z = unsharedRepeat(makeMusic(), 4)
+basic.scaleDurations(y.trees[1], 2)
+basic.scaleDurations(z.trees[1], 2)
+check(y, z, "scaleDurations one repetition")
+basic.transpose(y, -12)
+basic.transpose(z, -12)
+check(y, z, "transpose everything")
+found = sel.select(Note(None, WN), y)
+assert [n.onset for n in found] == [n.onset for n in sel.select(Note(None, WN), z)]
+print("select: ok")
+
+# Repeats of repeats, and Shifts inside Shifts
+w = op.Repeat(3).apply(op.Repeat(2).apply(makeMusic()))
+v = unsharedRepeat(unsharedRepeat(makeMusic(), 2), 3)
+check(w, v, "nested Repeat")
+u = deepcopy(v)
+basic.shiftOnsets(u, 0.5)
+check(materialize(Shift(w, 0.5)), u, "materialize")
+before = [(id(t), t._borrowed, t._borrowers) for t in w.trees + [w.trees[0].tree]]
+f = basic.flatten(w)
+check(f, v, "flatten")
+assert [(id(t), t._borrowed, t._borrowers) for t in w.trees + [w.trees[0].tree]] == before
+basic.transpose(f, 1)
+check(w, v, "flatten leaves its input alone")
+assert basic.flatten(Seq([Seq([Note(60, QN)], inPlace=True)], inPlace=True)).pitch == 60
+check(me.applyTempo(w, 2.0), me.applyTempo(v, 2.0), "applyTempo")
+
+# Hash-consing finds repeated material by itself
+def bar(i):
+    return Seq([Note(60 + i, EN), Note(64 + i, EN), Note(67 + i, QN), Rest(HN)], inPlace=True)
+
+x = Seq([Part(Seq([bar(i % 2) for i in range(32)], inPlace=True), Instrument(0)),
+         Par([bar(0), bar(0), Rest(WN)], inPlace=True)], inPlace=True)
+y = hashCons(x)
+check(y, x, "hashCons")
+part = y.trees[0].tree
+assert part.trees[0] is part.trees[2] and part.trees[1] is part.trees[3] and part.trees[0] is not part.trees[1]
+assert y.trees[1].trees[0] is part.trees[0]
+basic.transpose(y.trees[1], 12)
+basic.transpose(x.trees[1], 12)
+check(y, x, "hashCons, then transpose")
+assert part.trees[0].trees[0].pitch == 60
+
+# Onsets make otherwise equal bars different
+x = Seq([bar(0), bar(0)], inPlace=True)
+basic.deriveOnsets(x)
+y = hashCons(x)
+assert y.trees[0] is not y.trees[1]
+check(y, x, "hashCons with onsets")
+
+# Values that share structure can be altered independently, through any node
+def pitches(x):
+    return [e.pitch for e in me.musicToMEvents(x)]
+
+a = Seq([Note(60, QN), Note(62, QN)], inPlace=True)
+b = Seq([a])
+basic.transpose(b.trees[0].trees[0], 12)
+assert pitches(a) == [60, 62] and pitches(b) == [72, 62]
+for n in sel.select(Note(62, None), b):
+    basic.transpose(n, 12)
+assert pitches(a) == [60, 62] and pitches(b) == [72, 74]
+basic.transpose(b, -12)
+basic.transpose(a, -2)
+assert pitches(a) == [58, 60] and pitches(b) == [60, 62]
+t = basic.times(a, 3)
+t.trees[1].trees[0].forceMIDICompatible()
+basic.transpose(t.trees[1], 5)
+assert pitches(a) == [58, 60] and pitches(t) == [58, 60, 63, 65, 58, 60]
+a = Seq([Seq([Note(60, QN), Note(62, QN)], inPlace=True)], inPlace=True)
+b = Seq([a, a])
+basic.transpose(a, 1)
+assert pitches(a) == [61, 63] and pitches(b) == [60, 62, 60, 62]
+basic.transpose(b.trees[1], 2)
+basic.reverseInPlace(b.trees[0])
+assert pitches(a) == [61, 63] and pitches(b) == [62, 60, 62, 64]
+c = deepcopy(b)
+basic.transpose(b, 1)
+assert pitches(c) == [62, 60, 62, 64] and pitches(b) == [63, 61, 63, 65]
+r = deepcopy(op.Repeat(3).apply(Note(60, QN, onset=0)))
+basic.transpose(r.trees[0], 1)
+assert pitches(r) == [61, 60, 60]
+print("shared nodes: ok")
+
+# Building scores from values and then changing those values, as in Examples.py
+def expected(x):
+    return eventFields(me.musicToMEvents(x))
+
+x1 = Seq([Note(60, EN), Note(67, EN), Note(72, EN), Note(79, EN)])
+basic.deriveOnsets(x1)
+m1 = Music([Part(x1)])
+x2 = op.CombineSeq().apply([x1, op.Transpose(3).apply(x1)])
+x3 = op.CombineSeq().apply([x2, x2, op.Invert().apply(x1), op.Transpose(3).apply(op.Invert().apply(x1)),
+                            op.Retrograde().apply(x2)])
+x4 = Music([Part(op.CombineSeq().apply([x3] * 3)), Part(op.Repeat(2).apply(x2))])
+scores = [m1, x2, x3, x4]
+before = [expected(m) for m in scores]
+basic.transpose(x1, 2)
+basic.deriveOnsets(x1)
+x1.trees.append(Note(84, EN))
+assert pitches(x1) == [62, 69, 74, 81, 84]
+assert [expected(m) for m in scores[1:]] == before[1:] and expected(m1) == before[0]
+basic.scaleDurations(x2, 2)
+basic.deriveOnsets(x2)
+assert [expected(m) for m in scores[2:]] == before[2:]
+basic.reverseInPlace(x3)
+basic.transpose(x3, 7)
+assert expected(x4) == before[3] and expected(x3) != before[2]
+for m in scores:
+    basic.deriveOnsets(m)
+    basic.transpose(m, 1)
+assert expected(m1) == [e[:1] + (e[1] + 1,) + e[2:] for e in before[0]]
+assert [p - 1 for p in pitches(x4)] == [e[1] for e in before[3]]
+print("editing values after building scores: ok")
+
+# Folding doesn't alter anything, even inside Shifts
+y = op.Repeat(3).apply(makeMusic())
+z = unsharedRepeat(makeMusic(), 3)
+offsets = [t.offset for t in y.trees]
+assert basic.mFold(y, lambda n: [n.onset], lambda r: [], lambda vs: sum(vs, []), lambda vs: sum(vs, []), None) == \
+    basic.mFold(z, lambda n: [n.onset], lambda r: [], lambda vs: sum(vs, []), lambda vs: sum(vs, []), None)
+assert all([isinstance(t, Shift) for t in y.trees]) and [t.offset for t in y.trees] == offsets
+check(y, z, "mFold leaves Shifts alone")
+
+# What select finds belongs to the target, even inside Shifts and below shared nodes
+found = sel.select(Note(None, WN), y)
+assert [n.onset for n in found] == [n.onset for n in sel.select(Note(None, WN), z)]
+basic.transpose(found[1], 1)
+basic.transpose(sel.select(Note(None, WN), z)[1], 1)
+check(y, z, "select inside Shifts, then transpose")
+a = Seq([Seq([Note(60, QN), Note(62, QN)], inPlace=True)], inPlace=True)
+b = Seq([a])
+found = sel.select(Note(62, None), b)
+assert len(found) == 1
+basic.transpose(found[0], 12)
+assert pitches(a) == [60, 62] and pitches(b) == [60, 74]
+basic.transpose(sel.select(Note(60, None), a)[0], 1)
+assert pitches(a) == [61, 62] and pitches(b) == [60, 74]
+x = Seq([bar(0), bar(1), bar(0), bar(0)], inPlace=True)
+y = hashCons(x)
+for v in [x, y]:
+    for n in sel.select(Note(60, None), v)[1:]:
+        basic.transpose(n, 2)
+check(y, x, "select below nodes shared within the target, then transpose")
+y = op.Repeat(3).apply(makeMusic())
+z = unsharedRepeat(makeMusic(), 3)
+isWhole = lambda v: isinstance(v, Note) and v.dur == WN
+found = basic.findBy(isWhole, y)
+assert [n.onset for n in found] == [n.onset for n in basic.findBy(isWhole, z)] == \
+    [n.onset for n in sel.select(Note(None, WN), z)]
+basic.transpose(found[2], 1)
+basic.transpose(basic.findBy(isWhole, z)[2], 1)
+check(y, z, "findBy inside Shifts, then transpose")
+assert [t.offset for t in basic.findBy(lambda v: isinstance(v, Shift), op.Repeat(2).apply(makeMusic()))] == [0, 2]
+a = Seq([Seq([Note(60, QN), Note(62, QN)], inPlace=True)], inPlace=True)
+b = Seq([a])
+fields = [sorted(n.__dict__.keys()) for n in [a, a.trees[0]]]
+found = basic.findBy(lambda v: isinstance(v, Note) and v.pitch == 62, b)
+assert len(found) == 1 and found[0].pitch == 62
+assert [sorted(n.__dict__.keys()) for n in [a, a.trees[0]]] == fields
+basic.transpose(found[0], 12)
+assert pitches(a) == [60, 62] and pitches(b) == [60, 74]
+print("searching: ok")
+
+# Star imports leave the copy module alone
+import copy
+from MusECI.BasicOperations import *
+assert copy.deepcopy(Note(60)).pitch == 60 and copy.copy(Seq([])).trees == []
+print("copy module: ok")
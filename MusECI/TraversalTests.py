@@ -0,0 +1,102 @@
+# Testing traversals on very deep trees. The tree walkers used to be recursive,
+# so anything nested more deeply than Python's recursion limit would crash.
+# Run from the repository root with: python -m MusECI.TraversalTests [depth]
+
+import os
+import sys
+import tempfile
+from MusECI.MusEciDataStructures import *
+from MusECI.BasicOperations import dur, deriveOnsets, transpose, flatten, mMapAllRet, line
+from MusECI.MidiWriter import musicToMidi
+import MusECI.MEvent as me
+import MusECI.MidiConversion as mc
+import MusECI.MidiReader as mr
+
+
+def deepSeq(depth):
+    '''
+    Build a right-nested Seq: Seq([n1, Seq([n2, Seq([n3, ...])])])
+    :param depth: number of nested Seq nodes
+    :return:
+    '''
+    x = Note(60, SN)
+    for i in range(depth):
+        x = Seq([Note(60 + i % 12, SN), x], inPlace=True)
+    return x
+
+
+def eventTuples(mevs):
+    return sorted([(round(e.eTime, 6), e.pitch, round(e.dur, 6)) for e in mevs])
+
+
+def eventFields(mevs):
+    return [(e.eTime, e.pitch, e.dur, e.vol, e.patch) for e in mevs]
+
+
+def onOffFields(onOffs):
+    return [(e.eTime, e.eType, e.pitch, e.vol, e.patch) for e in onOffs]
+
+
+def walkTest(depth=100000):
+    # Walking a tree much deeper than the recursion limit
+    x = deepSeq(depth)
+    assert depth > sys.getrecursionlimit()
+    assert dur(x) == (depth + 1) * SN
+    deriveOnsets(x)
+    transpose(x, 2)
+    notes = mMapAllRet(lambda n: n if isinstance(n, Note) else None, x)
+    notes = [n for n in notes if n is not None]
+    assert len(notes) == depth + 1
+    assert notes[-1].onset == depth * SN
+    mevs = me.musicToMEvents(x)
+    assert len(mevs) == depth + 1
+    assert mevs[-1].eTime == depth * SN
+    assert dur(flatten(x)) == dur(x)
+    assert eventFields(me.iterMEvents(x)) == eventFields(mevs)
+    print("Walked a tree of depth "+str(depth)+": ok")
+
+
+def lazyTest():
+    # Lazy event generation must give the same events, in the same order, as
+    # the list-based functions. Ties and explicit onsets are the tricky parts.
+    m1 = Seq([Note(60, QN), Par([Note(64, EN), Seq([Rest(SN), Note(67, EN)])]), Note(72, HN)])
+    m2 = Par([Seq([Note(50, QN), Note(52, QN, onset=0.1)]), Note(55, EN), Part(line([Note(40, EN), Note(41, QN)]), Instrument(32))])
+    m3 = Music([Part(m1, Instrument(0)), Part(m2, Instrument(0, PERC)), Seq([Note(70, QN), Rest(0), Seq([])])])
+    for m in [m1, m2, m3, Note(60), Rest(QN), Seq([])]:
+        mevs = me.musicToMEvents(m)
+        assert eventFields(me.iterMEvents(m)) == eventFields(mevs)
+        assert onOffFields(mc.iterOnOff(mevs)) == onOffFields(mc.mEventsToOnOff(mevs))
+    # Messages at equal times keep the order of the MEvents, even if those
+    # aren't in time order
+    mevs = [me.MEvent(0.5, 64, 0, 100, (0, INST)), me.MEvent(0, 60, 0.5, 100, (0, INST)),
+            me.MEvent(0.5, 60, 0.25, 90, (0, INST)), me.MEvent(0, 67, 0.5, 80, (0, INST))]
+    assert [(e.eTime, e.eType, e.pitch) for e in mc.mEventsToOnOff(mevs)] == \
+        [(0, mc.ON, 60), (0, mc.ON, 67), (0.5, mc.ON, 64), (0.5, mc.OFF, 64), (0.5, mc.OFF, 60),
+         (0.5, mc.ON, 60), (0.5, mc.OFF, 67), (0.75, mc.OFF, 60)]
+    pmap = []
+    for p in [(0, False), (9, True)] + [(i, False) for i in range(1, 14)]:
+        mc.addPatch(pmap, p)
+    assert sorted(pmap, key=lambda p: p[1]) == mc.linearPatchMap([p for (p, c) in pmap])
+    print("Lazy events: ok")
+
+
+def midiRoundTripTest(depth=100000):
+    # Round trip through a MIDI file
+    x = deepSeq(depth)
+    before = eventTuples(me.musicToMEvents(x))
+    fd, path = tempfile.mkstemp(suffix=".mid")
+    os.close(fd)
+    try:
+        musicToMidi(path, x, partTracks=False)
+        after = eventTuples(me.musicToMEvents(mr.midiToMusic(path)))
+    finally:
+        os.remove(path)
+    assert before == after
+    print("MIDI round trip of a tree of depth "+str(depth)+": ok")
+
+
+if __name__ == "__main__":
+    depth = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    walkTest(depth)
+    lazyTest()
+    midiRoundTripTest(depth)
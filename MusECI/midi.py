@@ -21,38 +21,35 @@ def showstr(tmpstr, n=16):
     for x in tmpstr[:n]: 
         print(('%02x' % x), end=' ') 
     print() 
-def getNumber(tmpstr, length): 
-    # MIDI uses big-endian for everything 
+def getNumber(data, pos, length): 
+    # MIDI uses big-endian for everything. data can be bytes, a bytearray, a
+    # memoryview or an mmap; the number starts at data[pos]. Returns the number
+    # and the position after it (nothing is copied).
     sum = 0 
-    for i in range(length): 
-        sum = (sum << 8) + tmpstr[i] 
-    return sum, tmpstr[length:] 
-def getVariableLengthNumber(tmpstr): 
+    for i in range(pos, pos + length): 
+        sum = (sum << 8) + data[i] 
+    return sum, pos + length
+def getVariableLengthNumber(data, pos): 
     sum = 0 
-    i = 0 
     while 1: 
-        x = tmpstr[i] 
-        i = i + 1 
+        x = data[pos] 
+        pos = pos + 1 
         sum = (sum << 7) + (x & 0x7F) 
         if not (x & 0x80): 
-            return sum, tmpstr[i:] 
+            return sum, pos
 def putNumber(num, length): 
     # MIDI uses big-endian for everything 
-    lst = [ ] 
-    for i in range(length): 
-        n = 8 * (length - 1 - i) 
-        lst.append(chr((num >> n) & 0xFF)) 
-    return str([lst, ""]) 
+    return bytes([(num >> (8 * (length - 1 - i))) & 0xFF for i in range(length)])
 def putVariableLengthNumber(x): 
     lst = [ ] 
     while 1: 
         y, x = x & 0x7F, x >> 7 
-        lst.append(chr(y + 0x80)) 
+        lst.append(y + 0x80) 
         if x == 0: 
             break 
     lst.reverse() 
-    lst[-1] = chr(ord(lst[-1]) & 0x7f) 
-    return str([lst, ""]) 
+    lst[-1] = lst[-1] & 0x7f 
+    return bytes(lst)
 class EnumException(Exception): 
     pass 
 class Enumeration: 
@@ -120,6 +117,8 @@ metaEvents = Enumeration([("SEQUENCE_NUMBER", 0x00),
                           ("LYRIC", 0x05), 
                           ("MARKER", 0x06), 
                           ("CUE_POINT", 0x07), 
+                          ("PROGRAM_NAME", 0x08),
+                          ("DEVICE_NAME", 0x09),
                           ("MIDI_CHANNEL_PREFIX", 0x20), 
                           ("MIDI_PORT", 0x21), 
                           ("END_OF_TRACK", 0x2F), 
@@ -128,14 +127,12 @@ metaEvents = Enumeration([("SEQUENCE_NUMBER", 0x00),
                           ("TIME_SIGNATURE", 0x58), 
                           ("KEY_SIGNATURE", 0x59), 
                           ("SEQUENCER_SPECIFIC_META_EVENT", 0x7F)]) 
-# runningStatus appears to want to be an attribute of a MidiTrack. But 
-# it doesn't seem to do any harm to implement it as a global. 
-runningStatus = None 
 class MidiEvent: 
     def __init__(self, track): 
         self.track = track 
         self.time = None 
         self.channel = self.pitch = self.velocity = self.data = None 
+        self.metaType = None # the type byte of a meta event
     def __cmp__(self, other): 
         # assert self.time != None and other.time != None 
         return cmp(self.time, other.time) 
@@ -149,83 +146,89 @@ class MidiEvent:
             if getattr(self, attrib) != None: 
                 r = r + ", " + attrib + "=" + repr(getattr(self, attrib)) 
         return r + ">" 
-    def read(self, time, tmpstr): 
-        global runningStatus
+    def read(self, time, data, pos): 
+        # decode the event that starts at data[pos], and return the position after it
         self.time = time 
-        #print('%02x' % tmpstr[0])
-        # do we need to use running status? 
-        if not (tmpstr[0] & 0x80): 
-            tmpstr = bytes([runningStatus]) + tmpstr
-        runningStatus = x = tmpstr[0]
+        x = data[pos]
+        # do we need to use running status? It is kept by the track, so
+        # different files (and tracks) can be read at the same time.
+        if x & 0x80: 
+            pos = pos + 1
+            if x < 0xF0:
+                self.track.runningStatus = x
+            elif x != 0xFF: # sysex events cancel running status, and meta events leave it alone
+                self.track.runningStatus = None
+        elif self.track.runningStatus is None:
+            raise Exception("Running status with no status byte before it")
+        else:
+            x = self.track.runningStatus
         y = x & 0xF0 
-        z = tmpstr[1] 
         if channelVoiceMessages.has_value(y): 
             self.channel = (x & 0x0F) + 1 
             self.type = channelVoiceMessages.whatis(y) 
+            z = data[pos]
             if (self.type == "PROGRAM_CHANGE" or 
                 self.type == "CHANNEL_KEY_PRESSURE"): 
                 self.data = z 
-                return tmpstr[2:] 
+                return pos + 1
             else: 
                 self.pitch = z 
-                self.velocity = tmpstr[2] 
+                self.velocity = data[pos + 1] 
                 channel = self.track.channels[self.channel - 1] 
                 if (self.type == "NOTE_OFF" or 
                     (self.velocity == 0 and self.type == "NOTE_ON")): 
                     channel.noteOff(self.pitch, self.time) 
                 elif self.type == "NOTE_ON": 
                     channel.noteOn(self.pitch, self.time, self.velocity) 
-                return tmpstr[3:] 
-        elif y == 0xB0 and channelModeMessages.has_value(z): 
+                return pos + 2
+        elif y == 0xB0 and channelModeMessages.has_value(data[pos]): 
             self.channel = (x & 0x0F) + 1 
-            self.type = channelModeMessages.whatis(z) 
+            self.type = channelModeMessages.whatis(data[pos]) 
             if self.type == "LOCAL_CONTROL": 
-                self.data = (tmpstr[2] == 0x7F) 
+                self.data = (data[pos + 1] == 0x7F) 
             elif self.type == "MONO_MODE_ON": 
-                self.data = tmpstr[2] 
-            return tmpstr[3:] 
+                self.data = data[pos + 1] 
+            return pos + 2
         elif x == 0xF0 or x == 0xF7: 
             self.type = {0xF0: "F0_SYSEX_EVENT", 
                          0xF7: "F7_SYSEX_EVENT"}[x] 
-            length, tmpstr = getVariableLengthNumber(tmpstr[1:]) 
-            self.data = tmpstr[:length] 
-            return tmpstr[length:] 
+            length, pos = getVariableLengthNumber(data, pos) 
+            self.data = bytes(data[pos:pos + length]) # only the event's own bytes are copied
+            return pos + length
         elif x == 0xFF: 
-            if not metaEvents.has_value(z): 
-                print("Unknown meta event: FF %02X" % z) 
-                sys.stdout.flush() 
-                raise Exception("Unknown midi event type") 
-            self.type = metaEvents.whatis(z) 
-            length, tmpstr = getVariableLengthNumber(tmpstr[2:]) 
-            self.data = tmpstr[:length] 
-            return tmpstr[length:] 
+            z = data[pos]
+            self.metaType = z
+            if metaEvents.has_value(z): 
+                self.type = metaEvents.whatis(z) 
+            else:
+                self.type = "UNKNOWN_META_EVENT"
+            length, pos = getVariableLengthNumber(data, pos + 1) 
+            self.data = bytes(data[pos:pos + length]) 
+            return pos + length
         raise Exception("Unknown midi event type") 
     def write(self): 
+        # the event's bytes, always with a status byte (no running status)
         sysex_event_dict = {"F0_SYSEX_EVENT": 0xF0, 
                             "F7_SYSEX_EVENT": 0xF7} 
         if channelVoiceMessages.hasattr(self.type): 
-            x = chr((self.channel - 1) + 
-                    getattr(channelVoiceMessages, self.type)) 
+            x = (self.channel - 1) + getattr(channelVoiceMessages, self.type)
             if (self.type != "PROGRAM_CHANGE" and 
                 self.type != "CHANNEL_KEY_PRESSURE"): 
-                data = chr(self.pitch) + chr(self.velocity) 
+                return bytes([x, self.pitch, self.velocity])
             else: 
-                data = chr(self.data) 
-            return x + data 
+                return bytes([x, self.data])
         elif channelModeMessages.hasattr(self.type): 
             x = getattr(channelModeMessages, self.type) 
-            x = (chr(0xB0 + (self.channel - 1)) + 
-                 chr(x) + 
-                 chr(self.data)) 
-            return x 
+            if self.type == "LOCAL_CONTROL":
+                data = 0x7F if self.data else 0
+            else:
+                data = self.data or 0
+            return bytes([0xB0 + (self.channel - 1), x, data])
         elif self.type in sysex_event_dict: 
-            tmpstr = chr(sysex_event_dict[self.type]) 
-            tmpstr = tmpstr + putVariableLengthNumber(len(self.data)) 
-            return tmpstr + str(self.data) 
-        elif metaEvents.hasattr(self.type): 
-            tmpstr = chr(0xFF) + chr(getattr(metaEvents, self.type)) 
-            tmpstr = tmpstr + putVariableLengthNumber(len(self.data)) 
-            return tmpstr + str(self.data) 
+            return bytes([sysex_event_dict[self.type]]) + putVariableLengthNumber(len(self.data)) + bytes(self.data)
+        elif metaEvents.hasattr(self.type) or self.type == "UNKNOWN_META_EVENT": 
+            code = self.metaType if self.type == "UNKNOWN_META_EVENT" else getattr(metaEvents, self.type)
+            return bytes([0xFF, code]) + putVariableLengthNumber(len(self.data)) + bytes(self.data)
         else: 
             raise Exception("unknown midi event type: " + self.type) 
 """ 
@@ -266,43 +269,39 @@ those
         # I think, but we probably better just ignore it. 
 class DeltaTime(MidiEvent): 
     type = "DeltaTime" 
-    def read(self, oldtmpstr): 
-        self.time, newtmpstr = getVariableLengthNumber(oldtmpstr) 
-        return self.time, newtmpstr 
+    def read(self, data, pos): 
+        self.time, pos = getVariableLengthNumber(data, pos) 
+        return self.time, pos
     def write(self): 
-        tmpstr = putVariableLengthNumber(self.time) 
-        return tmpstr 
+        return putVariableLengthNumber(self.time) 
 class MidiTrack: 
     def __init__(self, index): 
         self.index = index 
         self.events = [ ] 
         self.channels = [ ] 
         self.length = 0 
+        self.runningStatus = None # the status byte of the latest event read
         for i in range(16): 
             self.channels.append(MidiChannel(self, i+1)) 
-    def read(self, tmpstr): 
+    def read(self, data, pos=0): 
+        # read the track chunk that starts at data[pos], and return the position after it
         time = 0 
-        assert tmpstr[:4] == b"MTrk" 
-        length, tmpstr = getNumber(tmpstr[4:], 4) 
+        assert data[pos:pos + 4] == b"MTrk" 
+        length, pos = getNumber(data, pos + 4, 4) 
         self.length = length 
-        mytmpstr = tmpstr[:length] 
-        remainder = tmpstr[length:] 
-        while mytmpstr: 
+        end = pos + length
+        while pos < end: 
             delta_t = DeltaTime(self) 
-            dt, mytmpstr = delta_t.read(mytmpstr) 
+            dt, pos = delta_t.read(data, pos) 
             time = time + dt 
             self.events.append(delta_t) 
             e = MidiEvent(self) 
-            mytmpstr = e.read(time, mytmpstr) 
+            pos = e.read(time, data, pos) 
             self.events.append(e) 
-        return remainder 
+        return end
     def write(self): 
-        time = self.events[0].time 
-        # build tmpstr using MidiEvents 
-        tmpstr = "" 
-        for e in self.events: 
-            tmpstr = tmpstr + e.write() 
-        return "MTrk" + putNumber(len(tmpstr), 4) + tmpstr 
+        body = b"".join([e.write() for e in self.events])
+        return b"MTrk" + putNumber(len(body), 4) + body
     def __repr__(self): 
         r = "<MidiTrack %d -- %d events\n" % (self.index, 
 len(self.events)) 
@@ -319,9 +318,9 @@ class MidiFile:
     def open(self, filename, attrib="rb"): 
         if filename == None: 
             if attrib in ["r", "rb"]: 
-                self.file = sys.stdin 
+                self.file = sys.stdin.buffer
             else: 
-                self.file = sys.stdout 
+                self.file = sys.stdout.buffer
         else: 
             self.file = open(filename, attrib) 
     def __repr__(self): 
@@ -330,45 +329,46 @@ class MidiFile:
             r = r + "  " + repr(t) + "\n" 
         return r + ">" 
     def close(self): 
-        #self.file.close()
-        pass
+        if self.file is not None and self.file not in [sys.stdin.buffer, sys.stdout.buffer]:
+            self.file.close()
+        self.file = None
     def read(self): 
         self.readstr(self.file.read()) 
-    def readstr(self, tmpstr): 
-        assert tmpstr[:4] == b"MThd" 
-        length, tmpstr = getNumber(tmpstr[4:], 4) 
-        assert length == 6 
-        format, tmpstr = getNumber(tmpstr, 2) 
-        self.format = format 
-        assert format == 0 or format == 1   # dunno how to handle 2 
-        numTracks, tmpstr = getNumber(tmpstr, 2) 
-        division, tmpstr = getNumber(tmpstr, 2) 
-        if division & 0x8000: 
-            framesPerSecond = -((division >> 8) | -128) 
-            ticksPerFrame = division & 0xFF 
-            assert ticksPerFrame == 24 or ticksPerFrame == 25 or \
-                   ticksPerFrame == 29 or ticksPerFrame == 30 
-            if ticksPerFrame == 29: ticksPerFrame = 30  # drop frame 
-            self.ticksPerSecond = ticksPerFrame * framesPerSecond 
-        else: 
-            self.ticksPerQuarterNote = division & 0x7FFF 
-        for i in range(numTracks): 
-            trk = MidiTrack(i)
-            #print('Track#%d' % i);
-            tmpstr = trk.read(tmpstr) 
-            self.tracks.append(trk) 
+    def readstr(self, data): 
+        # data can be bytes, a bytearray, a memoryview or an mmap. It is read
+        # through a memoryview, so track chunks aren't copied.
+        with memoryview(data) as view:
+            assert view[:4] == b"MThd" 
+            length, pos = getNumber(view, 4, 4) 
+            assert length == 6 
+            format, pos = getNumber(view, pos, 2) 
+            self.format = format 
+            assert format == 0 or format == 1   # dunno how to handle 2 
+            numTracks, pos = getNumber(view, pos, 2) 
+            division, pos = getNumber(view, pos, 2) 
+            if division & 0x8000: 
+                framesPerSecond = -((division >> 8) | -128) 
+                ticksPerFrame = division & 0xFF 
+                assert ticksPerFrame == 24 or ticksPerFrame == 25 or \
+                       ticksPerFrame == 29 or ticksPerFrame == 30 
+                if ticksPerFrame == 29: ticksPerFrame = 30  # drop frame 
+                self.ticksPerSecond = ticksPerFrame * framesPerSecond 
+            else: 
+                self.ticksPerQuarterNote = division & 0x7FFF 
+            for i in range(numTracks): 
+                trk = MidiTrack(i)
+                pos = trk.read(view, pos) 
+                self.tracks.append(trk) 
     def write(self): 
         self.file.write(self.writestr()) 
     def writestr(self): 
         division = self.ticksPerQuarterNote 
         # Don't handle ticksPerSecond yet, too confusing 
         assert (division & 0x8000) == 0 
-        tmpstr = "MThd" + putNumber(6, 4) + putNumber(self.format, 2) 
+        tmpstr = b"MThd" + putNumber(6, 4) + putNumber(self.format, 2) 
         tmpstr = tmpstr + putNumber(len(self.tracks), 2) 
         tmpstr = tmpstr + putNumber(division, 2) 
-        for trk in self.tracks: 
-            tmpstr = tmpstr + trk.write() 
-        return tmpstr 
+        return tmpstr + b"".join([trk.write() for trk in self.tracks])
 def main(argv): 
     global debugflag 
     import getopt 